@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+"""
+任意形状的下载范围（AOI）：多边形 / 折线 + 缓冲距离（道路、管线走廊）
+
+- 输入：GeoJSON（dict / 字符串 / .geojson 文件）或 WKT（字符串 / .wkt 文件），坐标为 经度 纬度
+  支持 Polygon / MultiPolygon / LineString / MultiLineString / Point / MultiPoint
+- 折线和点必须给缓冲距离 buffer_m（米，地面距离）；多边形给了缓冲距离就向外扩
+- 覆盖计算全部在 NumPy 里批量完成，不逐张瓦片判断：
+  1. 所有顶点一次换算成带小数的瓦片坐标（mercator.lonlat_to_tile_np）
+  2. 扫描线：每条整数水平线上按奇偶规则求多边形内部区间，
+     再加上每条边在每个瓦片行内的 x 范围，两者并起来就是该行和多边形相交的瓦片
+- 结果是稀疏瓦片集合；任务头里保存 AOI 本身，resume 时重新算出同一批瓦片
+"""
+
+import json
+import math
+import os
+import re
+
+import numpy as np
+
+import mercator
+
+CIRCLE_SEGMENTS = 16    # 缓冲区圆角用多少边形近似（外接，保证覆盖整个圆）
+
+
+# ========================
+# 读入 AOI
+# ========================
+def load(aoi):
+    """文件路径 → 文件内容；JSON 字符串 → dict；其余（dict / WKT）原样返回（任务头里保存这个结果）"""
+    if isinstance(aoi, str) and os.path.isfile(aoi):
+        with open(aoi, "r", encoding="utf-8") as f:
+            aoi = f.read()
+    if isinstance(aoi, str):
+        aoi = aoi.strip()
+        if aoi.startswith("{"):
+            aoi = json.loads(aoi)
+    return aoi
+
+
+def parse_wkt(text):
+    """WKT → GeoJSON 风格的 geometry dict（忽略 Z / M 坐标）"""
+    m = re.match(r"\s*([A-Za-z]+)(?:\s+(?:Z|M|ZM))?\s*(\(.*\))\s*$", text, re.S)
+    if not m:
+        raise ValueError(f"无法解析的 WKT：{text[:60]}")
+    kind = m.group(1).upper()
+    types = {
+        "POINT": "Point", "MULTIPOINT": "MultiPoint",
+        "LINESTRING": "LineString", "MULTILINESTRING": "MultiLineString",
+        "POLYGON": "Polygon", "MULTIPOLYGON": "MultiPolygon",
+    }
+    if kind not in types:
+        raise ValueError(f"不支持的 WKT 类型：{kind}")
+
+    # "x y [z]" → [x,y]，括号 → 方括号，再按 JSON 读
+    num = r"[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?"
+    body = re.sub(rf"({num})\s+({num})(?:\s+{num})*", r"[\1,\2]", m.group(2))
+    coords = json.loads(body.replace("(", "[").replace(")", "]"))
+    if kind == "POINT":
+        coords = coords[0]
+    elif kind == "MULTIPOINT":
+        coords = [c[0] if isinstance(c[0], list) else c for c in coords]
+    return {"type": types[kind], "coordinates": coords}
+
+
+def geometries(aoi):
+    """展开成 [(类型, 坐标), ...]，类型为 'polygon'（环列表）/ 'line'（点列表）/ 'point'（单点）"""
+    aoi = load(aoi)
+    if isinstance(aoi, str):
+        aoi = parse_wkt(aoi)
+
+    kind = aoi.get("type")
+    if kind == "FeatureCollection":
+        return [g for f in aoi["features"] for g in geometries(f)]
+    if kind == "Feature":
+        return geometries(aoi["geometry"])
+    if kind == "GeometryCollection":
+        return [g for sub in aoi["geometries"] for g in geometries(sub)]
+
+    coords = aoi.get("coordinates")
+    if kind == "Polygon":
+        return [("polygon", coords)]
+    if kind == "MultiPolygon":
+        return [("polygon", rings) for rings in coords]
+    if kind == "LineString":
+        return [("line", coords)]
+    if kind == "MultiLineString":
+        return [("line", line) for line in coords]
+    if kind == "Point":
+        return [("point", coords)]
+    if kind == "MultiPoint":
+        return [("point", p) for p in coords]
+    raise ValueError(f"不支持的 GeoJSON 类型：{kind}")
+
+
+# ========================
+# 几何 → 边（Web Mercator 米）
+# ========================
+def to_mercator(points):
+    """[[lon, lat], ...] → (N, 2) 米坐标；同时返回每个点的纬度（缓冲距离换算用）"""
+    pts = np.asarray(points, dtype=np.float64)[:, :2]
+    mx, my = mercator.lonlat_to_mercator_np(pts[:, 0], pts[:, 1])
+    return np.column_stack([mx, my]), pts[:, 1]
+
+
+def ring_edges(ring):
+    """闭合环 (N, 2) → 边 (N, 4)：x0 y0 x1 y1"""
+    return np.hstack([ring, np.roll(ring, -1, axis=0)])
+
+
+def buffer_shapes(points, lats, buffer_m):
+    """
+    折线（或单点）的缓冲区 = 每个顶点一个圆 + 每段一个矩形，返回 [(K, 2) 环, ...]
+    Mercator 在纬度 lat 处放大 1/cos(lat) 倍，所以缓冲半径按各点纬度换成 Mercator 米
+    """
+    r = buffer_m / np.cos(np.radians(lats))
+    angles = np.linspace(0, 2 * np.pi, CIRCLE_SEGMENTS, endpoint=False)
+    unit = np.column_stack([np.cos(angles), np.sin(angles)]) / math.cos(math.pi / CIRCLE_SEGMENTS)
+    shapes = list(points[:, None, :] + r[:, None, None] * unit[None])
+
+    d = points[1:] - points[:-1]
+    length = np.hypot(d[:, 0], d[:, 1])
+    keep = length > 0
+    normal = np.column_stack([-d[keep, 1], d[keep, 0]]) / length[keep, None]
+    p0, p1 = points[:-1][keep], points[1:][keep]
+    n0, n1 = normal * r[:-1][keep, None], normal * r[1:][keep, None]
+    shapes += list(np.stack([p0 + n0, p1 + n1, p1 - n1, p0 - n0], axis=1))
+    return shapes
+
+
+def polygon_edges(aoi, buffer_m=0):
+    """
+    AOI → 所有多边形的边 (E, 4)（Mercator 米）和每条边所属多边形编号 (E,)
+    同一多边形的外环和内环（洞）编号相同，扫描时按奇偶规则处理
+    """
+    edges, ids = [], []
+    count = 0
+
+    def add(rings):
+        nonlocal count
+        pid, count = count, count + 1
+        for ring in rings:
+            e = ring_edges(ring)
+            edges.append(e)
+            ids.append(np.full(len(e), pid))
+
+    for kind, coords in geometries(aoi):
+        if kind == "polygon":
+            rings = [to_mercator(r)[0] for r in coords]
+            add(rings)
+            if buffer_m > 0:
+                # 多边形外扩 = 多边形本身 + 各条边界线的缓冲区
+                for r in coords:
+                    pts, lats = to_mercator(r)
+                    for shape in buffer_shapes(pts, lats, buffer_m):
+                        add([shape])
+        else:
+            if buffer_m <= 0:
+                raise ValueError("折线 / 点 AOI 需要缓冲距离 buffer_m（米）")
+            pts, lats = to_mercator(coords if kind == "line" else [coords])
+            for shape in buffer_shapes(pts, lats, buffer_m):
+                add([shape])
+
+    if not edges:
+        raise ValueError("AOI 里没有几何图形")
+    return np.vstack(edges), np.concatenate(ids)
+
+
+# ========================
+# 扫描线：边 → 瓦片
+# ========================
+def expand(counts):
+    """每组 0..counts[i]-1 的组内序号（np.repeat 展开后用）"""
+    starts = np.cumsum(counts) - counts
+    return np.arange(counts.sum()) - np.repeat(starts, counts)
+
+
+def cover(edges, ids, zoom):
+    """边（Mercator 米）→ 相交瓦片 (T, 2) 数组，列为 x, y，按 y、x 排序"""
+    n = 2 ** zoom
+    x0, y0 = mercator.mercator_to_tile_np(edges[:, 0], edges[:, 1], zoom)
+    x1, y1 = mercator.mercator_to_tile_np(edges[:, 2], edges[:, 3], zoom)
+    ylo, yhi = np.minimum(y0, y1), np.maximum(y0, y1)
+    dy = y1 - y0
+    flat = dy == 0
+    safe_dy = np.where(flat, 1.0, dy)
+
+    # 1. 每条边在它经过的每个瓦片行 [r, r+1] 里的 x 范围
+    r0 = np.floor(ylo).astype(np.int64)
+    r1 = np.maximum(r0, np.ceil(yhi).astype(np.int64) - 1)
+    counts = r1 - r0 + 1
+    e = np.repeat(np.arange(len(edges)), counts)
+    rows_a = np.repeat(r0, counts) + expand(counts)
+    ta = np.where(flat[e], 0.0, np.clip((rows_a - y0[e]) / safe_dy[e], 0, 1))
+    tb = np.where(flat[e], 1.0, np.clip((rows_a + 1 - y0[e]) / safe_dy[e], 0, 1))
+    xa = x0[e] + ta * (x1[e] - x0[e])
+    xb = x0[e] + tb * (x1[e] - x0[e])
+    lo_a, hi_a = np.minimum(xa, xb), np.maximum(xa, xb)
+
+    # 2. 每条整数水平线 y = k 上多边形内部的区间（奇偶规则），同时属于上下两行
+    k0 = np.ceil(ylo).astype(np.int64)
+    counts = np.where(flat, 0, np.maximum(np.ceil(yhi).astype(np.int64) - k0, 0))
+    e = np.repeat(np.arange(len(edges)), counts)
+    k = np.repeat(k0, counts) + expand(counts)
+    xk = x0[e] + (k - y0[e]) / safe_dy[e] * (x1[e] - x0[e])
+    order = np.lexsort((xk, k, ids[e]))
+    xk, k = xk[order], k[order]
+    left, right, line = xk[0::2], xk[1::2], k[0::2]
+    rows_b = np.concatenate([line - 1, line])
+    lo_b = np.concatenate([left, left])
+    hi_b = np.concatenate([right, right])
+
+    # 区间 → 瓦片列号（右端正好落在瓦片边界上时不算进下一列）
+    rows = np.concatenate([rows_a, rows_b])
+    lo = np.concatenate([lo_a, lo_b])
+    hi = np.concatenate([hi_a, hi_b])
+    c0 = np.floor(lo).astype(np.int64)
+    c1 = np.maximum(c0, np.ceil(hi).astype(np.int64) - 1)
+    keep = (rows >= 0) & (rows < n) & (c1 >= 0) & (c0 < n)
+    rows, c0, c1 = rows[keep], np.clip(c0[keep], 0, n - 1), np.clip(c1[keep], 0, n - 1)
+
+    counts = c1 - c0 + 1
+    xs = np.repeat(c0, counts) + expand(counts)
+    keys = np.unique(np.repeat(rows, counts) * n + xs)
+    return np.column_stack([keys % n, keys // n])
+
+
+def tiles_for(aoi, zoom, buffer_m=0):
+    """AOI 在 zoom 层相交的全部瓦片 (T, 2)：x, y"""
+    edges, ids = polygon_edges(aoi, buffer_m)
+    return cover(edges, ids, zoom)
+
+
+# ========================
+# 任务（job）
+# ========================
+def aoi_job(aoi, zoom, buffer_m=0):
+    """
+    AOI → 下载任务的 tile_range：外接瓦片范围 + AOI 本身
+    （下载 / 拼接只处理 AOI 覆盖的瓦片；journal 任务头里也保存 AOI，resume 时重算）
+    """
+    aoi = load(aoi)
+    tiles = tiles_for(aoi, zoom, buffer_m)
+    if len(tiles) == 0:
+        raise ValueError("AOI 没有覆盖任何瓦片")
+    min_x, min_y = (int(v) for v in tiles.min(axis=0))
+    max_x, max_y = (int(v) for v in tiles.max(axis=0))
+    box = (max_x - min_x + 1) * (max_y - min_y + 1)
+    print(f"[INFO] AOI 覆盖 {len(tiles)} 张瓦片（外接矩形 {box} 张，{len(tiles) / box:.1%}）")
+    return {"zoom": zoom, "min_x": min_x, "max_x": max_x, "min_y": min_y, "max_y": max_y,
+            "aoi": aoi, "buffer_m": buffer_m}
+
+
+def job_tiles(job):
+    """任务的全部瓦片 (z, x, y)：有 AOI 时是稀疏集合，否则是整个矩形"""
+    z = job["zoom"]
+    if job.get("aoi") is not None:
+        for x, y in tiles_for(job["aoi"], z, job.get("buffer_m", 0)).tolist():
+            yield z, x, y
+        return
+    for x in range(job["min_x"], job["max_x"] + 1):
+        for y in range(job["min_y"], job["max_y"] + 1):
+            yield z, x, y
+
+
+def tile_count(job):
+    """任务的瓦片总数（进度显示用）"""
+    if job.get("aoi") is not None:
+        return len(tiles_for(job["aoi"], job["zoom"], job.get("buffer_m", 0)))
+    return (job["max_x"] - job["min_x"] + 1) * (job["max_y"] - job["min_y"] + 1)
+
+
+def tile_set(job):
+    """拼接用：AOI 任务返回 {(x, y), ...}，矩形任务（或 job 为空）返回 None（不过滤）"""
+    if not job or job.get("aoi") is None:
+        return None
+    return set(map(tuple, tiles_for(job["aoi"], job["zoom"], job.get("buffer_m", 0)).tolist()))
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""
+批量任务：一份清单（AOI × zoom × 来源）合并成一个去重的瓦片工作集，
+每张 (来源, z, x, y) 只下载一次，再从共享瓦片库拼出清单里的每一幅图
+
+清单（JSON）：
+  {
+    "db": "tiles/tiles.mbtiles",
+    "output_dir": "output",
+    "jobs": [
+      {"name": "ennis", "sources": ["osm"], "zooms": [14, 15], "center": [52.867, -8.756], "half_range": 10},
+      {"name": "quay", "sources": ["osm", "apple"], "zooms": [18], "format": "tif",
+       "aoi": "LINESTRING(-9.05 53.27, -9.04 53.28)", "buffer": 50}
+    ]
+  }
+
+- 范围写法同命令行：bbox / center + half_range / center + size（米）/ aoi（+ buffer）
+- 输出默认 {output_dir}/{name}_{source}_z{zoom}.{format}（format 默认 png）；也可给 "output" 模板，占位符相同
+- 相邻 / 重叠的区域、同一区域的多个 zoom 共用一个瓦片库：重叠部分只下载一次，
+  库里已有的瓦片直接跳过（refresh 时改发条件请求）
+- 每个来源一个任务日志，中断后用同一份清单重跑就从断点继续
+
+  python cli.py batch sites.json --plan
+  python cli.py batch sites.json
+"""
+
+import hashlib
+import json
+import os
+from contextlib import ExitStack
+
+import cache
+import journal
+import metrics
+import sources
+import tilestore
+
+DEFAULT_DB = sources.DEFAULT_DB
+DEFAULT_OUTPUT = "{output_dir}/{name}_{source}_z{zoom}.{format}"
+AREA_KEYS = ("bbox", "center", "half_range", "size", "aoi", "buffer")
+
+
+# ========================
+# 清单
+# ========================
+def load_manifest(path):
+    with open(path, "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    if not manifest.get("jobs"):
+        raise ValueError(f"清单 {path} 里没有 jobs")
+    for job in manifest["jobs"]:
+        for source in job.get("sources", ["osm"]):
+            if source not in sources.SOURCES:
+                raise ValueError(f"{job.get('name')}: 未知来源 {source}")
+            if source == "google":
+                raise ValueError(f"{job.get('name')}: google 静态图不是 XYZ 瓦片，不能合并进批量任务")
+    return manifest
+
+
+def expand(manifest):
+    """清单 → [{name, source, zoom, job, output}, ...]，每个 AOI × zoom × 来源一项"""
+    output_dir = manifest.get("output_dir", "output")
+    entries = []
+    for i, spec in enumerate(manifest["jobs"]):
+        name = spec.get("name", f"job{i}")
+        area = {k: spec[k] for k in AREA_KEYS if k in spec}
+        for zoom in spec["zooms"]:
+            job = sources.tile_range(zoom, **area)   # 同一区域在不同来源下瓦片编号相同，只算一次
+            for source in spec.get("sources", ["osm"]):
+                output = spec.get("output", DEFAULT_OUTPUT).format(
+                    output_dir=output_dir, name=name, source=source, zoom=zoom,
+                    format=spec.get("format", manifest.get("format", "png")))
+                entries.append({"name": name, "source": source, "zoom": zoom, "job": job, "output": output})
+    return entries
+
+
+def work_set(entries, source):
+    """(某来源全部请求的瓦片数, 去重后的 [(z, x, y), ...])，按 z / y / x 排序，和拼接时读库的顺序一致"""
+    import aoi
+
+    requested = 0
+    tiles = set()
+    for entry in entries:
+        if entry["source"] == source:
+            job_tiles = list(aoi.job_tiles(entry["job"]))
+            requested += len(job_tiles)
+            tiles.update(job_tiles)
+    return requested, sorted(tiles, key=lambda t: (t[0], t[2], t[1]))
+
+
+def cached_tiles(store, provider, tiles):
+    """tiles 里已经在库中的 {(z, x, y), ...}（每个 zoom 一次主键范围查询）"""
+    by_zoom = {}
+    for z, x, y in tiles:
+        by_zoom.setdefault(z, []).append((x, y))
+    cached = set()
+    for z, keys in by_zoom.items():
+        xs = [x for x, _ in keys]
+        ys = [y for _, y in keys]
+        found = store.keys_in_range(provider, z, min(xs), max(xs), min(ys), max(ys))
+        cached.update((z, x, y) for x, y in keys if (x, y) in found)
+    return cached
+
+
+def zoom_ranges(tiles):
+    """[(z, x, y), ...] → 每个 zoom 一个包住全部瓦片的 job 范围（任务期间 pin 住，不被淘汰）"""
+    by_zoom = {}
+    for z, x, y in tiles:
+        by_zoom.setdefault(z, []).append((x, y))
+    return [{"zoom": z, "min_x": min(x for x, _ in keys), "max_x": max(x for x, _ in keys),
+             "min_y": min(y for _, y in keys), "max_y": max(y for _, y in keys)} for z, keys in by_zoom.items()]
+
+
+def batch_name(provider, tiles):
+    """批量任务名：来源 + 去重工作集的哈希，同一份清单重跑得到同一个任务日志（自动续传）"""
+    digest = hashlib.blake2b(json.dumps(tiles).encode("utf-8"), digest_size=6).hexdigest()
+    return f"batch_{provider}_{digest}"
+
+
+def configure(src, manifest, refresh):
+    """清单里的选项覆盖来源模块的配置区常量（同 cli.configure）"""
+    if hasattr(src, "REFRESH"):
+        src.REFRESH = refresh
+    if src.__name__ == "jim":
+        src.TILE_DB = manifest.get("db", DEFAULT_DB)
+        src.STITCH_PROCESSES = manifest.get("processes", 1)
+        src.STREAMING_STITCH = manifest.get("streaming", True)
+        src.INCREMENTAL_STITCH = manifest.get("incremental", False)
+        key = manifest.get("access_key") or os.getenv("APPLE_ACCESS_KEY")
+        if key:
+            src.ACCESS_KEY = key
+
+
+# ========================
+# 估算
+# ========================
+def plan_batch(manifest_path, refresh=False):
+    """只估算：每个来源请求 / 去重 / 已缓存 / 要下载的瓦片数，流量和时间"""
+    import plan
+
+    manifest = load_manifest(manifest_path)
+    tile_db = manifest.get("db", DEFAULT_DB)
+    entries = expand(manifest)
+    exists = os.path.exists(tile_db)
+    result = {"sources": {}, "mosaics": len(entries)}
+
+    with tilestore.TileStore(tile_db if exists else ":memory:", readonly=exists) as store:
+        for source in sorted({e["source"] for e in entries}):
+            src = sources.load_source(source)
+            requested, tiles = work_set(entries, source)
+            cached = len(cached_tiles(store, src.PROVIDER, tiles))
+            missing = len(tiles) - cached
+            requests = len(tiles) if refresh else missing
+            mean, _ = plan.mean_tile_bytes(store, src.PROVIDER)
+            transfer = missing * mean + (cached * plan.REVALIDATE_BYTES if refresh else 0)
+            seconds = plan.wall_time(requests, src.RATE_LIMIT, src.MAX_WORKERS)
+            print(f"[PLAN] {source}：清单共 {requested} 张瓦片，去重后 {len(tiles)}（省 {requested - len(tiles)}），"
+                  f"已缓存 {cached}，请求 {requests}，约 {metrics.fmt_bytes(transfer)}，预计 {metrics.fmt_time(seconds)}")
+            result["sources"][source] = {"requested": requested, "unique": len(tiles), "cached": cached,
+                                         "requests": requests, "bytes": transfer, "seconds": seconds}
+
+    for entry in entries:
+        print(f"[PLAN] 拼接 {entry['name']} {entry['source']} z={entry['zoom']} → {entry['output']}")
+    return result
+
+
+# ========================
+# 执行
+# ========================
+def fetch_source(src, tile_db, tiles, refresh=False):
+    """下载一个来源的去重工作集（库中已有的跳过，refresh 时发条件请求），返回 (summary, 失败的瓦片)"""
+    with tilestore.TileStore(tile_db) as store:
+        store.set_metadata(name="imagetool")
+        with ExitStack() as pins:   # 下载期间这些瓦片不会被淘汰
+            for job in zoom_ranges(tiles):
+                pins.enter_context(cache.pinned(store, src.PROVIDER, job))
+            cached = set() if refresh else cached_tiles(store, src.PROVIDER, tiles)
+            todo = [t for t in tiles if t not in cached]
+            if cached:
+                metrics.inc("cache", len(cached), result="hit")
+                print(f"[INFO] {src.PROVIDER}：{len(cached)} 张已在瓦片库，跳过")
+
+            name = batch_name(src.PROVIDER, tiles)
+            path = os.path.join(os.path.dirname(tile_db), "jobs", name + ".journal")
+            job_log = journal.JobJournal(path, {"provider": src.PROVIDER, "batch": name, "tiles": len(tiles)},
+                                         before_sync=store.flush)
+            pending = list(job_log.pending(todo))
+            src.fetch_tiles(store, job_log, pending, len(pending))
+
+            # 补洞：只重试失败的瓦片
+            failed = job_log.failed()
+            if failed:
+                print(f"[INFO] 补洞：重试 {len(failed)} 张失败瓦片")
+                src.fetch_tiles(store, job_log, failed, len(failed))
+            failed = set(job_log.failed())
+            summary = job_log.finish()
+        cache.enforce(store)
+
+    if summary[journal.FAILED]:
+        print(f"[WARN] {src.PROVIDER}：仍有 {summary[journal.FAILED]} 张瓦片失败，重跑同一份清单继续")
+    return summary, failed
+
+
+def stitch_entry(src, tile_db, entry, processes=1, streaming=True, incremental=False):
+    """从共享瓦片库拼出清单里的一幅图"""
+    folder = os.path.dirname(entry["output"])
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    job = entry["job"]
+    if src.__name__ == "jim":
+        src.stitch_tiles({"provider": src.PROVIDER, **job}, entry["output"])
+    else:
+        src.stitch_tiles(tile_db, entry["output"], entry["zoom"], job, streaming, processes, incremental)
+
+
+def run_batch(manifest_path, refresh=False, stitch=True):
+    """按清单下载（每张瓦片只下一次）+ 逐个拼接；返回 {来源: summary}"""
+    import aoi
+
+    manifest = load_manifest(manifest_path)
+    tile_db = manifest.get("db", DEFAULT_DB)
+    processes = manifest.get("processes", 1)
+    entries = expand(manifest)
+    summaries = {}
+    failed = {}
+
+    for source in sorted({e["source"] for e in entries}):
+        src = sources.load_source(source)
+        configure(src, manifest, refresh)
+        requested, tiles = work_set(entries, source)
+        print(f"[INFO] {source}：清单共 {requested} 张瓦片，去重后 {len(tiles)}")
+        summaries[source], failed[source] = fetch_source(src, tile_db, tiles, refresh)
+
+    if not stitch:
+        return summaries
+
+    for i, entry in enumerate(entries, 1):
+        src = sources.load_source(entry["source"])
+        missing = sum(1 for t in aoi.job_tiles(entry["job"]) if t in failed[entry["source"]])
+        if missing:
+            print(f"[WARN] {entry['name']} z={entry['zoom']}：{missing} 张瓦片缺失，拼接时留空")
+        print(f"\n=== [{i}/{len(entries)}] 拼接 {entry['name']} {entry['source']} z={entry['zoom']} ===")
+        stitch_entry(src, tile_db, entry, processes, manifest.get("streaming", True),
+                     manifest.get("incremental", False))
+    return summaries
@@ -0,0 +1,471 @@
+# -*- coding: utf-8 -*-
+"""
+离线基准测试：本地假瓦片服务器 + 固定场景，测下载吞吐和拼接速度，改代码前后对比，防止性能回退
+
+假服务器（FakeTileServer，单独一个进程）模仿三种接口：
+  /{z}/{x}/{y}.png                                  OSM XYZ（PNG）
+  /tile?style=..&z=..&x=..&y=..&accessKey=..         Apple 卫星瓦片（JPEG）
+  /maps/api/staticmap?center=..&size=WxH&scale=..    Google Static Maps（PNG，尺寸 = size × scale）
+可配置：延迟 + 随机抖动、错误率（返回 500）、429（超过每秒请求数或同时在途数时返回，带 Retry-After）、
+负载大小（图片后面补私有块 / JPEG 注释段到指定字节数，每张内容都不同，不会被按哈希去重）
+响应带 ETag，支持 If-None-Match → 304；GET /__stats 返回服务端计数
+
+场景（SCENARIOS）：1k / 10k / 100k 张瓦片，每个场景在新的进程里跑（峰值内存互不影响）：
+  下载：直接调用 osm.download_tiles / jim.download_job / go.run_static_mosaic，目标换成假服务器
+  拼接：流式 PNG；瓦片数超过 STITCH_MAX_TILES 时只拼前面若干行
+  （google 是边下边拼，STITCH_MAX_TILES 同时限制下载张数，拼接速度按粘贴耗时算）
+输出：张/s、请求耗时 p50 / p99、拼接 MP/s、峰值内存；--save 存 JSON，--baseline 与上次结果对比
+
+用法：
+  python bench.py                               # osm，1k
+  python bench.py 10k 100k --provider apple --latency 0.05 --error-rate 0.01
+  python bench.py 1k --max-rps 200 --retry-after 0.5    # 测 429 / AIMD
+  python bench.py 1k --save base.json           # 改代码前
+  python bench.py 1k --baseline base.json       # 改代码后：张/s、MP/s 下降超过 10% 时退出码为 1
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from multiprocessing import get_context
+from urllib.parse import parse_qs, urlsplit
+from urllib.request import urlopen
+
+import numpy as np
+from PIL import Image
+
+import mercator
+import metrics
+
+SCENARIOS = {"1k": 1_000, "10k": 10_000, "100k": 100_000}
+BENCH_ZOOM = 18
+BENCH_ORIGIN = (131_000, 87_000)   # 场景瓦片范围的左上角 (x, y)
+STITCH_MAX_TILES = 10_000          # 拼接最多拼这么多张（100k 场景全拼要几十 GB 临时磁盘）
+BASE_VARIANTS = 32                 # 假服务器预先生成的底图数量
+TOLERANCE = 0.10                   # --baseline：下降超过 10% 算回退
+
+
+# ========================
+# 假瓦片
+# ========================
+def base_images(fmt, size, variants=BASE_VARIANTS):
+    """若干张平滑随机底图（编码后的字节），瓦片按 (x, y) 轮流取用；大图按像素数少生成几张"""
+    rng = np.random.default_rng(0)
+    out = []
+    for _ in range(max(2, variants * 256 * 256 // (size[0] * size[1]))):
+        small = rng.integers(0, 256, (8, 8, 3), dtype=np.uint8)
+        img = Image.fromarray(small).resize(size, Image.BILINEAR)
+        buf = BytesIO()
+        if fmt == "jpg":
+            img.save(buf, "JPEG", quality=85)
+        else:
+            img.save(buf, "PNG")
+        out.append(buf.getvalue())
+    return out
+
+
+def pad_payload(data, fmt, size, key):
+    """把图片补到 size 字节：PNG 在 IEND 前加私有辅助块，JPEG 在 SOI 后加注释段；填充内容含 key，每张都不同"""
+    pad = size - len(data)
+    filler = key.encode()
+    if fmt == "jpg":
+        segments = []
+        pad = max(pad, 4 + len(filler))
+        while pad > 0:
+            n = min(pad - 4, 65533) if pad > 4 else 0
+            segments.append(b"\xff\xfe" + struct.pack(">H", n + 2) + (filler * (n // len(filler) + 1))[:n])
+            pad -= n + 4
+        return data[:2] + b"".join(segments) + data[2:]
+    n = max(pad - 12, len(filler))
+    body = (filler * (n // len(filler) + 1))[:n]
+    chunk = struct.pack(">I", n) + b"bnCh" + body + struct.pack(">I", zlib.crc32(body, zlib.crc32(b"bnCh")))
+    return data[:-12] + chunk + data[-12:]
+
+
+# ========================
+# 假服务器
+# ========================
+class _TileHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"   # keep-alive，和真实 CDN 一样复用连接
+    config = {}
+    state = None
+
+    def _reply(self, status, body=b"", headers=()):
+        self.send_response(status)
+        for k, v in headers:
+            self.send_header(k, v)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if body:
+            self.wfile.write(body)
+        self.state.count(status)
+
+    def _throttled(self):
+        """超过每秒请求数（令牌桶）或同时在途数时返回 True"""
+        cfg, st = self.config, self.state
+        with st.lock:
+            if cfg["max_inflight"] and st.inflight > cfg["max_inflight"]:
+                return True
+            if cfg["max_rps"]:
+                now = time.monotonic()
+                st.tokens = min(cfg["max_rps"], st.tokens + (now - st.last) * cfg["max_rps"])
+                st.last = now
+                if st.tokens < 1:
+                    return True
+                st.tokens -= 1
+        return False
+
+    def do_GET(self):
+        cfg, st = self.config, self.state
+        parts = urlsplit(self.path)
+        if parts.path == "/__stats":
+            with st.lock:
+                body = json.dumps(st.counts).encode()
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        q = {k: v[0] for k, v in parse_qs(parts.query).items()}
+        if parts.path == "/tile":                       # Apple
+            key, fmt, size = f"{q.get('z')}/{q.get('x')}/{q.get('y')}", "jpg", (256, 256)
+        elif parts.path.endswith("/staticmap"):          # Google Static
+            w, h = (int(v) for v in q.get("size", "640x640").split("x"))
+            scale = int(q.get("scale", 1))
+            key, fmt, size = q.get("center", ""), "png", (w * scale, h * scale)
+        elif parts.path.endswith(".png"):                # OSM XYZ
+            key, fmt, size = parts.path.strip("/")[:-4], "png", (256, 256)
+        else:
+            self._reply(404)
+            return
+
+        with st.lock:
+            st.inflight += 1
+        try:
+            delay = cfg["latency"] + random.uniform(0, cfg["jitter"])
+            if delay > 0:
+                time.sleep(delay)
+            if self._throttled():
+                self._reply(429, headers=[("Retry-After", f"{cfg['retry_after']:g}")])
+                return
+            if cfg["error_rate"] and random.random() < cfg["error_rate"]:
+                self._reply(500)
+                return
+            etag = f'"{zlib.crc32(key.encode()):08x}"'
+            if self.headers.get("If-None-Match") == etag:
+                self._reply(304, headers=[("ETag", etag)])
+                return
+            images = st.images(fmt, size)
+            data = pad_payload(images[zlib.crc32(key.encode()) % len(images)], fmt, cfg["payload"], key)
+            ctype = "image/jpeg" if fmt == "jpg" else "image/png"
+            self._reply(200, data, [("Content-Type", ctype), ("ETag", etag)])
+        finally:
+            with st.lock:
+                st.inflight -= 1
+
+    def log_message(self, *args):
+        pass
+
+
+class _ServerState:
+    def __init__(self, max_rps):
+        self.lock = threading.Lock()
+        self.inflight = 0
+        self.tokens = max_rps
+        self.last = time.monotonic()
+        self.counts = {}
+        self.cache = {}
+
+    def count(self, status):
+        with self.lock:
+            self.counts[str(status)] = self.counts.get(str(status), 0) + 1
+
+    def images(self, fmt, size):
+        with self.lock:
+            if (fmt, size) not in self.cache:
+                self.cache[fmt, size] = base_images(fmt, size)
+            return self.cache[fmt, size]
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256   # 默认 5，并发线程多时会被拒绝连接
+
+
+def _serve(config, ready):
+    """子进程：运行假服务器直到被终止"""
+    handler = type("Handler", (_TileHandler,), {"config": config, "state": _ServerState(config["max_rps"])})
+    server = _Server(("127.0.0.1", 0), handler)
+    ready.put(server.server_port)
+    server.serve_forever()
+
+
+class FakeTileServer:
+    """
+    单独进程里的假瓦片服务器（不和被测代码抢 GIL），with 语句里可用，.url 为根地址
+    latency / jitter：每次请求固定延迟 + [0, jitter) 随机抖动（秒）
+    error_rate：返回 500 的比例；max_rps / max_inflight：超过时返回 429（0 不限）
+    retry_after：429 的 Retry-After 秒数；payload：每张图补到的字节数
+    """
+
+    def __init__(self, latency=0.02, jitter=0.01, error_rate=0.0, max_rps=0, max_inflight=0,
+                 retry_after=1.0, payload=15_000):
+        self.config = dict(latency=latency, jitter=jitter, error_rate=error_rate, max_rps=max_rps,
+                           max_inflight=max_inflight, retry_after=retry_after, payload=payload)
+        self.process = None
+        self.url = None
+
+    def start(self):
+        ctx = get_context("spawn")
+        ready = ctx.Queue()
+        self.process = ctx.Process(target=_serve, args=(self.config, ready), daemon=True)
+        self.process.start()
+        self.url = f"http://127.0.0.1:{ready.get(timeout=30)}"
+        return self
+
+    def stats(self):
+        with urlopen(self.url + "/__stats") as r:
+            return json.loads(r.read())
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.join()
+            self.process = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+
+# ========================
+# 场景
+# ========================
+def scenario_range(tiles, zoom=BENCH_ZOOM, origin=BENCH_ORIGIN):
+    """接近正方形的瓦片范围，张数 >= tiles"""
+    cols = math.ceil(math.sqrt(tiles))
+    rows = math.ceil(tiles / cols)
+    return {"zoom": zoom, "min_x": origin[0], "max_x": origin[0] + cols - 1,
+            "min_y": origin[1], "max_y": origin[1] + rows - 1}
+
+
+def stitch_range(tile_range, max_tiles=STITCH_MAX_TILES):
+    """只拼前面若干行，使张数不超过 max_tiles"""
+    cols = tile_range["max_x"] - tile_range["min_x"] + 1
+    rows = max(1, min(tile_range["max_y"] - tile_range["min_y"] + 1, max_tiles // cols))
+    return {**tile_range, "max_y": tile_range["min_y"] + rows - 1}
+
+
+def tile_center(x, y, zoom):
+    """瓦片中心的 (lon, lat)"""
+    mx, my = mercator.tile_top_left(x, y, zoom)
+    half = mercator.tile_resolution(zoom, 256) * 128
+    return mercator.mercator_to_lonlat(mx + half, my - half)
+
+
+def _bench_osm(server_url, tile_range, workers, folder, max_tiles):
+    import osm
+    osm.OSM_TILE_URL = server_url + "/{z}/{x}/{y}.png"
+    osm.RATE_LIMIT = 0          # 不限速：测的是引擎本身
+    osm.MAX_WORKERS = workers
+    tile_db = os.path.join(folder, "tiles.mbtiles")
+
+    t0 = time.perf_counter()
+    osm.download_tiles(tile_range, tile_db)
+    download_s = time.perf_counter() - t0
+
+    part = stitch_range(tile_range, max_tiles)
+    t0 = time.perf_counter()
+    osm.stitch_tiles(tile_db, os.path.join(folder, "mosaic.png"), part["zoom"], part)
+    stitch_s = time.perf_counter() - t0
+    pixels = (part["max_x"] - part["min_x"] + 1) * (part["max_y"] - part["min_y"] + 1) * 256 * 256
+    return download_s, stitch_s, pixels
+
+
+def _bench_apple(server_url, tile_range, workers, folder, max_tiles):
+    import jim
+    jim.APPLE_TILE_HOST = server_url
+    jim.ACCESS_KEY = "bench"
+    jim.RATE_LIMIT = 0
+    jim.MAX_WORKERS = workers
+    jim.TILE_DB = os.path.join(folder, "tiles.mbtiles")
+    jim.ZOOM = tile_range["zoom"]
+    jim.AOI = None
+    jim.STITCH_PROCESSES = 1
+    jim.STREAMING_STITCH = True
+    jim.OUTPUT_IMAGE = os.path.join(folder, "mosaic.png")
+
+    t0 = time.perf_counter()
+    jim.download_job({"provider": jim.PROVIDER, **tile_range})
+    download_s = time.perf_counter() - t0
+
+    # jim.stitch_tiles 按经纬度框取范围：用角上瓦片的中心点，换算回来正好是同一个瓦片范围
+    part = stitch_range(tile_range, max_tiles)
+    jim.MIN_LON, jim.MAX_LAT = tile_center(part["min_x"], part["min_y"], part["zoom"])
+    jim.MAX_LON, jim.MIN_LAT = tile_center(part["max_x"], part["max_y"], part["zoom"])
+    t0 = time.perf_counter()
+    jim.stitch_tiles()
+    stitch_s = time.perf_counter() - t0
+    pixels = (part["max_x"] - part["min_x"] + 1) * (part["max_y"] - part["min_y"] + 1) * 256 * 256
+    return download_s, stitch_s, pixels
+
+
+def _bench_google(server_url, tile_range, workers, folder, max_tiles):
+    os.environ.setdefault("GOOGLE_API_KEY", "bench")
+    import go
+    go.GOOGLE_STATIC_URL = server_url + "/maps/api/staticmap"
+    go.RATE_LIMIT = 0
+    go.MAX_WORKERS = workers
+
+    # 张数 → 网格行列 → 覆盖范围（米）；边下边拼，拼接速度按粘贴耗时算
+    cols = tile_range["max_x"] - tile_range["min_x"] + 1
+    rows = min(tile_range["max_y"] - tile_range["min_y"] + 1, max(1, max_tiles // cols))
+    zoom = tile_range["zoom"]
+    res = mercator.meters_per_pixel(zoom)
+    step_x = round(go.SIZE_X * 0.9) * res
+    step_y = round(go.SIZE_Y * 0.9) * res
+    lon, lat = tile_center(tile_range["min_x"], tile_range["min_y"], zoom)
+
+    t0 = time.perf_counter()
+    go.run_static_mosaic(lat, lon, go.SIZE_X * res + (cols - 1.5) * step_x,
+                         go.SIZE_Y * res + (rows - 1.5) * step_y, zoom,
+                         out_dir=folder, overlap_ratio=0.10, make_pgw=False)
+    download_s = time.perf_counter() - t0
+    paste = metrics.REGISTRY.histogram("paste_seconds")
+    stitch_s = paste.sum if paste else 0.0
+    pixels = (go.SIZE_X * go.SCALE) * (go.SIZE_Y * go.SCALE) * cols * rows   # 按子图像素计
+    return download_s, stitch_s, pixels
+
+
+BENCHES = {"osm": _bench_osm, "apple": _bench_apple, "google": _bench_google}
+
+
+def run_scenario(name, provider, server_url, workers, folder, max_tiles=STITCH_MAX_TILES):
+    """子进程：跑一个场景，返回结果 dict"""
+    metrics.reset()
+    tile_range = scenario_range(SCENARIOS[name])
+    download_s, stitch_s, pixels = BENCHES[provider](server_url, tile_range, workers, folder, max_tiles)
+
+    s = metrics.summary()
+    latency = s["http_latency_seconds"]
+    tiles = sum(s["tiles"].values())
+    return {
+        "scenario": name, "provider": provider, "workers": workers, "tiles": tiles,
+        "download_s": round(download_s, 3),
+        "tiles_per_s": round(tiles / download_s, 1) if download_s else None,
+        "p50_ms": round(latency["p50"] * 1000, 1) if latency["count"] else None,
+        "p99_ms": round(latency["p99"] * 1000, 1) if latency["count"] else None,
+        "requests": s["requests"], "retries": s["retries"], "status": s["status"],
+        "stitch_mp": round(pixels / 1e6, 1),
+        "stitch_s": round(stitch_s, 3),
+        "stitch_mp_s": round(pixels / 1e6 / stitch_s, 1) if stitch_s else None,
+        "peak_rss_bytes": s["peak_rss_bytes"],
+    }
+
+
+def show(result):
+    rss = result["peak_rss_bytes"]
+    print(f"[OK] {result['provider']} {result['scenario']}：{result['tiles']} 张，{result['download_s']:.1f}s，"
+          f"{result['tiles_per_s']} 张/s，p50 {result['p50_ms']}ms / p99 {result['p99_ms']}ms，"
+          f"重试 {result['retries']}，拼接 {result['stitch_mp']} MP {result['stitch_s']:.1f}s"
+          f"（{result['stitch_mp_s']} MP/s），峰值内存 {metrics.fmt_bytes(rss) if rss else '-'}")
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    """与上次结果对比，返回回退项数"""
+    old = {(r["provider"], r["scenario"]): r for r in baseline}
+    regressions = 0
+    for r in results:
+        b = old.get((r["provider"], r["scenario"]))
+        if b is None:
+            continue
+        for key, higher_is_better in (("tiles_per_s", True), ("stitch_mp_s", True), ("peak_rss_bytes", False)):
+            if not r.get(key) or not b.get(key):
+                continue
+            change = r[key] / b[key] - 1
+            worse = change < -tolerance if higher_is_better else change > tolerance
+            tag = "[WARN]" if worse else "[INFO]"
+            print(f"{tag} {r['provider']} {r['scenario']} {key}：{b[key]} → {r[key]}（{change:+.1%}）")
+            regressions += worse
+    return regressions
+
+
+# ========================
+# 入口
+# ========================
+def main(argv=None):
+    p = argparse.ArgumentParser(description="本地假瓦片服务器上的下载 / 拼接基准测试")
+    p.add_argument("scenarios", nargs="*", default=["1k"], choices=list(SCENARIOS))
+    p.add_argument("--provider", default="osm", choices=list(BENCHES))
+    p.add_argument("--workers", type=int, default=8)
+    p.add_argument("--latency", type=float, default=0.02)
+    p.add_argument("--jitter", type=float, default=0.01)
+    p.add_argument("--error-rate", type=float, default=0.0)
+    p.add_argument("--max-rps", type=float, default=0)
+    p.add_argument("--max-inflight", type=int, default=0)
+    p.add_argument("--retry-after", type=float, default=1.0)
+    p.add_argument("--payload", type=int, default=15_000)
+    p.add_argument("--stitch-max", type=int, default=STITCH_MAX_TILES)
+    p.add_argument("--dir", default=None, help="工作目录（默认临时目录，跑完删除）")
+    p.add_argument("--save", default=None, help="结果写成 JSON")
+    p.add_argument("--baseline", default=None, help="与这份 JSON 结果对比")
+    p.add_argument("--tolerance", type=float, default=TOLERANCE)
+    args = p.parse_args(argv)
+
+    root = args.dir or tempfile.mkdtemp(prefix="bench_")
+    results = []
+    try:
+        with FakeTileServer(args.latency, args.jitter, args.error_rate, args.max_rps, args.max_inflight,
+                            args.retry_after, args.payload) as server:
+            print(f"[INFO] 假瓦片服务器 → {server.url}")
+            before = {}
+            for name in args.scenarios:
+                folder = os.path.join(root, f"{args.provider}_{name}")
+                shutil.rmtree(folder, ignore_errors=True)
+                os.makedirs(folder)
+                # 每个场景一个新进程：峰值内存只算这个场景
+                with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as pool:
+                    result = pool.submit(run_scenario, name, args.provider, server.url, args.workers,
+                                         folder, args.stitch_max).result()
+                after = server.stats()
+                result["server"] = {k: v - before.get(k, 0) for k, v in after.items()}   # 本场景的服务端计数
+                before = after
+                results.append(result)
+                show(result)
+                if not args.dir:
+                    shutil.rmtree(folder, ignore_errors=True)
+    finally:
+        if not args.dir:
+            shutil.rmtree(root, ignore_errors=True)
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"[OK] 结果 → {args.save}")
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print(f"[WARN] {regressions} 项性能回退（容差 {args.tolerance:.0%}）")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
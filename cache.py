@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+瓦片库容量管理：每个来源一个字节上限（按最近访问时间 LRU 淘汰）和 TTL（下载超过这么久就删掉，下次重新下载）
+
+- 策略存在瓦片库的 metadata 表里（cache.budget.<来源> / cache.ttl.<来源>），同一个库的所有下载脚本、
+  批量任务、瓦片服务共用同一份策略；没设策略的来源不淘汰
+- 访问时间：写入、TileStore.get / validators 命中、任务结束（pinned 退出时整段范围）都会刷新
+- 正在进行的任务用 pinned() 登记瓦片范围，范围内的瓦片不淘汰；进程崩溃留下的 pin 到期自动失效
+- 刚写入 / 刚访问不到 PROTECT_SECONDS 的瓦片也不淘汰（例如下载完、还没开始拼接的间隙）
+- 下载结束时各脚本调用 enforce()；也可以手动：
+
+  python cli.py cache --set osm --budget 2G --ttl 7d
+  python cli.py cache --set apple-sat --budget 20G --ttl 180d
+  python cli.py cache --evict
+  python cli.py cache            # 每个来源的占用 / 上限 / 命中率 / 淘汰次数
+"""
+
+import os
+import uuid
+from contextlib import contextmanager
+
+import metrics
+
+PIN_SECONDS = 12 * 3600     # pin 的有效期（任务正常结束时会提前删掉）
+PROTECT_SECONDS = 3600      # 最近这么久内写入 / 访问过的瓦片不淘汰
+EVICT_BATCH = 500           # 每个删除事务的瓦片数
+
+SIZE_UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+TIME_UNITS = {"": 1, "s": 1, "m": 60, "h": 3600, "d": 86400, "w": 7 * 86400}
+
+
+def parse_size(text):
+    """'2G' / '500M' / '1048576' → 字节数"""
+    text = str(text).strip().upper().rstrip("B")
+    unit = text[-1] if text and text[-1] in SIZE_UNITS else ""
+    return int(float(text[:len(text) - len(unit)]) * SIZE_UNITS[unit])
+
+
+def parse_duration(text):
+    """'7d' / '12h' / '3600' → 秒数"""
+    text = str(text).strip().lower()
+    unit = text[-1] if text and text[-1] in TIME_UNITS else ""
+    return float(text[:len(text) - len(unit)]) * TIME_UNITS[unit]
+
+
+# ========================
+# 策略
+# ========================
+def policy(store):
+    """{provider: {"budget": 字节数或 None, "ttl": 秒数或 None}}"""
+    result = {}
+    for name, value in store.metadata().items():
+        if not name.startswith(("cache.budget.", "cache.ttl.")) or value in ("", "None"):
+            continue
+        _, kind, provider = name.split(".", 2)
+        result.setdefault(provider, {"budget": None, "ttl": None})[kind] = float(value)
+    return result
+
+
+def set_policy(store, provider, budget=None, ttl=None):
+    """设置某个来源的上限 / TTL（'2G'、'7d' 或数字；'none' 取消）"""
+    items = {}
+    if budget is not None:
+        items[f"cache.budget.{provider}"] = "" if str(budget).lower() == "none" else parse_size(budget)
+    if ttl is not None:
+        items[f"cache.ttl.{provider}"] = "" if str(ttl).lower() == "none" else parse_duration(ttl)
+    store.set_metadata(**items)
+
+
+# ========================
+# 任务占用
+# ========================
+@contextmanager
+def pinned(store, provider, job, seconds=PIN_SECONDS):
+    """任务期间 job 的瓦片范围不淘汰；结束时范围内的瓦片记一次访问"""
+    pin_id = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+    store.pin(pin_id, provider, job["zoom"], job["min_x"], job["max_x"], job["min_y"], job["max_y"], seconds)
+    try:
+        yield
+    finally:
+        store.unpin(pin_id)
+
+
+# ========================
+# 淘汰
+# ========================
+def evict(store, provider, keys, reason):
+    """删掉 keys，返回实际释放的字节数"""
+    freed = 0
+    for i in range(0, len(keys), EVICT_BATCH):
+        freed += store.delete(provider, keys[i:i + EVICT_BATCH], reason)
+    if keys:
+        metrics.inc("cache_evictions", len(keys), provider=provider, reason=reason)
+    return freed
+
+
+def enforce(store, now=None):
+    """
+    按策略淘汰：先删超过 TTL 的，再按最近访问时间从旧到新删到不超过上限
+    占用按不同内容算（见 TileStore.usage）：内容被该来源多张瓦片共用时，删其中几张不减少占用，
+    所以 LRU 只在走到最后一个引用时才把这些瓦片一起删掉，freed 是实际删掉的内容字节数
+    返回 {provider: {"ttl": 张数, "lru": 张数, "freed": 字节数}}；没有策略时什么也不做
+    """
+    import time
+
+    rules = policy(store)
+    if not rules:
+        return {}
+    now = now or time.time()
+    protect = now - PROTECT_SECONDS
+    result = {}
+
+    for provider, rule in rules.items():
+        done = {"ttl": 0, "lru": 0, "freed": 0}
+        if rule["ttl"]:
+            expired = [(z, x, y) for z, x, y, *_ in
+                       store.evictable(provider, accessed_before=protect, fetched_before=now - rule["ttl"])]
+            done["freed"] += evict(store, provider, expired, "ttl")
+            done["ttl"] = len(expired)
+
+        if rule["budget"]:
+            _, used = store.usage().get(provider, (0, 0))
+            over = used - rule["budget"]
+            victims = []
+            if over > 0:
+                refs = store.shared_refs(provider)
+                waiting = {}   # 共享内容 → 已轮到、但还有别的引用的瓦片
+                for z, x, y, content_hash, size in store.evictable(provider, accessed_before=protect):
+                    keys = waiting.setdefault(content_hash, [])
+                    keys.append((z, x, y))
+                    refs[content_hash] = refs.get(content_hash, 1) - 1
+                    if refs[content_hash] == 0:   # 该来源的最后一个引用：占用才减少
+                        victims += waiting.pop(content_hash)
+                        over -= size
+                        if over <= 0:
+                            break
+            done["freed"] += evict(store, provider, victims, "lru")
+            done["lru"] = len(victims)
+            if over > 0:
+                print(f"[WARN] {provider} 仍超出上限 {metrics.fmt_bytes(over)}：其余瓦片正被任务使用或刚访问过")
+
+        if done["ttl"] or done["lru"]:
+            print(f"[INFO] 缓存淘汰 {provider}：过期 {done['ttl']} 张，LRU {done['lru']} 张，"
+                  f"释放 {metrics.fmt_bytes(done['freed'])}")
+        result[provider] = done
+    return result
+
+
+# ========================
+# 统计
+# ========================
+def stats(store):
+    """每个来源的 {tiles, bytes, budget, ttl, hit, miss, hit_ratio, evicted_lru, evicted_ttl}"""
+    usage = store.usage()
+    counters = store.cache_stats()
+    rules = policy(store)
+    result = {}
+    for provider in sorted(set(usage) | set(counters) | set(rules)):
+        tiles, size = usage.get(provider, (0, 0))
+        c = counters.get(provider, {})
+        lookups = c.get("hit", 0) + c.get("miss", 0)
+        result[provider] = {
+            "tiles": tiles, "bytes": size,
+            "budget": rules.get(provider, {}).get("budget"), "ttl": rules.get(provider, {}).get("ttl"),
+            "hit": c.get("hit", 0), "miss": c.get("miss", 0),
+            "hit_ratio": c.get("hit", 0) / lookups if lookups else None,
+            "evicted_lru": c.get("evicted_lru", 0), "evicted_ttl": c.get("evicted_ttl", 0),
+        }
+    return result
+
+
+def report(store):
+    """打印每个来源一行"""
+    for provider, s in stats(store).items():
+        budget = metrics.fmt_bytes(s["budget"]) if s["budget"] else "不限"
+        ttl = metrics.fmt_time(s["ttl"]) if s["ttl"] else "不过期"
+        ratio = f"{s['hit_ratio']:.1%}" if s["hit_ratio"] is not None else "-"
+        print(f"[INFO] {provider}：{s['tiles']} 张，{metrics.fmt_bytes(s['bytes'])} / {budget}，TTL {ttl}，"
+              f"命中 {s['hit']} / 未命中 {s['miss']}（{ratio}），淘汰 LRU {s['evicted_lru']} / 过期 {s['evicted_ttl']}")
+    pins = store.active_pins()
+    if pins:
+        print(f"[INFO] {pins} 个任务正在占用瓦片范围（不淘汰）")
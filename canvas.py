@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+磁盘画布：用 NumPy memmap 代替内存里的 Image.new
+
+- 像素放在磁盘上的临时 .raw 文件里（H × W × 3，uint8），由操作系统按页换入换出
+- paste() 按像素偏移写入（自动裁掉越界部分）
+- save() 交给 encode.save：PNG / RAW 按行分块读出写出，整幅图从不完整放进内存
+- 上限只取决于磁盘空间（见 check_disk_space）
+- NumPy 在创建画布时才导入：只做估算（plan.py 用 required_bytes）时不加载
+"""
+
+import os
+import shutil
+import tempfile
+
+CHUNK_ROWS = 256   # 填充 / 保存时每次处理的行数
+
+
+def required_bytes(width, height):
+    """画布 .raw 文件 + 输出文件（按未压缩估上限）需要的磁盘字节数"""
+    return width * height * 3 * 2
+
+
+def check_disk_space(width, height, folder):
+    """磁盘空间不够放画布 + 输出时直接报错"""
+    need = required_bytes(width, height)
+    free = shutil.disk_usage(folder or ".").free
+    if need > free:
+        raise OSError(
+            f"磁盘空间不足：{width}x{height} 画布约需 {need/1e9:.2f} GB，"
+            f"{os.path.abspath(folder or '.')} 只剩 {free/1e9:.2f} GB。"
+        )
+    return need
+
+
+class MemmapCanvas:
+    """磁盘上的 RGB 画布，接口与 PIL Image 的 paste / save 保持一致"""
+
+    def __init__(self, width, height, fill=(0, 0, 0), folder=None):
+        import numpy as np
+        self.size = (width, height)
+        fd, self.path = tempfile.mkstemp(suffix=".raw", prefix="canvas_", dir=folder)
+        os.close(fd)
+        self.array = np.memmap(self.path, dtype=np.uint8, mode="w+", shape=(height, width, 3))
+        if tuple(fill) != (0, 0, 0):
+            for y in range(0, height, CHUNK_ROWS):
+                self.array[y:y + CHUNK_ROWS] = fill
+
+    @property
+    def width(self):
+        return self.size[0]
+
+    @property
+    def height(self):
+        return self.size[1]
+
+    def paste(self, img, xy):
+        """把 PIL 图像按左上角像素偏移 xy 写入画布（越界部分裁掉）"""
+        px, py = xy
+        w, h = img.size
+        x0, y0 = max(px, 0), max(py, 0)
+        x1, y1 = min(px + w, self.width), min(py + h, self.height)
+        if x0 >= x1 or y0 >= y1:
+            return
+        import numpy as np
+        pixels = np.asarray(img.convert("RGB"))
+        self.array[y0:y1, x0:x1] = pixels[y0 - py:y1 - py, x0 - px:x1 - px]
+
+    def iter_strips(self, rows=CHUNK_ROWS):
+        """按行分块读出原始 RGB 字节"""
+        for y in range(0, self.height, rows):
+            yield self.array[y:y + rows].tobytes()
+
+    def save(self, path):
+        """按扩展名编码写出（.png 分块并行压缩，另有 .jpg / .webp / .raw，见 encode.py），返回实际输出路径"""
+        import encode
+        return encode.save(self, path)
+
+    def close(self):
+        """释放 memmap 并删掉临时 .raw 文件"""
+        if self.array is not None:
+            self.array = None
+            os.remove(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
@@ -0,0 +1,410 @@
+# -*- coding: utf-8 -*-
+"""
+统一命令行入口：不用再改各脚本 __main__ 里的常量
+
+  python cli.py plan   osm    --center 52.867,-8.756 --zoom 15 --half-range 10 --output output/z15.png
+  python cli.py fetch  osm    --bbox=-8.78,52.86,-8.76,52.96 --zoom 14
+  python cli.py stitch osm    --bbox=-8.78,52.86,-8.76,52.96 --zoom 14 --output output/z14.tif
+  python cli.py fetch  apple  --aoi "LINESTRING(-6.25 53.36, -6.24 53.37)" --buffer 50 --zoom 19 --access-key ...
+  python cli.py export osm    --center 52.867,-8.756 --zoom 15 --half-range 10 --format pyramid --levels 3
+  python cli.py fetch  google --center 53.2754,-9.0438 --size 400,400 --zoom 18 --out-dir out_static
+  （负数开头的值写成 --bbox=-8.78,... 也行；直接写 --bbox -8.78,... 时 main() 会自动接上）
+
+子命令：plan（只估算）/ fetch（下载进瓦片库；--pipeline 时边下载边拼接）/ stitch（拼接）/
+        export（cog：Cloud-Optimized GeoTIFF；pyramid：本地生成低层级；world：PNG / JPEG / WebP / RAW + 世界文件；dxf：再加 DXF）/
+        batch（一份清单里的多个区域 × zoom × 来源，瓦片去重只下一次，见 batch.py）/
+        shard + work + merge（大任务切片，多节点通过共享目录上的租约领取，见 shard.py）/
+        serve（本地瓦片服务，HTML 页面的底图和下载走它，见 server.py）/
+        cache（瓦片库容量：每个来源的上限 / TTL、命中率、淘汰，见 cache.py）
+输出编码（见 encode.py）：--output 的扩展名决定格式（.png / .jpg / .webp / .raw / .tif），
+        --png-level / --quality / --encode-threads 调速度和体积，--preview 只出缩小的 JPEG 预览
+--trace PATH：各阶段时间线写成 Chrome trace JSON，用 chrome://tracing 或 Perfetto 打开（见 tracing.py）
+来源：osm（osm.py）/ apple（jim.py）/ google（go.py，静态图边下边拼，fetch 和 stitch 都是整个流程）
+范围：--bbox / --center + --half-range（瓦片数）/ --center + --size（米）/ --aoi（GeoJSON / WKT，可加 --buffer）
+
+本文件只导入标准库和 sources.py；来源模块和 requests / NumPy / PIL 等在子命令真正用到时才导入，plan 启动只要几十毫秒
+"""
+
+import argparse
+import json
+import os
+import re
+import sys
+
+from sources import DEFAULT_DB, SOURCES, bbox_of, load_source, tile_range
+
+EXPORT_FORMATS = ("cog", "pyramid", "world", "dxf")
+COORD_OPTIONS = ("--bbox", "--center")   # 值可能以负号开头的选项（见 join_negative）
+
+
+def pair(text):
+    """'a,b' → (float(a), float(b))"""
+    a, b = text.split(",")
+    return float(a), float(b)
+
+
+def quad(text):
+    values = [float(v) for v in text.split(",")]
+    if len(values) != 4:
+        raise argparse.ArgumentTypeError("需要 4 个逗号分隔的数")
+    return values
+
+
+# ========================
+# 范围（bbox_of / tile_range 见 sources.py）
+# ========================
+def tile_job(args):
+    return tile_range(args.zoom, args.bbox, args.center, args.half_range, args.size, args.aoi, args.buffer)
+
+
+def static_area(args):
+    """google 静态图的 (中心纬度, 中心经度, 宽米, 高米)"""
+    if args.center and args.size:
+        return (*args.center, *args.size)
+    bbox = bbox_of(args.bbox)
+    if bbox is None:
+        raise SystemExit("[ERROR] google 需要 --center + --size（米）或 --bbox")
+    import mercator
+    x0, y0 = mercator.lonlat_to_mercator(bbox[0], bbox[1])
+    x1, y1 = mercator.lonlat_to_mercator(bbox[2], bbox[3])
+    lon, lat = mercator.mercator_to_lonlat((x0 + x1) / 2, (y0 + y1) / 2)
+    return lat, lon, abs(x1 - x0), abs(y1 - y0)
+
+
+def configure(module, args):
+    """命令行参数覆盖模块配置区的常量"""
+    for attr, value in (("MAX_WORKERS", args.workers), ("RATE_LIMIT", args.rate)):
+        if value is not None:
+            setattr(module, attr, value)
+    if hasattr(module, "REFRESH"):
+        module.REFRESH = args.refresh
+    if module.__name__ == "jim":
+        module.TILE_DB = args.db
+        module.STITCH_PROCESSES = args.processes
+        module.STREAMING_STITCH = args.streaming
+        module.INCREMENTAL_STITCH = args.incremental
+        if args.output:
+            module.OUTPUT_IMAGE = args.output
+        key = args.access_key or os.getenv("APPLE_ACCESS_KEY")
+        if key:
+            module.ACCESS_KEY = key
+    if module.__name__ == "go" and args.maptype:
+        module.MAPTYPE = args.maptype
+    if args.png_level is not None or args.quality or args.encode_threads or args.preview:
+        import encode
+        for attr, value in (("PNG_LEVEL", args.png_level), ("QUALITY", args.quality),
+                            ("THREADS", args.encode_threads)):
+            if value is not None:
+                setattr(encode, attr, value)
+        encode.PREVIEW = args.preview
+
+
+def run_static(go, args, **options):
+    lat, lon, w, h = static_area(args)
+    return go.run_static_mosaic(lat, lon, w, h, args.zoom, out_dir=args.out_dir, overlap_ratio=args.overlap,
+                                maptype=go.MAPTYPE, **options)
+
+
+def need_output(args, suffixes=None):
+    if not args.output:
+        raise SystemExit("[ERROR] 需要 --output")
+    if suffixes and not args.output.lower().endswith(suffixes):
+        raise SystemExit(f"[ERROR] --output 需要以 {' / '.join(suffixes)} 结尾")
+    return args.output
+
+
+def first_tile_size(tile_db, provider, job):
+    import tilestore
+    with tilestore.TileStore(tile_db, readonly=True) as store:
+        first = next(store.tiles_in_range(provider, job["zoom"], job["min_x"], job["max_x"],
+                                          job["min_y"], job["max_y"]), None)
+    return (tilestore.image_size(first[2]) if first else None) or (256, 256)
+
+
+# ========================
+# 子命令
+# ========================
+def cmd_plan(args, src):
+    if args.source == "google":
+        lat, lon, w, h = static_area(args)
+        make_cog = bool(args.output and args.output.lower().endswith((".tif", ".tiff")))
+        result = src.plan_static_mosaic(lat, lon, w, h, args.zoom, out_dir=args.out_dir,
+                                        overlap_ratio=args.overlap, maptype=src.MAPTYPE, make_cog=make_cog)
+    elif args.source == "apple":
+        result = src.plan_area({"provider": src.PROVIDER, **tile_job(args)})
+    else:
+        result = src.plan_download(tile_job(args), args.db, args.output, args.streaming, args.processes,
+                                   args.incremental)
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False))
+    return 0
+
+
+def cmd_fetch(args, src):
+    if args.source == "google":
+        run_static(src, args, make_pgw=True)
+        return 0
+    if args.source == "apple" and not src.ACCESS_KEY:
+        raise SystemExit("[ERROR] 需要 --access-key（或环境变量 APPLE_ACCESS_KEY）")
+    if args.pipeline:
+        import pipeline
+        output = need_output(args, (".png", ".tif", ".tiff"))
+        summary = pipeline.fetch_and_stitch(src, args.db, tile_job(args), output, args.refresh,
+                                            src.ACCESS_KEY if args.source == "apple" else None)
+    elif args.source == "apple":
+        summary = src.download_job({"provider": src.PROVIDER, **tile_job(args)})
+    else:
+        summary = src.download_tiles(tile_job(args), args.db)
+    return 1 if summary.get("failed") else 0
+
+
+def cmd_stitch(args, src):
+    if args.source == "google":
+        run_static(src, args, make_pgw=True)
+        return 0
+    output = need_output(args)
+    job = tile_job(args)
+    if args.source == "apple":
+        src.stitch_tiles({"provider": src.PROVIDER, **job})
+    else:
+        src.stitch_tiles(args.db, output, job["zoom"], job, args.streaming, args.processes, args.incremental)
+    return 0
+
+
+def cmd_export(args, src):
+    fmt = args.format
+    if args.source == "google":
+        if fmt == "pyramid":
+            raise SystemExit("[ERROR] google 静态图没有瓦片金字塔")
+        run_static(src, args, make_pgw=True, make_cog=fmt == "cog", make_dxf=fmt == "dxf")
+        return 0
+
+    job = tile_job(args)
+    provider = src.PROVIDER
+    if fmt == "pyramid":
+        import pyramid
+        pyramid.build_pyramid(args.db, provider, job["zoom"], args.levels, job, overwrite=args.overwrite)
+        return 0
+
+    output = need_output(args, (".tif", ".tiff") if fmt == "cog" else (".png", ".jpg", ".jpeg", ".webp", ".raw"))
+    cmd_stitch(args, src)
+    if fmt in ("world", "dxf"):
+        import encode
+        import geotiff
+        import mercator
+        tile_w, tile_h = first_tile_size(args.db, provider, job)
+        resolution = mercator.tile_resolution(job["zoom"], tile_w)
+        if encode.PREVIEW:
+            output = encode.output_path(output)
+            resolution *= encode.preview_factor((job["max_x"] - job["min_x"] + 1) * tile_w,
+                                                (job["max_y"] - job["min_y"] + 1) * tile_h)
+        wld_path = geotiff.write_world_file(output, mercator.tile_top_left(job["min_x"], job["min_y"], job["zoom"]),
+                                            resolution)
+        if fmt == "dxf":
+            import go
+            go.export_dxf_with_image(output, wld_path, os.path.splitext(output)[0] + ".dxf")
+    return 0
+
+
+def cmd_batch(args):
+    import batch
+    if args.plan:
+        batch.plan_batch(args.manifest, args.refresh)
+        return 0
+    summaries = batch.run_batch(args.manifest, args.refresh, args.stitch)
+    return 1 if any(s["failed"] for s in summaries.values()) else 0
+
+
+def cmd_shard(args):
+    import shard
+    if args.source == "google":
+        raise SystemExit("[ERROR] google 静态图不是 XYZ 瓦片，不能建分片任务（用 fetch google）")
+    shard.init_job(args.dir, args.source, tile_job(args), args.shard_tiles, args.curve)
+    return 0
+
+
+def cmd_work(args):
+    import shard
+    if args.status:
+        shard.status(args.dir)
+        return 0
+    if args.local > 1:
+        return max(shard.work_local(args.dir, args.local, args.rate, args.workers, lease_seconds=args.lease))
+    shard.work(args.dir, lease_seconds=args.lease, rate=args.rate, max_workers=args.workers)
+    return 0
+
+
+def cmd_merge(args):
+    import shard
+    shard.merge(args.dir, args.db)
+    return 0
+
+
+def cmd_serve(args):
+    import server
+    key = args.access_key or os.getenv("APPLE_ACCESS_KEY")
+    if args.output_dir:
+        server.OUTPUT_DIR = args.output_dir
+    server.serve(args.db, args.host, args.port, key)
+    return 0
+
+
+def cmd_cache(args):
+    import cache
+    import tilestore
+    with tilestore.TileStore(args.db) as store:
+        if args.set:
+            # 来源写 osm / apple 或瓦片库里的来源名（apple-sat）
+            provider = load_source(args.set).PROVIDER if args.set in SOURCES else args.set
+            cache.set_policy(store, provider, args.budget, args.ttl)
+        if args.evict:
+            cache.enforce(store)
+        cache.report(store)
+    return 0
+
+
+COMMANDS = {"plan": cmd_plan, "fetch": cmd_fetch, "stitch": cmd_stitch, "export": cmd_export}
+# 不对应单个来源
+JOB_COMMANDS = {"batch": cmd_batch, "shard": cmd_shard, "work": cmd_work, "merge": cmd_merge, "serve": cmd_serve,
+                "cache": cmd_cache}
+
+
+# ========================
+# 参数
+# ========================
+def build_parser():
+    p = argparse.ArgumentParser(prog="imagetool", description="地图瓦片 / 静态图下载、拼接、导出")
+    sub = p.add_subparsers(dest="command", required=True)
+
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("source", choices=list(SOURCES), help="osm / apple / google")
+    area = common.add_argument_group("范围")
+    area.add_argument("--zoom", type=int, required=True)
+    area.add_argument("--bbox", type=quad, help="min_lon,min_lat,max_lon,max_lat（西经为负，可写 --bbox=-8.78,...）")
+    area.add_argument("--center", type=pair, help="lat,lon（南纬为负，可写 --center=-33.9,18.4）")
+    area.add_argument("--half-range", type=int, help="中心点四周的瓦片数（osm 脚本的 half_range）")
+    area.add_argument("--size", type=pair, help="宽,高（米），配合 --center")
+    area.add_argument("--aoi", help="GeoJSON / WKT 字符串或文件路径")
+    area.add_argument("--buffer", type=float, default=0, help="折线走廊的缓冲距离（米）")
+    opts = common.add_argument_group("选项")
+    opts.add_argument("--db", default=DEFAULT_DB, help="MBTiles 瓦片库")
+    opts.add_argument("--output", help="输出图像（.png / .tif）")
+    opts.add_argument("--processes", type=int, default=1, help=">1：多进程并行拼接")
+    opts.add_argument("--no-streaming", dest="streaming", action="store_false", help="整幅放内存拼接")
+    opts.add_argument("--incremental", action="store_true",
+                      help="增量拼接：只重写内容变了的瓦片，没有变化时直接跳过（见 patch.py）")
+    opts.add_argument("--workers", type=int, help="并发下载线程数（覆盖脚本配置）")
+    opts.add_argument("--rate", type=float, help="每个 host 每秒最多请求数（覆盖脚本配置）")
+    opts.add_argument("--access-key", help="apple：accessKey（也可用环境变量 APPLE_ACCESS_KEY）")
+    opts.add_argument("--refresh", action="store_true", help="osm / apple：库中已有的瓦片也发条件请求刷新（默认直接跳过）")
+    opts.add_argument("--out-dir", default="out_static", help="google：子图和拼接图目录")
+    opts.add_argument("--overlap", type=float, default=0.10, help="google：相邻子图重叠比例")
+    opts.add_argument("--maptype", help="google：satellite / hybrid / roadmap / terrain")
+    opts.add_argument("--metrics-port", type=int, default=0, help=">0：运行期间提供 Prometheus /metrics")
+    opts.add_argument("--metrics-json", help="运行结束把指标汇总写成 JSON")
+    opts.add_argument("--png-level", type=int, choices=range(10), metavar="0-9",
+                      help="PNG 压缩级别（默认 6；1 快几倍，文件稍大）")
+    opts.add_argument("--quality", type=int, help="JPEG / WebP 输出质量（默认 90）")
+    opts.add_argument("--encode-threads", type=int, help="PNG 并行压缩线程数（默认 CPU 核数）")
+    opts.add_argument("--preview", action="store_true",
+                      help="只输出长边不超过 4096 的 JPEG 预览（<输出名>.preview.jpg），比完整编码快得多")
+    opts.add_argument("--trace", metavar="PATH",
+                      help="把请求 / 等待 / 解码 / 编码等各阶段写成 Chrome trace JSON（见 tracing.py）")
+
+    sp = sub.add_parser("plan", parents=[common], help="只估算：请求数 / 流量 / 时间 / 拼接内存")
+    sp.add_argument("--json", action="store_true", help="估算结果以一行 JSON 输出")
+    sp = sub.add_parser("fetch", parents=[common], help="下载（osm / apple 写进瓦片库）")
+    sp.add_argument("--pipeline", action="store_true",
+                    help="osm / apple：下载、解码、拼接流水线同时进行，直接输出 --output（见 pipeline.py）")
+    sub.add_parser("stitch", parents=[common], help="拼接成大图（.png / .tif）")
+    sp = sub.add_parser("export", parents=[common], help="导出 COG / 金字塔 / 世界文件 / DXF")
+    sp.add_argument("--format", choices=EXPORT_FORMATS, required=True)
+    sp.add_argument("--levels", type=int, default=1, help="pyramid：向下生成几级")
+    sp.add_argument("--overwrite", action="store_true", help="pyramid：库里已有的低层级瓦片也重新生成")
+
+    sp = sub.add_parser("batch", help="批量清单（AOI × zoom × 来源）：瓦片去重后只下载一次，再逐个拼接")
+    sp.add_argument("manifest", help="JSON 清单（格式见 batch.py）")
+    sp.add_argument("--plan", action="store_true", help="只估算去重后的请求数 / 流量 / 时间")
+    sp.add_argument("--refresh", action="store_true", help="库中已有的瓦片也发条件请求刷新")
+    sp.add_argument("--no-stitch", dest="stitch", action="store_false", help="只下载不拼接")
+    sp.add_argument("--metrics-port", type=int, default=0)
+    sp.add_argument("--metrics-json")
+    sp.add_argument("--trace", metavar="PATH")
+
+    sp = sub.add_parser("shard", parents=[common], help="在共享目录里建分片任务（Hilbert / Z-order 切片），供多节点 work 领取")
+    sp.add_argument("--dir", required=True, help="任务目录（共享文件系统上）")
+    sp.add_argument("--shard-tiles", type=int, default=256, help="每个分片的瓦片数")
+    sp.add_argument("--curve", choices=("hilbert", "z"), default="hilbert")
+    sp = sub.add_parser("work", help="领取分片下载，直到任务全部完成（每个节点跑一个）")
+    sp.add_argument("dir", help="shard 建的任务目录")
+    sp.add_argument("--local", type=int, default=1, help=">1：本机起多个 worker 进程（限速按进程数平分）")
+    sp.add_argument("--status", action="store_true", help="只看分片进度")
+    sp.add_argument("--lease", type=float, default=60, help="租约有效期（秒）")
+    sp.add_argument("--workers", type=int, help="每个 worker 的并发下载线程数")
+    sp.add_argument("--rate", type=float, help="每个 worker 每个 host 每秒最多请求数")
+    sp.add_argument("--metrics-port", type=int, default=0)
+    sp.add_argument("--metrics-json")
+    sp.add_argument("--trace", metavar="PATH", help="本进程的时间线（--local > 1 时不记录）")
+    sp = sub.add_parser("merge", help="所有分片完成后并进主瓦片库")
+    sp.add_argument("dir")
+    sp.add_argument("--db", default=DEFAULT_DB)
+
+    sp = sub.add_parser("serve", help="本地 XYZ 瓦片服务（瓦片库 + 缺失时下载），给 overview.html / ampa.html 用")
+    sp.add_argument("--db", default=DEFAULT_DB)
+    sp.add_argument("--host", default="127.0.0.1", help="0.0.0.0：局域网内其他机器也能访问")
+    sp.add_argument("--port", type=int, default=8765)
+    sp.add_argument("--output-dir", help="/mosaic 结果目录（默认 output/server）")
+    sp.add_argument("--access-key", help="apple：accessKey（页面也可以每次请求带上）")
+
+    sp = sub.add_parser("cache", help="瓦片库容量：查看占用 / 命中率，设置每个来源的上限和 TTL，手动淘汰")
+    sp.add_argument("--db", default=DEFAULT_DB)
+    sp.add_argument("--set", metavar="SOURCE", help="要设置策略的来源（osm / apple）")
+    sp.add_argument("--budget", help="字节上限，如 2G / 500M（none：不限）")
+    sp.add_argument("--ttl", help="下载后多久过期，如 7d / 12h（none：不过期）")
+    sp.add_argument("--evict", action="store_true", help="立即按策略淘汰")
+    return p
+
+
+def join_negative(argv, options=COORD_OPTIONS):
+    """'--bbox -8.78,52.86,...' → '--bbox=-8.78,52.86,...'：argparse 会把负数开头的值当成选项"""
+    result = []
+    for arg in argv:
+        if result and result[-1] in options and re.match(r"-\d|-\.\d", arg):
+            result[-1] = f"{result[-1]}={arg}"
+        else:
+            result.append(arg)
+    return result
+
+
+def main(argv=None):
+    args = build_parser().parse_args(join_negative(sys.argv[1:] if argv is None else argv))
+    if args.command in JOB_COMMANDS:
+        run = lambda: JOB_COMMANDS[args.command](args)
+    else:
+        src = load_source(args.source)
+        configure(src, args)
+        run = lambda: COMMANDS[args.command](args, src)
+
+    # 只估算 / 查状态 / 建分片任务时不起指标端点、不打印汇总；work --local 由各 worker 进程自己汇总
+    if args.command in ("plan", "shard", "merge", "serve", "cache") or getattr(args, "plan", False) \
+            or getattr(args, "status", False) or getattr(args, "local", 1) > 1:
+        return run()
+
+    import metrics
+    import tracing
+    if args.metrics_port:
+        metrics.serve(args.metrics_port)
+    if args.trace:
+        tracing.start()
+    try:
+        with tracing.span(f"cli {args.command}", "cli"):
+            code = run()
+    finally:
+        if args.trace:
+            tracing.save(args.trace)
+    metrics.report(args.metrics_json)
+    return code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
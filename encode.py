@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+"""
+输出编码：拼好的大图（PIL Image / 磁盘画布 / (H, W, 3) 数组）→ 文件，格式按扩展名决定
+
+- .png：按行切成互相独立的块，多线程并行 zlib 压缩（zlib 压缩时释放 GIL），按顺序拼成一个 zlib 流：
+  每块单独 raw deflate，非最后一块用 Z_SYNC_FLUSH 结尾（字节对齐、不带结束标志），
+  Adler-32 各块分别计算再合并（adler32_combine）；输出是普通的单 IDAT 流 PNG，任何解码器都能读
+  压缩级别 PNG_LEVEL 可调：1 比默认 6 快几倍，文件大一些
+- .jpg / .jpeg / .webp：Pillow 整幅编码（质量 QUALITY），比 PNG 快得多也小得多，但有损；
+  需要把整幅图放进内存（约 宽 × 高 × 4 字节），边长上限 JPEG 65500 / WebP 16383
+- .raw：不压缩的 RGB 字节（逐像素交错），同时写 ENVI 头（.hdr），GDAL / QGIS 能直接打开；
+  配合 export --format world 的世界文件带地理参考。写出速度只受磁盘限制
+- 快速预览（PREVIEW）：不写原图，按整数倍盒式缩小到长边不超过 PREVIEW_SIZE，输出 <原名>.preview.jpg
+- 每次编码打印 MP/s，并记进 metrics（encode_seconds / encode_pixels{format=...}）
+
+各脚本的拼接结果都经过 save()；流式拼接（stitch.stitch_streaming）逐行写 PNG 时用 png_writer()。
+命令行：--png-level / --quality / --encode-threads / --preview（见 cli.py）
+
+  python cli.py stitch osm --bbox ... --zoom 17 --output output/z17.png --png-level 1
+  python cli.py stitch osm --bbox ... --zoom 17 --output output/z17.jpg --quality 85
+  python cli.py export osm --bbox ... --zoom 17 --output output/z17.raw --format world
+  python cli.py stitch osm --bbox ... --zoom 17 --output output/z17.png --preview
+"""
+
+import os
+import struct
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+import stitch
+import tracing
+
+PNG_LEVEL = 6                         # PNG 的 zlib 压缩级别（0-9）
+QUALITY = 90                          # JPEG / WebP 质量
+WEBP_METHOD = 2                       # WebP 压缩速度 / 体积折中（0 最快，6 最小；Pillow 默认 4）
+THREADS = os.cpu_count() or 1         # PNG 并行压缩线程数（1 即单线程）
+CHUNK_BYTES = 4 << 20                 # 每个并行压缩块的原始字节数上限
+PREVIEW = False                       # True：只输出缩小的 JPEG 预览
+PREVIEW_SIZE = 4096                   # 预览图长边上限（像素）
+PREVIEW_QUALITY = 80
+
+FORMATS = (".png", ".jpg", ".jpeg", ".webp", ".raw")
+MAX_SIDE = {"jpeg": 65500, "webp": 16383}
+ADLER_BASE = 65521
+
+
+def format_of(path):
+    ext = os.path.splitext(path)[1].lower()
+    if ext not in FORMATS:
+        raise ValueError(f"不支持的输出格式 {ext}：只支持 {' / '.join(FORMATS)}（GeoTIFF 见 geotiff.py）")
+    return {".jpg": "jpeg", ".jpeg": "jpeg"}.get(ext, ext[1:])
+
+
+def output_path(path):
+    """实际写出的文件：预览模式下是 <原名>.preview.jpg"""
+    return os.path.splitext(path)[0] + ".preview.jpg" if PREVIEW else path
+
+
+def preview_factor(width, height):
+    """预览相对原图的缩小倍数"""
+    return max(1, -(-max(width, height) // PREVIEW_SIZE))
+
+
+def streamable(path):
+    """能否逐行写出（流式拼接只支持 PNG，预览和其他格式要先拼进画布）"""
+    return path.lower().endswith(".png") and not PREVIEW
+
+
+# ========================
+# 并行 PNG
+# ========================
+def adler32_combine(adler1, adler2, len2):
+    """前后两段数据的 Adler-32 → 整段的 Adler-32（zlib 的 adler32_combine，Python 的 zlib 没有导出）"""
+    rem = len2 % ADLER_BASE
+    sum1 = adler1 & 0xFFFF
+    sum2 = rem * sum1 % ADLER_BASE
+    sum1 += (adler2 & 0xFFFF) + ADLER_BASE - 1
+    sum2 += (adler1 >> 16) + (adler2 >> 16) + ADLER_BASE - rem
+    return (sum2 % ADLER_BASE) << 16 | sum1 % ADLER_BASE
+
+
+def deflate_rows(data, stride, level, last):
+    """一块整行 → (raw deflate 数据, Adler-32, 扫描线字节数)；在压缩线程里执行"""
+    raw = stitch.filter_rows(data, stride)
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    out = compressor.compress(raw) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+    return out, zlib.adler32(raw), len(raw)
+
+
+class ParallelPNGWriter(stitch.PNGStripWriter):
+    """接口同 PNGStripWriter；write_rows 只提交压缩任务，在途的块不超过 threads × 2 个"""
+
+    def __init__(self, path, width, height, compress_level=PNG_LEVEL, threads=THREADS):
+        super().__init__(path, width, height, compress_level)
+        self.level = compress_level
+        self.pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="png-deflate")
+        self.limit = threads * 2
+        self.inflight = deque()
+        self.adler = 1
+        # zlib 头：CMF = 0x78（deflate，32K 窗口），FLG 按压缩级别取值，保证 (CMF << 8 | FLG) % 31 == 0
+        flevel = 0 if compress_level < 2 else 1 if compress_level < 6 else 2 if compress_level == 6 else 3
+        flg = flevel << 6
+        flg += 31 - ((0x78 << 8 | flg) % 31)
+        self._emit(bytes((0x78, flg)))
+
+    def write_rows(self, data):
+        n_rows, rest = divmod(len(data), self.stride)
+        if rest:
+            raise ValueError("条带数据不是整行")
+        if self.rows_written + n_rows > self.height:
+            raise ValueError("写入行数超过图像高度")
+
+        step = max(1, CHUNK_BYTES // self.stride) * self.stride
+        for start in range(0, len(data), step):
+            piece = data[start:start + step]
+            self.rows_written += len(piece) // self.stride
+            last = self.rows_written == self.height
+            self.inflight.append(self.pool.submit(deflate_rows, piece, self.stride, self.level, last))
+            while len(self.inflight) > self.limit:
+                self._drain()
+
+    def _drain(self):
+        out, adler, size = self.inflight.popleft().result()
+        self.adler = adler32_combine(self.adler, adler, size)
+        self._emit(out)
+
+    def close(self):
+        if self.f is None:
+            return
+        try:
+            if self.rows_written != self.height:
+                raise ValueError(f"只写了 {self.rows_written}/{self.height} 行")
+            while self.inflight:
+                self._drain()
+            self._emit(struct.pack(">I", self.adler), force=True)
+            self._chunk(b"IEND", b"")
+        finally:
+            self.pool.shutdown(cancel_futures=True)
+            self.f.close()
+            self.f = None
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.pool.shutdown(cancel_futures=True)
+        super().__exit__(exc_type, exc, tb)
+
+
+def png_writer(path, width, height):
+    """按当前配置（PNG_LEVEL / THREADS）选 PNG 写入器"""
+    if THREADS > 1:
+        return ParallelPNGWriter(path, width, height, PNG_LEVEL, THREADS)
+    return stitch.PNGStripWriter(path, width, height, PNG_LEVEL)
+
+
+# ========================
+# 输入
+# ========================
+def _reader(source):
+    """(宽, 高, read(y0, y1) → 这些行的原始 RGB 字节)；PIL Image 每次只裁出这几行"""
+    array = getattr(source, "array", source)   # MemmapCanvas → 它的 memmap
+    if hasattr(array, "shape"):
+        if hasattr(array, "flush"):
+            array.flush()
+        height, width = array.shape[:2]
+        return width, height, lambda y0, y1: array[y0:y1].reshape(-1)
+    source = source if source.mode == "RGB" else source.convert("RGB")
+    width, height = source.size
+    return width, height, lambda y0, y1: source.crop((0, y0, width, y1)).tobytes()
+
+
+def _image(source, width, height, read):
+    """整幅 PIL Image（JPEG / WebP 用）"""
+    from PIL import Image
+    if hasattr(source, "mode"):
+        return source if source.mode == "RGB" else source.convert("RGB")
+    return Image.frombuffer("RGB", (width, height), read(0, height), "raw", "RGB", 0, 1)
+
+
+def _rows_per_chunk(width):
+    return max(1, CHUNK_BYTES // (width * 3))
+
+
+# ========================
+# 各格式
+# ========================
+def _save_png(path, width, height, read):
+    rows = _rows_per_chunk(width)
+    with png_writer(path, width, height) as writer:
+        for y in range(0, height, rows):
+            writer.write_rows(read(y, min(y + rows, height)))
+
+
+def _save_pillow(path, fmt, source, width, height, read, quality):
+    if max(width, height) > MAX_SIDE[fmt]:
+        raise ValueError(f"{fmt.upper()} 边长上限 {MAX_SIDE[fmt]} 像素，{width} x {height} 太大："
+                         f"改用 .png / .raw / .tif，或 --preview")
+    img = _image(source, width, height, read)
+    if fmt == "jpeg":
+        img.save(path, "JPEG", quality=quality, subsampling=2)
+    else:
+        img.save(path, "WEBP", quality=quality, method=WEBP_METHOD)
+
+
+def _save_raw(path, width, height, read):
+    rows = _rows_per_chunk(width)
+    with open(path, "wb") as f:
+        for y in range(0, height, rows):
+            f.write(read(y, min(y + rows, height)))
+    # ENVI 头：GDAL 按它识别宽高、波段数和交错方式
+    with open(os.path.splitext(path)[0] + ".hdr", "w", encoding="utf-8") as f:
+        f.write(f"ENVI\nsamples = {width}\nlines = {height}\nbands = 3\nheader offset = 0\n"
+                f"file type = ENVI Standard\ndata type = 1\ninterleave = bip\nbyte order = 0\n")
+
+
+def _save_preview(path, source, width, height, read):
+    from PIL import Image
+    factor = preview_factor(width, height)
+    if hasattr(source, "mode"):
+        small = source.reduce(factor) if factor > 1 else source
+    else:
+        # 按条带缩小（条带行数是 factor 的整数倍），不把整幅图读进内存
+        small = Image.new("RGB", (-(-width // factor), -(-height // factor)))
+        rows = factor * max(1, _rows_per_chunk(width) // factor)
+        for y in range(0, height, rows):
+            y1 = min(y + rows, height)
+            strip = Image.frombuffer("RGB", (width, y1 - y), read(y, y1), "raw", "RGB", 0, 1)
+            small.paste(strip.reduce(factor) if factor > 1 else strip, (0, y // factor))
+    small.convert("RGB").save(path, "JPEG", quality=PREVIEW_QUALITY)
+    return factor
+
+
+# ========================
+# 入口
+# ========================
+def save(source, path, quality=None):
+    """
+    source：PIL Image、canvas.MemmapCanvas 或 (H, W, 3) uint8 数组（可以是 memmap）
+    按扩展名编码写出，返回实际写出的路径（预览模式下是 <原名>.preview.jpg）
+    """
+    fmt = format_of(path)
+    width, height, read = _reader(source)
+    path = output_path(path)
+    folder = os.path.dirname(path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+
+    label = "preview" if PREVIEW else fmt
+    t0 = time.perf_counter()
+    with metrics.timer("encode_seconds", format=label), tracing.span(f"{label}.save", "encode", path=path):
+        if PREVIEW:
+            factor = _save_preview(path, source, width, height, read)
+        elif fmt == "png":
+            _save_png(path, width, height, read)
+        elif fmt == "raw":
+            _save_raw(path, width, height, read)
+        else:
+            _save_pillow(path, fmt, source, width, height, read, quality or QUALITY)
+    elapsed = max(time.perf_counter() - t0, 1e-9)
+    metrics.inc("encode_pixels", width * height, format=label)
+
+    detail = {"png": f"level {PNG_LEVEL}，{THREADS} 线程", "raw": "不压缩",
+              "jpeg": f"质量 {quality or QUALITY}", "webp": f"质量 {quality or QUALITY}"}[fmt]
+    if PREVIEW:
+        detail = f"缩小 1/{factor}"
+    print(f"[OK] {label.upper()} 编码 → {path}（{width} x {height}，{detail}，"
+          f"{width * height / 1e6 / elapsed:.1f} MP/s）")
+    return path
@@ -0,0 +1,462 @@
+# -*- coding: utf-8 -*-
+"""
+共享瓦片下载引擎（osm.py / osma.py / jim.py / go.py 共用）
+
+- 有界线程池并发下载：同时在途的任务数有上限，内存占用不随任务总数增长
+- 按 host 的令牌桶限速（单位：请求/秒），取代每张瓦片之后固定 sleep
+- 按 host 复用 requests.Session（keep-alive 连接池），省掉每张瓦片的 TCP/TLS 握手
+- 条件请求：记录 ETag / Last-Modified，刷新时发 If-None-Match / If-Modified-Since，
+  304 时本地文件保持不变
+- 按 host 的 AIMD 自适应并发：响应正常时逐步放宽同时在途的请求数，
+  遇到 429 / 5xx 减半，并遵守 Retry-After（整个 host 暂停）
+- fetch()：单张瓦片带抖动的指数退避重试
+- 每次请求的耗时 / 状态码 / 字节数 / 重试 / 条件请求命中都记进 metrics
+"""
+
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+import tracing
+
+# ========================
+# 默认参数（各脚本可以覆盖）
+# ========================
+MAX_WORKERS = 4       # 并发下载线程数
+RATE_LIMIT = 4.0      # 每个 host 每秒最多请求数；<= 0 表示不限速
+BURST = 1             # 令牌桶容量（允许的瞬时突发请求数）
+POOL_SIZE = 16        # 每个 host 保持的 keep-alive 连接数上限
+
+RETRIES = 4           # fetch() 每张瓦片最多尝试次数
+BACKOFF_BASE = 0.5    # 指数退避：第 n 次重试前最多等 BACKOFF_BASE * 2^(n-1) 秒（随机抖动）
+BACKOFF_MAX = 30.0    # 单次退避上限（秒）
+RETRY_STATUS = {429, 500, 502, 503, 504}   # 值得重试的状态码
+THROTTLE_STATUS = {429, 503}               # 表示“太快了”的状态码（并发减半）
+
+
+# ========================
+# 令牌桶
+# ========================
+class TokenBucket:
+    """平均速率 rate 次/秒，最多攒 burst 个令牌"""
+
+    def __init__(self, rate, burst=BURST):
+        self.rate = float(rate)
+        self.capacity = float(max(1, burst))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """取一个令牌，不够时阻塞等待"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_s = (1 - self.tokens) / self.rate
+            time.sleep(wait_s)
+
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+def host_of(url):
+    return urlsplit(url).netloc
+
+
+def bucket_for(url, rate=RATE_LIMIT, burst=BURST):
+    """同一个 host 共用一个令牌桶（所有线程、所有任务共享）"""
+    host = host_of(url)
+    with _buckets_lock:
+        bucket = _buckets.get(host)
+        if bucket is None:
+            bucket = _buckets[host] = TokenBucket(rate, burst)
+        elif bucket.rate != rate:
+            bucket.rate = float(rate)
+        return bucket
+
+
+# ========================
+# AIMD 自适应并发
+# ========================
+class AIMDController:
+    """
+    一个 host 同时在途的请求数上限（窗口）：
+    - 慢启动：窗口从 1 开始，每个正常响应 +1，直到第一次被限流
+    - 之后每个正常响应 +1/窗口（约每轮 +1），被限流（429 / 503）时减半
+    - 同一轮里发出的请求一起被限流只减一次（只看减半之后才发出的请求）
+    - 只有窗口被用满时才增长，线程数本身就是真正的上限
+    - Retry-After：整个 host 暂停到指定时间
+    """
+
+    def __init__(self, host="", ceiling=POOL_SIZE):
+        self.host = host
+        self.ceiling = ceiling
+        self.limit = 1.0
+        self.threshold = float(ceiling)   # 慢启动阈值
+        self.inflight = 0
+        self.last_cut = 0.0
+        self.paused_until = 0.0
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        """等到窗口有空位且不在暂停期，返回请求开始时间"""
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    self.cond.wait(self.paused_until - now)
+                elif self.inflight >= int(self.limit):
+                    self.cond.wait()
+                else:
+                    self.inflight += 1
+                    return now
+
+    def release(self, started, throttled=False, retry_after=None):
+        with self.cond:
+            full = self.inflight >= int(self.limit)
+            self.inflight -= 1
+            now = time.monotonic()
+            if throttled:
+                if started >= self.last_cut:
+                    old = self.limit
+                    self.limit = max(1.0, self.limit / 2)
+                    self.threshold = self.limit
+                    self.last_cut = now
+                    print(f"[WARN] {self.host} 限流，并发 {int(old)} → {int(self.limit)}"
+                          + (f"，暂停 {retry_after:.1f}s" if retry_after else ""))
+                    tracing.instant("throttled", "http", host=self.host, limit=int(self.limit),
+                                    retry_after=retry_after)
+                if retry_after:
+                    self.paused_until = max(self.paused_until, now + retry_after)
+            elif full:
+                step = 1.0 if self.limit < self.threshold else 1.0 / self.limit
+                self.limit = min(float(self.ceiling), self.limit + step)
+            self.cond.notify_all()
+
+
+_controllers = {}
+_controllers_lock = threading.Lock()
+
+
+def controller_for(url):
+    """同一个 host 共用一个 AIMD 控制器"""
+    host = host_of(url)
+    with _controllers_lock:
+        ctl = _controllers.get(host)
+        if ctl is None:
+            ctl = _controllers[host] = AIMDController(host)
+        return ctl
+
+
+def retry_after_of(response):
+    """Retry-After 响应头 → 秒数（支持秒数和 HTTP 日期两种写法），没有时返回 None"""
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff(attempt):
+    """第 attempt 次失败后的等待秒数：指数增长 + 随机抖动（避免所有线程同时重试）"""
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (attempt - 1)))
+
+
+# ========================
+# 连接池（每个 host 一个 Session）
+# ========================
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def session_for(url):
+    """同一个 host 复用一个 Session，连接保持 keep-alive"""
+    host = host_of(url)
+    with _sessions_lock:
+        session = _sessions.get(host)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _sessions[host] = session
+        return session
+
+
+# ========================
+# 条件请求（ETag / Last-Modified）
+# ========================
+def validators_of(response):
+    """从响应头取出 ETag / Last-Modified"""
+    validators = {}
+    if response.headers.get("ETag"):
+        validators["etag"] = response.headers["ETag"]
+    if response.headers.get("Last-Modified"):
+        validators["last_modified"] = response.headers["Last-Modified"]
+    return validators
+
+
+def conditional_headers(validators):
+    """ETag / Last-Modified → If-None-Match / If-Modified-Since"""
+    headers = {}
+    if validators:
+        if validators.get("etag"):
+            headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            headers["If-Modified-Since"] = validators["last_modified"]
+    return headers
+
+
+class ValidatorIndex:
+    """瓦片目录下每个文件的 ETag / Last-Modified（存成一个 JSON 文件）"""
+
+    FILENAME = ".validators.json"
+
+    def __init__(self, folder):
+        self.path = os.path.join(folder, self.FILENAME)
+        self.lock = threading.Lock()
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def get(self, file_path):
+        """本地文件还在时才返回记录（文件被删了就要重新完整下载）"""
+        if not os.path.exists(file_path):
+            return None
+        with self.lock:
+            return self.entries.get(os.path.basename(file_path))
+
+    def set(self, file_path, validators):
+        with self.lock:
+            if validators:
+                self.entries[os.path.basename(file_path)] = validators
+            else:
+                self.entries.pop(os.path.basename(file_path), None)
+
+    def save(self):
+        with self.lock:
+            tmp = self.path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(self.entries, f)
+            os.replace(tmp, self.path)
+
+
+# ========================
+# 请求 + 线程池
+# ========================
+def get(url, rate=RATE_LIMIT, validators=None, **kwargs):
+    """
+    按 host 的并发窗口和令牌桶限速后，用该 host 的 Session 发起 GET，其余参数原样传给 Session.get。
+    validators 不为空时附带条件请求头，服务端可能返回 304。
+    """
+    ctl = controller_for(url)
+    with tracing.span("wait_concurrency", "http", host=ctl.host):
+        started = ctl.acquire()
+    try:
+        if rate and rate > 0:
+            with tracing.span("wait_rate_limit", "http", host=ctl.host):
+                bucket_for(url, rate).acquire()
+        if validators:
+            kwargs["headers"] = {**(kwargs.get("headers") or {}), **conditional_headers(validators)}
+        t0 = time.perf_counter()
+        with tracing.span("GET", "http", url=url) as info:
+            r = session_for(url).get(url, **kwargs)
+            size = len(r.content)
+            if info is not None:
+                # elapsed：发出请求到解析完响应头（新连接含 DNS / TCP / TLS），其余是下载响应体
+                info.update(status=r.status_code, bytes=size, ttfb_ms=round(r.elapsed.total_seconds() * 1000, 1))
+    except Exception:
+        ctl.release(started)
+        metrics.inc("http_requests", host=ctl.host, status="error")
+        raise
+    ctl.release(started, r.status_code in THROTTLE_STATUS, retry_after_of(r))
+
+    metrics.observe("http_latency_seconds", time.perf_counter() - t0, host=ctl.host)
+    metrics.inc("http_requests", host=ctl.host, status=r.status_code)
+    metrics.inc("http_bytes", size, host=ctl.host)
+    if r.status_code == 304:
+        metrics.inc("cache", result="hit")
+    elif r.status_code == 200:
+        metrics.inc("cache", result="miss")
+    return r
+
+
+def fetch(url, rate=RATE_LIMIT, validators=None, retries=RETRIES, **kwargs):
+    """
+    get() + 重试：网络异常和 429 / 5xx 按带抖动的指数退避重试，有 Retry-After 时至少等那么久。
+    返回最后一次的响应（调用方自己看状态码）；每次都是网络异常时抛出最后一个异常。
+    """
+    for attempt in range(1, retries + 1):
+        try:
+            r = get(url, rate=rate, validators=validators, **kwargs)
+        except requests.RequestException as e:
+            if attempt == retries:
+                raise
+            metrics.inc("http_retries", host=host_of(url), reason="error")
+            with tracing.span("retry_sleep", "http", url=url, attempt=attempt, reason=type(e).__name__):
+                time.sleep(backoff(attempt))
+            continue
+        if r.status_code not in RETRY_STATUS or attempt == retries:
+            return r
+        metrics.inc("http_retries", host=host_of(url), reason=r.status_code)
+        with tracing.span("retry_sleep", "http", url=url, attempt=attempt, reason=r.status_code):
+            time.sleep(max(backoff(attempt), retry_after_of(r) or 0))
+
+
+def run(tasks, worker, max_workers=MAX_WORKERS):
+    """
+    有界线程池：对每个 task（元组）调用 worker(*task)，按完成顺序 yield (task, result)。
+    tasks 可以是生成器；同时提交的任务不超过 max_workers * 2 个。
+    worker 抛出的异常会打印出来，对应 result 记为 None。
+    """
+    tasks = iter(tasks)
+    max_workers = max(1, int(max_workers))
+    limit = max_workers * 2
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        pending = {}
+
+        def fill():
+            while len(pending) < limit:
+                task = next(tasks, None)
+                if task is None:
+                    return
+                pending[pool.submit(worker, *task)] = task
+
+        fill()
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                task = pending.pop(fut)
+                try:
+                    result = fut.result()
+                except Exception as e:
+                    print(f"[ERROR] {task} -> {e}")
+                    result = None
+                yield task, result
+            fill()
+
+
+# ========================
+# 瓦片任务：下载进瓦片库 + 任务日志（osm.py / osma.py / jim.py 共用）
+# ========================
+def fetch_tile(url, rate=RATE_LIMIT, validators=None, retries=RETRIES, label=None, **kwargs):
+    """
+    下载单张瓦片（各来源 download_tile 的公共部分）；label：日志里代替 url 显示（url 里带密钥时用）
+    返回 (状态码, 内容, 附加信息)：200 / 304 → 附加信息为响应的 validators（304 时内容为 None）；
+    失败 → 内容为 None，附加信息为失败原因
+    """
+    import tilestore
+
+    label = label or url
+    try:
+        r = fetch(url, rate=rate, validators=validators, retries=retries, **kwargs)
+    except Exception as e:
+        print(f"[ERROR] 下载失败：{label} -> {e}")
+        return None, None, str(e)
+
+    if r.status_code == 304:
+        return 304, None, validators_of(r)
+    if r.status_code != 200:
+        print(f"[WARN] HTTP {r.status_code}：{label}")
+        return r.status_code, None, f"HTTP {r.status_code}"
+    if not tilestore.detect_format(r.content):
+        print(f"[WARN] 返回内容不是图片：{label}")
+        return 200, None, "返回内容不是图片"
+    return 200, r.content, validators_of(r)
+
+
+def fetch_tiles(store, job_log, tiles, provider, download, workers=MAX_WORKERS, total=None, refresh=False):
+    """
+    下载 tiles 中的 (z, x, y)，成功写库，结果逐条记进任务日志
+    download(x, y, z, validators) → (状态码, 内容, 附加信息)
+    refresh：库中已有的瓦片发条件请求（304 不动）；False（默认）时直接跳过、记为成功
+    """
+    import journal
+
+    progress = metrics.Progress(total)
+
+    def tasks():
+        for z, x, y in tiles:
+            validators = store.validators(provider, z, x, y)
+            if validators is not None and not refresh:
+                metrics.inc("cache", result="hit")
+                job_log.record(z, x, y, journal.OK)
+                progress.update()
+                continue
+            yield x, y, z, validators
+
+    # 并发下载，按 host 令牌桶限速；结果由主线程批量写库
+    for (x, y, z, _), result in run(tasks(), download, workers):
+        status, content, info = result or (None, None, "下载线程异常")
+        if status == 200 and content is not None:
+            store.put(provider, z, x, y, content, **info)
+        elif status == 304:
+            store.touch(provider, z, x, y, info or {})   # 仍然有效：刷新下载时间，TTL 不会误删
+        else:
+            print(f"[WARN] 跳过缺失瓦片：z={z} x={x} y={y}")
+            job_log.record(z, x, y, journal.FAILED, info)
+            progress.update(ok=False)
+            continue
+        job_log.record(z, x, y, journal.OK)
+        progress.update()
+    progress.close()
+
+
+def download_job(tile_db, job, fetch_batch, fmt, journal_path=None):
+    """
+    下载 job（带 provider 的瓦片范围 / AOI 任务），写入 MBTiles 瓦片库
+    fetch_batch(store, job_log, tiles, total)：下载一批瓦片（各来源的 fetch_tiles）
+    * 每张瓦片的结果记进任务日志；中断后重跑同一任务（或 resume）从断点继续
+    * 最后对失败的瓦片再补一遍；全部成功时删除日志
+    返回 (各状态张数, 日志路径)
+    """
+    import aoi
+    import cache
+    import journal
+    import tilestore
+
+    if journal_path is None:
+        journal_path = journal.journal_path_for(tile_db, job)
+    tile_range = {k: v for k, v in job.items() if k != "provider"}
+
+    with tilestore.TileStore(tile_db) as store:
+        store.set_metadata(name="imagetool", format=fmt)
+        job_log = journal.JobJournal(journal_path, job, before_sync=store.flush)
+        with cache.pinned(store, job["provider"], tile_range):   # 下载期间这些瓦片不会被淘汰
+            # 第一遍：日志里还没有结果的瓦片；矩形范围或 AOI（多边形 / 走廊）覆盖的稀疏瓦片集合
+            total = aoi.tile_count(tile_range) - sum(job_log.summary().values())
+            fetch_batch(store, job_log, job_log.pending(aoi.job_tiles(tile_range)), total)
+
+            # 补洞：只重试失败的瓦片
+            failed = job_log.failed()
+            if failed:
+                print(f"[INFO] 补洞：重试 {len(failed)} 张失败瓦片")
+                fetch_batch(store, job_log, failed, len(failed))
+
+            summary = job_log.finish()
+        cache.enforce(store)
+    return summary, journal_path
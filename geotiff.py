@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+"""
+Cloud-Optimized GeoTIFF 输出（内部分块 + 压缩 + 内部金字塔 + EPSG:3857 地理参考）
+
+- 内部按 TILE_SIZE × TILE_SIZE 分块，DEFLATE（带水平差分预测）或 JPEG（YCbCr 4:2:0）压缩
+- 每级 2× 缩小的内部金字塔，直到整幅图不超过一个块
+- GeoTIFF 标签：ModelPixelScale + ModelTiepoint + GeoKeyDirectory（ProjectedCSType = 3857）
+- COG 布局：所有 IFD 在文件开头，块数据从最小的金字塔层到原图依次排列，
+  QGIS / GDAL 只需读取需要的窗口和分辨率
+- 源数据可以是 memmap（canvas.MemmapCanvas.array），金字塔层同样放在磁盘临时文件里；
+  数据超过 4GB 时自动写 BigTIFF
+"""
+
+import os
+import shutil
+import struct
+import tempfile
+import zlib
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+import metrics
+import tracing
+from canvas import MemmapCanvas
+from pyramid import downsample_box
+
+TILE_SIZE = 256
+COMPRESSION = "deflate"     # 'deflate' | 'jpeg'
+JPEG_QUALITY = 85
+DEFLATE_LEVEL = 6
+CHUNK_ROWS = 512            # 生成金字塔层时每次处理的行数
+
+# TIFF 数据类型 → struct 格式
+SHORT, LONG, DOUBLE, LONG8 = 3, 4, 12, 16
+TYPE_FMT = {SHORT: "H", LONG: "I", DOUBLE: "d", LONG8: "Q"}
+
+# GeoKeyDirectory：版本 1.1.0，3 个键
+#   GTModelTypeGeoKey(1024) = 1 投影坐标系
+#   GTRasterTypeGeoKey(1025) = 1 PixelIsArea
+#   ProjectedCSTypeGeoKey(3072) = 3857 Web Mercator
+GEO_KEYS = [1, 1, 0, 3,
+            1024, 0, 1, 1,
+            1025, 0, 1, 1,
+            3072, 0, 1, 3857]
+
+
+# ========================
+# 金字塔层
+# ========================
+def downsample_level(src, folder):
+    """(H, W, 3) → (ceil(H/2), ceil(W/2), 3)，结果写进临时 memmap；奇数边复制最后一行/列"""
+    h, w = src.shape[:2]
+    fd, path = tempfile.mkstemp(suffix=".raw", prefix="overview_", dir=folder)
+    os.close(fd)
+    dst = np.memmap(path, dtype=np.uint8, mode="w+", shape=((h + 1) // 2, (w + 1) // 2, 3))
+    for r0 in range(0, h, CHUNK_ROWS):
+        block = np.asarray(src[r0:r0 + CHUNK_ROWS])
+        if block.shape[0] % 2:
+            block = np.concatenate([block, block[-1:]], axis=0)
+        if block.shape[1] % 2:
+            block = np.concatenate([block, block[:, -1:]], axis=1)
+        dst[r0 // 2:r0 // 2 + block.shape[0] // 2] = downsample_box(block)
+    dst.flush()
+    return dst, path
+
+
+# ========================
+# 块编码
+# ========================
+def encode_tile(tile, compression, quality):
+    if compression == "jpeg":
+        buf = BytesIO()
+        Image.fromarray(tile).save(buf, "JPEG", quality=quality, subsampling=2)
+        return buf.getvalue()
+    # Predictor = 2：每个样本减去左边像素的同一通道（uint8 回绕）
+    diff = tile.copy()
+    diff[:, 1:] -= tile[:, :-1]
+    return zlib.compress(diff.tobytes(), DEFLATE_LEVEL)
+
+
+def pad_block(tile, tile_size):
+    """右 / 下边缘不满一块的部分补零"""
+    if tile.shape[:2] != (tile_size, tile_size):
+        padded = np.zeros((tile_size, tile_size, 3), dtype=np.uint8)
+        padded[:tile.shape[0], :tile.shape[1]] = tile
+        tile = padded
+    return np.ascontiguousarray(tile)
+
+
+def spool_block(spool, data, offsets, counts):
+    """块数据追加到 spool（按 2 字节对齐），记下相对偏移和长度"""
+    offsets.append(spool.tell())
+    counts.append(len(data))
+    spool.write(data)
+    if spool.tell() % 2:
+        spool.write(b"\0")
+
+
+def write_level_tiles(array, tile_size, compression, quality, spool):
+    """把一层按块压缩写进 spool，返回 (相对偏移列表, 字节数列表)"""
+    h, w = array.shape[:2]
+    offsets, counts = [], []
+    for ty in range(0, h, tile_size):
+        band = np.asarray(array[ty:ty + tile_size])
+        for tx in range(0, w, tile_size):
+            tile = pad_block(band[:, tx:tx + tile_size], tile_size)
+            spool_block(spool, encode_tile(tile, compression, quality), offsets, counts)
+    return offsets, counts
+
+
+# ========================
+# IFD
+# ========================
+def level_tags(width, height, tile_size, compression, offsets, counts, bigtiff, geo=None):
+    offset_type = LONG8 if bigtiff else LONG
+    tags = [
+        (254, LONG, [0 if geo else 1]),          # NewSubfileType：1 = 缩小版（金字塔层）
+        (256, LONG, [width]),
+        (257, LONG, [height]),
+        (258, SHORT, [8, 8, 8]),
+        (259, SHORT, [7 if compression == "jpeg" else 8]),
+        (262, SHORT, [6 if compression == "jpeg" else 2]),   # YCbCr / RGB
+        (277, SHORT, [3]),
+        (284, SHORT, [1]),
+        (322, LONG, [tile_size]),
+        (323, LONG, [tile_size]),
+        (324, offset_type, offsets),
+        (325, offset_type, counts),
+        (339, SHORT, [1, 1, 1]),
+    ]
+    if compression == "jpeg":
+        tags.append((530, SHORT, [2, 2]))       # YCbCrSubSampling 4:2:0
+    else:
+        tags.append((317, SHORT, [2]))          # Predictor：水平差分
+    if geo:
+        (mx, my), res = geo
+        tags += [
+            (33550, DOUBLE, [res, res, 0.0]),                 # ModelPixelScale
+            (33922, DOUBLE, [0.0, 0.0, 0.0, mx, my, 0.0]),    # ModelTiepoint：像素 (0,0) 左上角
+            (34735, SHORT, GEO_KEYS),                         # GeoKeyDirectory
+        ]
+    return sorted(tags)
+
+
+def pack_ifds(ifds, bigtiff, start):
+    """把多个 IFD 依次打包（每个 IFD 后面紧跟它放不下的标签值），返回字节串"""
+    count_fmt, entry_fmt, offset_fmt, inline = (
+        ("<Q", "<HHQ", "<Q", 8) if bigtiff else ("<H", "<HHI", "<I", 4)
+    )
+    out = bytearray()
+    pos = start
+    for i, tags in enumerate(ifds):
+        ifd_size = struct.calcsize(count_fmt) + len(tags) * (struct.calcsize(entry_fmt) + inline) \
+            + struct.calcsize(offset_fmt)
+        extra = bytearray()
+        body = bytearray(struct.pack(count_fmt, len(tags)))
+        for tag, typ, values in tags:
+            data = struct.pack("<" + TYPE_FMT[typ] * len(values), *values)
+            if len(data) <= inline:
+                field = data.ljust(inline, b"\0")
+            else:
+                field = struct.pack(offset_fmt, pos + ifd_size + len(extra))
+                extra += data
+                if len(extra) % 2:
+                    extra += b"\0"
+            body += struct.pack(entry_fmt, tag, typ, len(values)) + field
+        next_ifd = pos + ifd_size + len(extra) if i < len(ifds) - 1 else 0
+        body += struct.pack(offset_fmt, next_ifd)
+        out += body + extra
+        pos += len(body) + len(extra)
+    return bytes(out)
+
+
+# ========================
+# 写 COG
+# ========================
+def write_cog(path, array, top_left, resolution, compression=COMPRESSION,
+              quality=JPEG_QUALITY, tile_size=TILE_SIZE):
+    """
+    array：(H, W, 3) uint8，可以是 memmap
+    top_left：左上角 Web Mercator 坐标 (mx, my)（米）
+    resolution：米/像素
+    """
+    if compression not in ("deflate", "jpeg"):
+        raise ValueError("compression 只能是 'deflate' 或 'jpeg'")
+
+    folder = os.path.dirname(os.path.abspath(path))
+    os.makedirs(folder, exist_ok=True)
+
+    # 原图 + 各级金字塔（金字塔层放在临时 memmap 里）
+    levels = [array]
+    temp_paths = []
+    fd, spool_path = tempfile.mkstemp(suffix=".spool", prefix="cog_", dir=folder)
+    os.close(fd)
+    temp_paths.append(spool_path)
+    try:
+        with tracing.span("cog.overviews", "encode"):
+            while max(levels[-1].shape[:2]) > tile_size:
+                level, level_path = downsample_level(levels[-1], folder)
+                levels.append(level)
+                temp_paths.append(level_path)
+
+        # 块数据：从最小的金字塔层到原图
+        tiles = {}
+        with open(spool_path, "wb") as spool:
+            for i in range(len(levels) - 1, -1, -1):
+                with tracing.span("cog.encode", "encode", level=i, compression=compression):
+                    tiles[i] = write_level_tiles(levels[i], tile_size, compression, quality, spool)
+
+        with tracing.span("cog.write", "encode", path=path):
+            assemble(path, [level.shape[:2] for level in levels], tiles, spool_path, top_left, resolution,
+                     compression, tile_size)
+    finally:
+        del levels[1:]
+        for p in temp_paths:
+            if os.path.exists(p):
+                os.remove(p)
+
+    print(f"[OK] COG 输出 → {path}（{len(tiles) - 1} 级金字塔，{compression}）")
+    return path
+
+
+def assemble(path, shapes, tiles, spool_path, top_left, resolution, compression=COMPRESSION,
+             tile_size=TILE_SIZE):
+    """
+    IFD + spool 里的块数据 → COG 文件，返回块数据在文件里的起始偏移
+    shapes：各层 (H, W)（原图在前）；tiles：{层号: (相对偏移列表, 字节数列表)}
+    """
+    data_size = os.path.getsize(spool_path)
+
+    def build(bigtiff, data_start):
+        ifds = []
+        for i, (h, w) in enumerate(shapes):
+            offsets, counts = tiles[i]
+            offsets = [data_start + o for o in offsets]
+            geo = (top_left, resolution) if i == 0 else None
+            ifds.append(level_tags(w, h, tile_size, compression, offsets, counts, bigtiff, geo))
+        header_size = 16 if bigtiff else 8
+        return pack_ifds(ifds, bigtiff, header_size)
+
+    # IFD 长度与偏移量的值无关：先用 0 算长度，再填真实偏移
+    bigtiff = False
+    head_len = 8 + len(build(False, 0))
+    if head_len + data_size >= 2 ** 32:
+        bigtiff = True
+        head_len = 16 + len(build(True, 0))
+
+    with open(path, "wb") as f:
+        if bigtiff:
+            f.write(b"II+\0" + struct.pack("<HHQ", 8, 0, 16))
+        else:
+            f.write(b"II*\0" + struct.pack("<I", 8))
+        f.write(build(bigtiff, head_len))
+        with open(spool_path, "rb") as spool:
+            shutil.copyfileobj(spool, f, 1 << 20)
+    return head_len
+
+
+def write_world_file(image_path, top_left, resolution):
+    """
+    世界文件（.png → .pgw，.jpg → .jgw，其他 → .wld）：A D B E C F 六行
+    A / E：像素宽 / 高方向的地面分辨率（米/像素，E 为负）；C / F：左上像素中心的 Web Mercator 坐标
+    """
+    stem, ext = os.path.splitext(image_path)
+    ext = ext.lower()
+    suffix = {".png": ".pgw", ".jpg": ".jgw", ".jpeg": ".jgw", ".tif": ".tfw", ".tiff": ".tfw"}.get(ext, ".wld")
+    mx, my = top_left
+    a, e = resolution, -resolution
+    wld_path = stem + suffix
+    with open(wld_path, "w", encoding="utf-8") as f:
+        f.write(f"{a:.12f}\n{0.0:.12f}\n{0.0:.12f}\n{e:.12f}\n{mx + a * 0.5:.12f}\n{my + e * 0.5:.12f}\n")
+    print(f"[OK] 世界文件生成 → {wld_path}")
+    return wld_path
+
+
+def stitch_to_cog(xs, ys, get_row, output_image, tile_size, top_left, resolution, **kwargs):
+    """
+    按行把瓦片贴进磁盘画布，再写成 COG（参数同 stitch.stitch_streaming）
+    top_left / resolution：xs[0], ys[0] 瓦片左上角的 Web Mercator 坐标和米/像素
+    """
+    xs = list(xs)
+    ys = list(ys)
+    col_of = {x: i for i, x in enumerate(xs)}
+    tile_w, tile_h = tile_size
+    width, height = len(xs) * tile_w, len(ys) * tile_h
+
+    print(f"[INFO] 拼接 GeoTIFF：{width} x {height}")
+    folder = os.path.dirname(os.path.abspath(output_image))
+    os.makedirs(folder, exist_ok=True)
+
+    with MemmapCanvas(width, height, folder=folder) as mosaic:
+        for yi, y in enumerate(ys):
+            for x, src in get_row(y).items():
+                if x not in col_of:
+                    continue
+                if isinstance(src, Image.Image):
+                    with metrics.timer("paste_seconds"):
+                        mosaic.paste(src, (col_of[x] * tile_w, yi * tile_h))
+                    continue
+                try:
+                    with Image.open(src) as img, metrics.timer("paste_seconds"):
+                        mosaic.paste(img, (col_of[x] * tile_w, yi * tile_h))
+                except Exception as e:
+                    print(f"[WARN] 打开失败 {src}: {e}")
+        write_cog(output_image, mosaic.array, top_left, resolution, **kwargs)
+
+    return output_image
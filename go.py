@@ -1,23 +1,18 @@
 import os
 import math
-import time
-import requests
-from io import BytesIO
-from PIL import Image
 
-from dotenv import load_dotenv
+import canvas
+import metrics
+import plan
+import tilestore
+# Web Mercator 换算（原来写在本文件里，GeoTIFF 输出也要用，移到 mercator.py 共用）
+from mercator import lonlat_to_mercator, mercator_to_lonlat, meters_per_pixel
+# requests / NumPy / PIL 等重模块在用到的函数里才导入：只做估算（plan）时启动很快，import 时不做任何事
 
-# 加载 .env 文件中的变量
-load_dotenv()
-
-GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
-
-if not GOOGLE_API_KEY:
-    raise RuntimeError("未找到 GOOGLE_API_KEY，请在 .env 文件中设置。")
-
-
-# 配置区 GOOGLE_API_KEY = 
+# 配置区
+GOOGLE_API_KEY = None  # 为空时第一次请求前从环境变量 / .env 文件读取（见 google_api_key）
 MAPTYPE = "satellite"  # 'satellite' | 'hybrid' | 'roadmap' | 'terrain'
+GOOGLE_STATIC_URL = "https://maps.googleapis.com/maps/api/staticmap"
 
 # 单张静态图的逻辑尺寸（scale=1 时的像素）
 SIZE_X, SIZE_Y = 640, 640       # Google Static Maps 常用最大 640
@@ -25,67 +20,96 @@ SCALE = 2                       # 渲染像素放大倍数（返回图像尺寸
 
 # 下载节流/重试
 REQUEST_TIMEOUT = 20
-RETRIES = 3
-SLEEP_BETWEEN = 0.2  # s
+RETRIES = 4          # 每张图最多尝试次数（429 / 5xx / 网络异常，指数退避 + 抖动，遵守 Retry-After）
+RATE_LIMIT = 5       # 每秒最多请求数（按 host 令牌桶限速）
+MAX_WORKERS = 4      # 并发下载线程数
+METRICS_PORT = 0     # >0：运行期间在 http://127.0.0.1:端口/metrics 提供 Prometheus 指标
+
+# 拼图画布：'memmap'（NumPy memmap 磁盘画布，只受磁盘空间限制）| 'memory'（Image.new，整幅放内存）
+CANVAS_BACKEND = "memmap"
 
 # 合成图最大像素保护（避免内存爆炸）——注意这里是“渲染像素”（已乘以 SCALE）
+# 仅 CANVAS_BACKEND = 'memory' 时生效；memmap 画布改为检查磁盘剩余空间
 MAX_TOTAL_PIXELS = 100_000_000  # 100MP
 
-# =========================
-# Web Mercator 常量
-# =========================
-EARTH_RADIUS = 6378137.0
-INITIAL_RES = 156543.03392804097  # m/px at zoom=0 (Web Mercator, scale=1)
-
-def lonlat_to_mercator(lon: float, lat: float):
-    x = math.radians(lon) * EARTH_RADIUS
-    # clamp lat for mercator
-    lat = max(-85.05112878, min(85.05112878, lat))
-    y = EARTH_RADIUS * math.log(math.tan(math.pi/4 + math.radians(lat)/2))
-    return x, y
-
-def mercator_to_lonlat(x: float, y: float):
-    lon = math.degrees(x / EARTH_RADIUS)
-    lat = math.degrees(2 * math.atan(math.exp(y / EARTH_RADIUS)) - math.pi/2)
-    return lon, lat
-
-def meters_per_pixel(zoom: int) -> float:
-    """Meters per logical pixel at given zoom (i.e., scale=1)."""
-    return INITIAL_RES / (2 ** zoom)
+def google_api_key():
+    """GOOGLE_API_KEY：配置区 → 环境变量 → .env 文件；只在真正要发请求时读取，缺失时报错"""
+    global GOOGLE_API_KEY
+    if not GOOGLE_API_KEY:
+        GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
+    if not GOOGLE_API_KEY:
+        from dotenv import load_dotenv
+        load_dotenv()   # 加载 .env 文件中的变量
+        GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
+    if not GOOGLE_API_KEY:
+        raise RuntimeError("未找到 GOOGLE_API_KEY，请在 .env 文件中设置。")
+    return GOOGLE_API_KEY
 
 def build_static_url(lat: float, lon: float, zoom: int,
                      size_x=SIZE_X, size_y=SIZE_Y, scale=SCALE, maptype=MAPTYPE):
     #  必须使用 '&'，不要使用 HTML 转义的 '&amp;'
     return (
-        "https://maps.googleapis.com/maps/api/staticmap"
-        f"?center={lat:.8f},{lon:.8f}&zoom={zoom}"
+        f"{GOOGLE_STATIC_URL}?center={lat:.8f},{lon:.8f}&zoom={zoom}"
         f"&size={size_x}x{size_y}&scale={scale}"
-        f"&maptype={maptype}&key={GOOGLE_API_KEY}"
+        f"&maptype={maptype}&key={google_api_key()}"
     )
 
-def download_static(lat, lon, zoom, out_path):
-    """下载一张静态图（带重试与节流）"""
-    url = build_static_url(lat, lon, zoom)
-    for attempt in range(1, RETRIES + 1):
-        try:
-            r = requests.get(url, timeout=REQUEST_TIMEOUT)
-            if r.status_code == 200:
-                img = Image.open(BytesIO(r.content)).convert("RGB")
-                img.save(out_path)
-                return True
-            else:
-                print(f"[WARN] HTTP {r.status_code} url={url}")
-        except Exception as e:
-            print(f"[ERROR] attempt {attempt}: {e}")
-        if attempt < RETRIES:
-            time.sleep(0.6 * attempt)
-    return False
+def find_cached_static(out_stem):
+    """已下载的子图文件（扩展名由返回内容决定，事先不知道）"""
+    for ext in ("png", "jpg", "gif", "webp"):
+        path = f"{out_stem}.{ext}"
+        if os.path.exists(path):
+            return path
+    return None
+
+def download_static(lat, lon, zoom, out_stem, index=None):
+    """
+    下载一张静态图（带重试与节流），返回图片原始字节；失败返回 None
+    * 原样保存服务端返回的字节，不解码也不重新压缩；扩展名按文件头魔数决定（out_stem + .jpg/.png）
+    * 有 index 时做条件请求，304 直接读回本地文件
+    """
+    import engine
 
-def plan_grid_center_range(center_lon, center_lat, width_m, height_m, zoom, overlap_ratio=0.10):
+    url = build_static_url(lat, lon, zoom)
+    cached = find_cached_static(out_stem)
+    validators = index.get(cached) if index and cached else None
+    try:
+        # 限流 / 5xx / 网络异常由 engine.fetch 退避重试，并发由 AIMD 自动调整
+        r = engine.fetch(url, rate=RATE_LIMIT, validators=validators, retries=RETRIES,
+                         timeout=REQUEST_TIMEOUT)
+    except Exception as e:
+        print(f"[ERROR] {e}")
+        return None
+
+    if r.status_code == 304 and cached:
+        with open(cached, "rb") as f:
+            return f.read()
+    if r.status_code != 200:
+        print(f"[WARN] HTTP {r.status_code} url={url}")
+        return None
+    fmt = tilestore.detect_format(r.content)
+    if fmt is None:
+        print(f"[WARN] 返回内容不是图片 url={url}")
+        return None
+    out_path = f"{out_stem}.{fmt}"
+    with open(out_path, "wb") as f:
+        f.write(r.content)
+    if cached and cached != out_path:
+        os.remove(cached)
+        if index:
+            index.set(cached, None)
+    if index:
+        index.set(out_path, engine.validators_of(r))
+    return r.content
+
+def plan_grid_center_range(center_lon, center_lat, width_m, height_m, zoom, overlap_ratio=0.10,
+                           canvas_backend=CANVAS_BACKEND, canvas_dir=".", check=True):
     """
     方案（Option B）：
       * 所有几何/距离计算均在 “1x 逻辑像素空间” 完成（SIZE_X / SIZE_Y / meters_per_pixel）。
       * 仅在渲染时把像素乘以 SCALE。
+      * 画布保护：'memory' 画布受 MAX_TOTAL_PIXELS 限制；'memmap' 画布检查 canvas_dir 的磁盘空间。
+      * check=False 时不做画布保护（只估算时用）。
     返回：
       grid_cols, grid_rows,
       step_px_world_x, step_px_world_y,        # 逻辑像素步长
@@ -142,10 +166,12 @@ def plan_grid_center_range(center_lon, center_lat, width_m, height_m, zoom, over
 
     # 组合像素总量保护（以渲染像素计）
     total_pixels = mosaic_px_render_w * mosaic_px_render_h
-    if total_pixels > MAX_TOTAL_PIXELS:
+    if check and canvas_backend == "memmap":
+        canvas.check_disk_space(mosaic_px_render_w, mosaic_px_render_h, canvas_dir)
+    elif check and total_pixels > MAX_TOTAL_PIXELS:
         raise MemoryError(
             f"拼接图过大：{mosaic_px_render_w}x{mosaic_px_render_h} ≈ {total_pixels/1e6:.1f} MP，"
-            f"超过上限 {MAX_TOTAL_PIXELS/1e6:.0f} MP。请降低范围或 zoom。"
+            f"超过上限 {MAX_TOTAL_PIXELS/1e6:.0f} MP。请降低范围或 zoom，或使用 CANVAS_BACKEND='memmap'。"
         )
 
     # 用 Web Mercator 计算整个拼图的左上角（米）——注意用“逻辑像素 * res_1x”
@@ -166,15 +192,74 @@ def plan_grid_center_range(center_lon, center_lat, width_m, height_m, zoom, over
         world_px_w, world_px_h
     )
 
+def plan_static_mosaic(center_lat, center_lon, width_m, height_m, zoom,
+                       out_dir="output_static", overlap_ratio=0.10, maptype=MAPTYPE,
+                       save_name_prefix=None, canvas_backend=CANVAS_BACKEND, make_cog=False):
+    """只估算不下载：请求数、已下载子图数、流量、时间、拼接内存 / 磁盘（参数同 run_static_mosaic）"""
+    if save_name_prefix is None:
+        save_name_prefix = f"static_{maptype}_z{zoom}"
+
+    (
+        grid_cols, grid_rows,
+        _, _, _, _,
+        eff_px_render_w, eff_px_render_h,
+        mosaic_px_render_w, mosaic_px_render_h,
+        _, _, _, _, _
+    ) = plan_grid_center_range(
+        center_lon=center_lon, center_lat=center_lat,
+        width_m=width_m, height_m=height_m, zoom=zoom,
+        overlap_ratio=overlap_ratio, canvas_backend=canvas_backend, check=False
+    )
+
+    total = grid_cols * grid_rows
+    cached = [p for p in (find_cached_static(os.path.join(out_dir, f"{save_name_prefix}_{j:02d}_{i:02d}"))
+                          for j in range(grid_rows) for i in range(grid_cols)) if p]
+    # 平均子图大小：out_dir 里已下载子图的实测值，没有时用默认值
+    if cached:
+        mean = sum(os.path.getsize(p) for p in cached) / len(cached)
+    else:
+        mean = plan.DEFAULT_TILE_BYTES["google-static"]
+    transfer = (total - len(cached)) * mean + len(cached) * plan.REVALIDATE_BYTES
+    seconds = plan.wall_time(total, RATE_LIMIT, MAX_WORKERS)
+
+    print(f"[PLAN] z={zoom}: {grid_cols} x {grid_rows} = {total} 张静态图，已下载 {len(cached)}，"
+          f"请求 {total}（已下载的发条件请求）")
+    print(f"[PLAN] 平均子图 {plan.fmt_bytes(mean)}（{'实测' if cached else '默认值'}），下载约 {plan.fmt_bytes(transfer)}，"
+          f"预计 {plan.fmt_time(seconds)}（{RATE_LIMIT}/s 限速，{MAX_WORKERS} 线程）")
+
+    ram, disk = plan.stitch_cost(mosaic_px_render_w, mosaic_px_render_h,
+                                 (eff_px_render_w, eff_px_render_h), canvas_backend)
+    if make_cog:
+        disk += plan.stitch_cost(mosaic_px_render_w, mosaic_px_render_h,
+                                 (eff_px_render_w, eff_px_render_h), "cog")[1]
+    print(f"[PLAN] 拼接 {mosaic_px_render_w} x {mosaic_px_render_h}（{canvas_backend}），"
+          f"峰值内存约 {plan.fmt_bytes(ram)}，临时磁盘约 {plan.fmt_bytes(disk)}")
+    if canvas_backend == "memory" and mosaic_px_render_w * mosaic_px_render_h > MAX_TOTAL_PIXELS:
+        print(f"[WARN] 超过 MAX_TOTAL_PIXELS（{MAX_TOTAL_PIXELS/1e6:.0f} MP），请使用 CANVAS_BACKEND='memmap'")
+
+    return {"provider": "google-static", "requests": total, "cached": len(cached), "bytes": transfer,
+            "seconds": seconds, "width": mosaic_px_render_w, "height": mosaic_px_render_h,
+            "backend": canvas_backend, "ram": ram, "disk": disk}
+
 def run_static_mosaic(center_lat, center_lon, width_m, height_m, zoom,
                       out_dir="output_static",
                       overlap_ratio=0.10, maptype=MAPTYPE,
-                      save_name_prefix=None, make_pgw=True, make_dxf=False):
+                      save_name_prefix=None, make_pgw=True, make_dxf=False,
+                      canvas_backend=CANVAS_BACKEND, make_cog=False):
     """
-    主流程：下载 + 拼接 + 世界文件 (+ 可选 DXF)
+    主流程：下载 + 拼接 + 世界文件 (+ 可选 DXF / Cloud-Optimized GeoTIFF)
     * 所有几何/坐标用 1x 逻辑像素 + res_1x（米/逻辑像素）
     * 画布与粘贴偏移用渲染像素（乘以 SCALE）
+    * canvas_backend='memmap' 时画布在 out_dir 下的临时 .raw 文件里，保存后删除
     """
+    import encode
+    import engine
+    import geotiff
+    import numpy as np
+    import pipeline
+    from PIL import Image
+
+    google_api_key()   # 没有 key 时在建画布之前就报错
     os.makedirs(out_dir, exist_ok=True)
     if save_name_prefix is None:
         save_name_prefix = f"static_{maptype}_z{zoom}"
@@ -191,7 +276,8 @@ def run_static_mosaic(center_lat, center_lon, width_m, height_m, zoom,
     ) = plan_grid_center_range(
         center_lon=center_lon, center_lat=center_lat,
         width_m=width_m, height_m=height_m, zoom=zoom,
-        overlap_ratio=overlap_ratio
+        overlap_ratio=overlap_ratio,
+        canvas_backend=canvas_backend, canvas_dir=out_dir
     )
 
     print(f"[PLAN] cols x rows = {grid_cols} x {grid_rows}")
@@ -199,63 +285,71 @@ def run_static_mosaic(center_lat, center_lon, width_m, height_m, zoom,
     print(f"[PLAN] step_render_px = {step_px_render_x} x {step_px_render_y}, per_img_render_px = {eff_px_render_w} x {eff_px_render_h}")
     print(f"[PLAN] mosaic_render_px = {mosaic_px_render_w} x {mosaic_px_render_h}, res_1x={res_1x:.6f} m/px, scale={SCALE}")
 
-    mosaic = Image.new("RGB", (mosaic_px_render_w, mosaic_px_render_h), (255, 255, 255))
+    if canvas_backend == "memmap":
+        mosaic = canvas.MemmapCanvas(mosaic_px_render_w, mosaic_px_render_h, (255, 255, 255), folder=out_dir)
+    else:
+        mosaic = Image.new("RGB", (mosaic_px_render_w, mosaic_px_render_h), (255, 255, 255))
 
     # 为每一格计算中心点（Web Mercator），再转回经纬度请求 Static
-    for j in range(grid_rows):
-        for i in range(grid_cols):
-            # 本块中心（米）——全部基于“逻辑像素 * res_1x”
-            cx_m = top_left_mx + (world_px_w / 2 + i * step_px_world_x) * res_1x
-            cy_m = top_left_my - (world_px_h / 2 + j * step_px_world_y) * res_1x
-
-            lon, lat = mercator_to_lonlat(cx_m, cy_m)
-
-            tile_name = f"{save_name_prefix}_{j:02d}_{i:02d}.png"
-            tile_path = os.path.join(out_dir, tile_name)
-
-            ok = download_static(lat=lat, lon=lon, zoom=zoom, out_path=tile_path)
-            if not ok:
-                print(f"[WARN] 下载失败，留空：({i},{j})")
-                continue
-
-            try:
-                im = Image.open(tile_path).convert("RGB")
-            except Exception as e:
-                print(f"[WARN] 打开失败 {tile_path}: {e}")
-                continue
-
-            # 粘贴位置（渲染像素）
-            px = i * step_px_render_x
-            py = j * step_px_render_y
-
-            # 保险：如果返回尺寸不是期望的（例如 API 变动），可居中/调整
-            # 这里简单直接粘贴
+    def tasks():
+        for j in range(grid_rows):
+            for i in range(grid_cols):
+                # 本块中心（米）——全部基于“逻辑像素 * res_1x”
+                cx_m = top_left_mx + (world_px_w / 2 + i * step_px_world_x) * res_1x
+                cy_m = top_left_my - (world_px_h / 2 + j * step_px_world_y) * res_1x
+
+                lon, lat = mercator_to_lonlat(cx_m, cy_m)
+
+                # 扩展名在下载后按返回内容决定
+                tile_stem = os.path.join(out_dir, f"{save_name_prefix}_{j:02d}_{i:02d}")
+                yield i, j, lat, lon, tile_stem
+
+    # 已下载子图的 ETag / Last-Modified（重复跑同一区域时只花响应头的流量）
+    index = engine.ValidatorIndex(out_dir)
+
+    def fetch(i, j, lat, lon, tile_stem):
+        return download_static(lat=lat, lon=lon, zoom=zoom, out_stem=tile_stem, index=index)
+
+    # 流水线：下载线程池（按 host 令牌桶限速）→ 解码线程池 → 主线程粘贴，三段同时进行，队列有界（见 pipeline.py）
+    progress = metrics.Progress(grid_cols * grid_rows)
+    for (i, j, _, _, tile_stem), data, im in pipeline.run(tasks(), fetch, fetch_workers=MAX_WORKERS):
+        progress.update(ok=data is not None)
+        if data is None:
+            print(f"[WARN] 下载失败，留空：({i},{j})")
+            continue
+        if im is None:
+            print(f"[WARN] 解码失败，留空：{tile_stem}")
+            continue
+
+        # 粘贴位置（渲染像素）
+        px = i * step_px_render_x
+        py = j * step_px_render_y
+
+        # 保险：如果返回尺寸不是期望的（例如 API 变动），可居中/调整
+        # 这里简单直接粘贴（已在解码线程里解码好）
+        with metrics.timer("paste_seconds"):
             mosaic.paste(im, (px, py))
+    progress.close()
 
-            time.sleep(SLEEP_BETWEEN)
+    index.save()
 
-    mosaic_path = os.path.join(out_dir, f"{save_name_prefix}_mosaic.png")
-    mosaic.save(mosaic_path)
+    mosaic_path = encode.save(mosaic, os.path.join(out_dir, f"{save_name_prefix}_mosaic.png"))
     print(f"[OK] 拼接完成 → {mosaic_path}")
 
+    if make_cog:
+        # 同一张画布再写一份带 EPSG:3857 地理参考的 COG（内部分块 + 金字塔）
+        pixels = mosaic.array if canvas_backend == "memmap" else np.asarray(mosaic)
+        geotiff.write_cog(os.path.join(out_dir, f"{save_name_prefix}_mosaic.tif"), pixels,
+                          (top_left_mx, top_left_my), res_1x / SCALE)
+        del pixels
+    if canvas_backend == "memmap":
+        mosaic.close()
+
     wld_path = None
     if make_pgw:
-        # PGW（世界文件）：A D B E C F
-        # A = 像素宽方向地面分辨率（米/渲染像素）
-        # E = 像素高方向地面分辨率（通常为 -A）
-        # 注意：渲染像素的米/像素 = res_1x / SCALE
-        A = res_1x / SCALE
-        D = 0.0
-        B = 0.0
-        E = -res_1x / SCALE
-        # C/F = 左上像素中心的地理坐标（米）
-        C = top_left_mx + A * 0.5
-        F = top_left_my + E * 0.5
-
-        wld_path = mosaic_path[:-4] + ".pgw"
-        with open(wld_path, "w", encoding="utf-8") as f:
-            f.write(f"{A:.12f}\n{D:.12f}\n{B:.12f}\n{E:.12f}\n{C:.12f}\n{F:.12f}\n")
-        print(f"[OK] 世界文件生成 → {wld_path}")
+        # 注意：渲染像素的米/像素 = res_1x / SCALE；预览图再乘缩小倍数
+        factor = encode.preview_factor(mosaic_px_render_w, mosaic_px_render_h) if encode.PREVIEW else 1
+        wld_path = geotiff.write_world_file(mosaic_path, (top_left_mx, top_left_my), res_1x / SCALE * factor)
 
     if make_dxf:
         try:
@@ -305,7 +399,20 @@ if __name__ == "__main__":
     out_dir = "out_static"
     overlap_ratio = 0.10  # 相邻子图重叠 10%（减少接缝）
 
+    # 只估算不下载（请求数 / 流量 / 时间 / 拼接内存），确认后改回 False
+    plan_only = False
+    if plan_only:
+        plan_static_mosaic(center_lat, center_lon, width_m, height_m, zoom,
+                           out_dir=out_dir, overlap_ratio=overlap_ratio, maptype=MAPTYPE)
+        raise SystemExit
+
+    if METRICS_PORT:
+        metrics.serve(METRICS_PORT)
+
     run_static_mosaic(center_lat, center_lon, width_m, height_m, zoom,
                       out_dir=out_dir, overlap_ratio=overlap_ratio,
                       maptype=MAPTYPE, save_name_prefix=None,
                       make_pgw=True, make_dxf=True)
+
+    # 下载 / 拼接各阶段指标（请求耗时分位数、流量、重试、缓存命中、粘贴耗时、峰值内存）
+    metrics.report(os.path.join(out_dir, "metrics.json"))
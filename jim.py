@@ -9,12 +9,12 @@ Apple Maps / satellites.pro 手动 accessKey 下载瓦片并拼接成大图
 - 抓到的 accessKey 必须保持原样粘贴到 ACCESS_KEY 变量中
 """
 
-import os
 import math
-import time
-import requests
-from io import BytesIO
-from PIL import Image
+
+import journal
+import metrics
+import tilestore
+# requests / NumPy / PIL 等重模块在用到的函数里才导入：只做估算（plan）时启动很快，import 时不做任何事
 
 # ============================================================
 # 🔧🔧🔧 手动配置区（你只需要修改这里） 🔧🔧🔧
@@ -25,8 +25,10 @@ ACCESS_KEY = "1770634203_1864761183818928198_%2F_JAa50YazV0S5a%2FQbyEt15UTLeDMvd
 ZOOM = 19                     # z
 MIN_LAT, MIN_LON  = 53.36297828726348, -6.248149349652652 # 左下角（经纬度）
 MAX_LAT, MAX_LON  = 53.36519002004783, -6.241323388028519  # 右上角（经纬度）
-OUT_DIR = "tiles_z14"        # 下载的瓦片保存到此文件夹
-OUTPUT_IMAGE = "satellite_z14.png"   # 拼接结果图像
+AOI = None        # 可选：多边形 / 折线（GeoJSON 或 WKT，字符串或文件路径），设置后代替上面的矩形
+BUFFER_M = 0      # 折线走廊的缓冲距离（米），例如 AOI = "LINESTRING(-6.25 53.36, -6.24 53.37)", BUFFER_M = 50
+TILE_DB = "tiles/tiles.mbtiles"      # 下载的瓦片保存到此 MBTiles 瓦片库
+OUTPUT_IMAGE = "satellite_z14.png"   # 拼接结果图像（.tif 输出带地理参考的 Cloud-Optimized GeoTIFF）
 
 # Apple Maps tile 参数（一般不需要改）
 TILE_SIZE = 256
@@ -35,11 +37,20 @@ APPLE_TILE_STYLE = 7          #style
 APPLE_TILE_SIZE_PARAM = 1     # size
 APPLE_TILE_SCALE = 1          #scale
 APPLE_TILE_VERSION = 10311    #v
+PROVIDER = "apple-sat"        # 瓦片库中的来源名
 
 # 下载相关参数
 REQUEST_TIMEOUT = 20
-RETRIES = 3
-SLEEP_BETWEEN = 0.25
+RETRIES = 4             # 每张瓦片最多尝试次数（429 / 5xx / 网络异常，指数退避 + 抖动，遵守 Retry-After）
+RATE_LIMIT = 4          # 每秒最多请求数（按 host 令牌桶限速）
+MAX_WORKERS = 4         # 并发下载线程数
+STREAMING_STITCH = True # 流式拼接：逐行瓦片写 PNG，峰值内存只占一行瓦片
+STITCH_PROCESSES = 1    # >1：多进程并行解码 + 粘贴到磁盘共享画布（见 mosaic.py）
+INCREMENTAL_STITCH = False # True：只重写变了的瓦片（输出旁边保留索引和原始像素，见 patch.py）
+PLAN_ONLY = False       # True：只估算请求数 / 流量 / 时间 / 拼接内存，不下载
+REFRESH = False         # True：库中已有瓦片发条件请求刷新（304 不动）；False：已有瓦片直接跳过
+METRICS_PORT = 0        # >0：运行期间在 http://127.0.0.1:端口/metrics 提供 Prometheus 指标
+METRICS_JSON = "output/metrics_apple.json"   # 运行结束写指标汇总（None 不写）
 
 
 # ============================================================
@@ -74,87 +85,111 @@ def build_tile_url(z, x, y, access_key):
     )
 
 
-def download_tile(z, x, y, access_key, out_path):
-    url = build_tile_url(z, x, y, access_key)
-    for attempt in range(1, RETRIES + 1):
-        try:
-            r = requests.get(url, timeout=REQUEST_TIMEOUT)
-            if r.status_code == 200:
-                img = Image.open(BytesIO(r.content)).convert("RGB")
-                img.save(out_path)
-                return True
-            print(f"[WARN] HTTP {r.status_code} while downloading x={x} y={y}")
-        except Exception as e:
-            print(f"[ERROR] attempt {attempt}: {e}")
-        time.sleep(attempt * 0.7)
-    return False
+def download_tile(z, x, y, access_key, validators=None):
+    """
+    返回 (状态码, 原始字节, 附加信息)：200 / 304 → validators（304 时内容为 None）；失败 → 内容为 None + 原因
+    原样保存服务端返回的 JPEG，不解码也不重新压缩（避免二次 JPEG 损失）
+    """
+    import engine
+
+    # 限流 / 5xx / 网络异常由 engine.fetch 退避重试；url 里带 accessKey，日志只显示瓦片号
+    return engine.fetch_tile(build_tile_url(z, x, y, access_key), rate=RATE_LIMIT, validators=validators,
+                             retries=RETRIES, label=f"z={z} x={x} y={y}", timeout=REQUEST_TIMEOUT)
+
+
+def area_job():
+    """任务范围：设置了 AOI 时是 AOI 覆盖的稀疏瓦片，否则是 MIN/MAX 经纬度矩形"""
+    if AOI is not None:
+        import aoi
+        return {"provider": PROVIDER, **aoi.aoi_job(AOI, ZOOM, BUFFER_M)}
+    x_min, x_max, y_min, y_max = bbox_to_tile_range(MIN_LON, MIN_LAT, MAX_LON, MAX_LAT, ZOOM)
+    return {"provider": PROVIDER, "zoom": ZOOM,
+            "min_x": x_min, "max_x": x_max, "min_y": y_min, "max_y": y_max}
 
 
 def download_area():
     if not ACCESS_KEY:
         raise RuntimeError("请先设置 ACCESS_KEY！")
 
-    os.makedirs(OUT_DIR, exist_ok=True)
-
-    x_min, x_max, y_min, y_max = bbox_to_tile_range(MIN_LON, MIN_LAT, MAX_LON, MAX_LAT, ZOOM)
+    job = area_job()
 
     print(f"[INFO] Zoom={ZOOM}")
-    print(f"[INFO] X: {x_min} → {x_max}")
-    print(f"[INFO] Y: {y_min} → {y_max}")
+    print(f"[INFO] X: {job['min_x']} → {job['max_x']}")
+    print(f"[INFO] Y: {job['min_y']} → {job['max_y']}")
 
-    total = (x_max - x_min + 1) * (y_max - y_min + 1)
-    done = 0
+    return download_job(job)
 
-    for x in range(x_min, x_max + 1):
-        for y in range(y_min, y_max + 1):
-            out_path = f"{OUT_DIR}/{x}_{y}.jpg"
-            if os.path.exists(out_path):
-                done += 1
-                continue
 
-            print(f"[Downloading] {done+1}/{total} tile ({x},{y})")
-            download_tile(ZOOM, x, y, ACCESS_KEY, out_path)
-            done += 1
-            time.sleep(SLEEP_BETWEEN)
+def plan_area(job=None):
+    """只估算不下载（已缓存的瓦片 REFRESH=False 时不再请求）；job 为空时按配置区的范围"""
+    import plan
 
-    print("[INFO] 下载完成！")
+    return plan.plan_tiles(TILE_DB, PROVIDER, [job or area_job()], RATE_LIMIT, MAX_WORKERS, OUTPUT_IMAGE,
+                           STREAMING_STITCH, STITCH_PROCESSES, revalidate=REFRESH, incremental=INCREMENTAL_STITCH)
 
 
-def stitch_tiles():
-    files = [f for f in os.listdir(OUT_DIR) if "_" in f]
-    coords = [(int(f.split("_")[0]), int(f.split("_")[1].split(".")[0])) for f in files]
+def resume(journal_path):
+    """按任务日志继续中断的下载（accessKey 过期后换上新的 ACCESS_KEY 再调用）"""
+    if not ACCESS_KEY:
+        raise RuntimeError("请先设置 ACCESS_KEY！")
+    return download_job(journal.job_of(journal_path), journal_path)
 
-    xs = sorted(set([c[0] for c in coords]))
-    ys = sorted(set([c[1] for c in coords]))
 
-    width = len(xs) * TILE_SIZE
-    height = len(ys) * TILE_SIZE
+def fetch_tiles(store, job_log, tiles, total=None):
+    """下载 tiles 中的 (z, x, y)，成功写库，结果逐条记进任务日志；库中已有的瓦片 REFRESH=False 时直接跳过"""
+    import engine
 
-    print(f"[INFO] 拼接图像大小: {width} x {height}")
+    access_key = ACCESS_KEY
 
-    canvas = Image.new("RGB", (width, height), (0,0,0))
+    def download(x, y, z, validators):
+        return download_tile(z, x, y, access_key, validators)
 
-    for xi, x in enumerate(xs):
-        for yi, y in enumerate(ys):
-            path = f"{OUT_DIR}/{x}_{y}.jpg"
-            if not os.path.exists(path):
-                print(f"[WARN] 缺失瓦片: {path}")
-                continue
+    engine.fetch_tiles(store, job_log, tiles, PROVIDER, download, MAX_WORKERS, total, refresh=REFRESH)
 
-            img = Image.open(path)
-            x1 = xi * TILE_SIZE
-            y1 = yi * TILE_SIZE
-            canvas.paste(img, (x1, y1))
 
-    canvas.save(OUTPUT_IMAGE)
-    print(f"[INFO] 拼接完成: {OUTPUT_IMAGE}")
+def download_job(job, journal_path=None):
+    """
+    下载 job 描述的瓦片范围，每张瓦片的结果记进任务日志：
+    第一遍只下日志里还没有结果的瓦片，第二遍补洞只重试失败的瓦片
+    """
+    import engine
+
+    summary, journal_path = engine.download_job(TILE_DB, job, fetch_tiles, "jpg", journal_path)
+
+    if summary[journal.FAILED]:
+        print(f"[WARN] {summary[journal.FAILED]} 张瓦片下载失败，换新 ACCESS_KEY 后可 resume('{journal_path}')")
+    print("[INFO] 下载完成！")
+    return summary
+
+
+def stitch_tiles(job=None, output_image=None, tile_db=None):
+    """拼接 job（为空时按配置区的范围）的瓦片，输出 output_image（为空时用 OUTPUT_IMAGE），瓦片库为空时用 TILE_DB"""
+    import mosaic
+
+    job = job or area_job()
+    output_image = output_image or OUTPUT_IMAGE
+
+    with tilestore.TileStore(tile_db or TILE_DB) as store:
+        # 卫星图本身是 JPEG，输出 COG 时也用 JPEG 压缩
+        output_image = mosaic.stitch_store(store, PROVIDER, job["zoom"], output_image, job, STREAMING_STITCH,
+                                           STITCH_PROCESSES, INCREMENTAL_STITCH, compression="jpeg")
+    print(f"[INFO] 拼接完成: {output_image}")
+    return output_image
 
 
 if __name__ == "__main__":
+    if PLAN_ONLY:
+        plan_area()
+        raise SystemExit
+
+    if METRICS_PORT:
+        metrics.serve(METRICS_PORT)
+
     print("=== 开始下载 Apple Maps 瓦片 ===")
     download_area()
 
     print("\n=== 开始拼接大图 ===")
     stitch_tiles()
 
+    metrics.report(METRICS_JSON)
     print("\n 完成！")
\ No newline at end of file
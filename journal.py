@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""
+下载任务日志（只追加的 job journal），用于断点续传
+
+每行一条 JSON：
+  {"type": "job", ...}                                   任务头（来源 / zoom / 瓦片范围），resume 时据此重建任务
+  {"z": 15, "x": 1, "y": 2, "state": "ok", "attempts": 1}
+  {"z": 15, "x": 1, "y": 3, "state": "failed", "reason": "HTTP 503", "attempts": 2}
+
+瓦片状态：pending（日志里还没有记录）/ ok / failed（带原因，attempts 为累计尝试次数）
+- 记录先缓冲，每 FSYNC_EVERY 条或 FSYNC_INTERVAL 秒写盘并 fsync 一次
+- 写盘前先调用 before_sync（一般是 TileStore.flush），保证日志里的 ok 一定已经进了瓦片库
+- 进程中途被杀时最后一行可能写了一半：重放时跳过，续写前截掉（否则下一条记录会接在这半行后面一起丢掉）
+"""
+
+import hashlib
+import json
+import os
+import time
+
+PENDING = "pending"
+OK = "ok"
+FAILED = "failed"
+
+FSYNC_EVERY = 100       # 每攒多少条记录 fsync 一次
+FSYNC_INTERVAL = 2.0    # 或者距上次 fsync 超过多少秒
+
+
+class JobJournal:
+    """一个任务一个日志文件；同一个对象只在一个线程里使用"""
+
+    def __init__(self, path, job=None, before_sync=None):
+        """
+        job：任务头（dict）。日志已存在时与文件里的任务头比对，不一致直接报错；
+             为 None 时只读取已有日志（resume）
+        """
+        self.path = path
+        self.before_sync = before_sync
+        self.states = {}
+        self.buffer = []
+        self.last_sync = time.monotonic()
+        self.job = None
+
+        if os.path.exists(path):
+            self._replay()
+            self._truncate_torn()
+            if job is not None and self.job is not None and job != self.job:
+                raise ValueError(f"日志 {path} 属于另一个任务：{self.job}")
+
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self.f = open(path, "a", encoding="utf-8")
+
+        if self.job is None:
+            if job is None:
+                raise ValueError(f"日志 {path} 不存在或没有任务头，无法续传")
+            self.job = job
+            self.buffer.append(json.dumps({"type": "job", **job}))
+            self.sync()
+
+    def _replay(self):
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    continue   # 被中断时写了一半的行
+                if rec.get("type") == "job":
+                    rec.pop("type")
+                    self.job = rec
+                    continue
+                self.states[(rec["z"], rec["x"], rec["y"])] = (
+                    rec["state"], rec.get("reason"), rec.get("attempts", 0)
+                )
+
+    def _truncate_torn(self):
+        """文件不以换行结尾时，截回到最后一个换行（去掉写了一半的最后一行）"""
+        with open(self.path, "rb+") as f:
+            end = f.seek(0, os.SEEK_END)
+            pos = end
+            while pos > 0:
+                start = max(0, pos - 4096)
+                f.seek(start)
+                block = f.read(pos - start)
+                if pos == end and block.endswith(b"\n"):
+                    return
+                cut = block.rfind(b"\n")
+                if cut >= 0:
+                    f.truncate(start + cut + 1)
+                    return
+                pos = start
+            f.truncate(0)
+
+    # ---------- 查询 ----------
+    def state(self, z, x, y):
+        return self.states.get((z, x, y), (PENDING,))[0]
+
+    def attempts(self, z, x, y):
+        return self.states.get((z, x, y), (PENDING, None, 0))[2]
+
+    def pending(self, tiles):
+        """tiles 中还没有结果的瓦片（断点续传的第一遍）"""
+        for z, x, y in tiles:
+            if (z, x, y) not in self.states:
+                yield z, x, y
+
+    def failed(self):
+        """所有失败的瓦片（补洞那一遍只重试这些）"""
+        return sorted(k for k, v in self.states.items() if v[0] == FAILED)
+
+    def summary(self):
+        counts = {OK: 0, FAILED: 0}
+        for state, _, _ in self.states.values():
+            counts[state] += 1
+        return counts
+
+    # ---------- 写 ----------
+    def record(self, z, x, y, state, reason=None):
+        attempts = self.attempts(z, x, y) + 1
+        self.states[(z, x, y)] = (state, reason, attempts)
+        rec = {"z": z, "x": x, "y": y, "state": state, "attempts": attempts}
+        if reason:
+            rec["reason"] = reason
+        self.buffer.append(json.dumps(rec))
+        if len(self.buffer) >= FSYNC_EVERY or time.monotonic() - self.last_sync >= FSYNC_INTERVAL:
+            self.sync()
+
+    def sync(self):
+        if self.before_sync:
+            self.before_sync()
+        if self.buffer:
+            self.f.write("\n".join(self.buffer) + "\n")
+            self.buffer = []
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.last_sync = time.monotonic()
+
+    def close(self):
+        if self.f is not None:
+            self.sync()
+            self.f.close()
+            self.f = None
+
+    def finish(self):
+        """任务结束：全部成功就删掉日志（下次同一任务是全新一轮），否则留着等 resume"""
+        self.close()
+        summary = self.summary()
+        if summary[FAILED] == 0:
+            os.remove(self.path)
+        return summary
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def journal_path_for(tile_db, job):
+    """
+    默认日志位置：瓦片库旁边的 jobs/ 目录，文件名由来源 + 瓦片范围决定（同一任务重跑会自动续传）
+    AOI 任务（见 aoi.py）外接范围可能相同，文件名再加上 AOI 的短哈希
+    """
+    name = f"{job['provider']}_z{job['zoom']}_{job['min_x']}_{job['min_y']}_{job['max_x']}_{job['max_y']}"
+    if job.get("aoi") is not None:
+        key = json.dumps([job["aoi"], job.get("buffer_m", 0)], sort_keys=True).encode("utf-8")
+        name += "_" + hashlib.blake2b(key, digest_size=4).hexdigest()
+    name += ".journal"
+    return os.path.join(os.path.dirname(tile_db), "jobs", name)
+
+
+def job_of(path):
+    """只读出日志的任务头（resume 用）"""
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                continue
+            if rec.get("type") == "job":
+                rec.pop("type")
+                return rec
+    raise ValueError(f"日志 {path} 没有任务头")
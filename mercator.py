@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""
+Web Mercator (EPSG:3857) 坐标换算（go.py 的静态图拼接和 GeoTIFF 地理参考共用）
+*_np 为 NumPy 批量版本（AOI 覆盖计算一次换算成千上万个点）；NumPy 在第一次调用时才导入
+"""
+
+import math
+
+# =========================
+# Web Mercator 常量
+# =========================
+EARTH_RADIUS = 6378137.0
+INITIAL_RES = 156543.03392804097  # m/px at zoom=0 (Web Mercator, scale=1)
+ORIGIN_SHIFT = math.pi * EARTH_RADIUS  # 20037508.342789244，世界左上角到原点的距离（米）
+
+def lonlat_to_mercator(lon: float, lat: float):
+    x = math.radians(lon) * EARTH_RADIUS
+    # clamp lat for mercator
+    lat = max(-85.05112878, min(85.05112878, lat))
+    y = EARTH_RADIUS * math.log(math.tan(math.pi/4 + math.radians(lat)/2))
+    return x, y
+
+def mercator_to_lonlat(x: float, y: float):
+    lon = math.degrees(x / EARTH_RADIUS)
+    lat = math.degrees(2 * math.atan(math.exp(y / EARTH_RADIUS)) - math.pi/2)
+    return lon, lat
+
+def meters_per_pixel(zoom: int) -> float:
+    """Meters per logical pixel at given zoom (i.e., scale=1)."""
+    return INITIAL_RES / (2 ** zoom)
+
+def tile_resolution(zoom: int, tile_size: int = 256) -> float:
+    """XYZ 瓦片的地面分辨率（米/像素），tile_size 为瓦片实际像素宽"""
+    return 2 * ORIGIN_SHIFT / (2 ** zoom) / tile_size
+
+def tile_top_left(x: int, y: int, zoom: int):
+    """XYZ 瓦片 (x, y) 左上角的 Web Mercator 坐标（米）"""
+    span = 2 * ORIGIN_SHIFT / (2 ** zoom)
+    return x * span - ORIGIN_SHIFT, ORIGIN_SHIFT - y * span
+
+def lonlat_to_mercator_np(lon, lat):
+    """lonlat_to_mercator 的批量版本（数组进，数组出）"""
+    import numpy as np
+    lon = np.asarray(lon, dtype=np.float64)
+    lat = np.clip(np.asarray(lat, dtype=np.float64), -85.05112878, 85.05112878)
+    x = np.radians(lon) * EARTH_RADIUS
+    y = EARTH_RADIUS * np.log(np.tan(np.pi / 4 + np.radians(lat) / 2))
+    return x, y
+
+def mercator_to_tile_np(mx, my, zoom: int):
+    """Web Mercator 米 → 带小数的 XYZ 瓦片坐标（np.floor 后即瓦片编号）"""
+    import numpy as np
+    n = 2 ** zoom
+    tx = (np.asarray(mx, dtype=np.float64) + ORIGIN_SHIFT) / (2 * ORIGIN_SHIFT) * n
+    ty = (ORIGIN_SHIFT - np.asarray(my, dtype=np.float64)) / (2 * ORIGIN_SHIFT) * n
+    return tx, ty
+
+def lonlat_to_tile_np(lon, lat, zoom: int):
+    """latlon_to_tile / lonlat_to_tile 的批量版本，返回带小数的瓦片坐标"""
+    return mercator_to_tile_np(*lonlat_to_mercator_np(lon, lat), zoom)
@@ -0,0 +1,402 @@
+# -*- coding: utf-8 -*-
+"""
+运行指标：下载引擎和拼接各阶段的计数器 / 直方图（进程内，线程安全）
+
+- 下载：每次请求的耗时直方图、按 host + 状态码计数、重试次数、字节数（→ 字节/秒）、
+  条件请求的缓存命中率（304 / 已缓存跳过 算命中，200 算未命中）
+- 拼接：解码耗时、粘贴耗时直方图，重复内容复用次数
+- 进程峰值内存（RSS，含已结束的子进程）
+- 运行结束：report() 打印汇总并写 JSON；长任务：serve(port) 在 /metrics 提供 Prometheus 文本格式
+- 进度：Progress 代替逐张瓦片的 print，最多每 PROGRESS_INTERVAL 秒打一行
+- timer() 的每次计时在开了追踪时同时记成时间线上的一段（见 tracing.py）
+
+多进程拼接时子进程各有一份指标：子进程 reset() 后干活，把 snapshot() 交回主进程 merge()
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+import tracing
+
+try:
+    import resource   # Windows 没有，峰值内存记为 None
+except ImportError:
+    resource = None
+
+PREFIX = "imagetool_"
+PROGRESS_INTERVAL = 2.0   # 进度行最短间隔（秒）
+
+# 直方图桶上界（秒）
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+STAGE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+
+# ========================
+# 格式化
+# ========================
+def fmt_bytes(n):
+    for unit in ("B", "KB", "MB", "GB"):
+        if n < 1024:
+            return f"{n:.1f} {unit}" if unit != "B" else f"{int(n)} B"
+        n /= 1024
+    return f"{n:.2f} TB"
+
+
+def fmt_time(seconds):
+    seconds = int(round(seconds))
+    h, rest = divmod(seconds, 3600)
+    m, s = divmod(rest, 60)
+    if h:
+        return f"{h}h{m:02d}m{s:02d}s"
+    if m:
+        return f"{m}m{s:02d}s"
+    return f"{s}s"
+
+
+# ========================
+# 直方图
+# ========================
+class Histogram:
+    """固定桶直方图；分位数在桶内线性插值（和 Prometheus histogram_quantile 一样）"""
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)   # 最后一个是 +Inf
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value):
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                lo = self.buckets[i - 1] if i else 0.0
+                hi = min(self.buckets[i], self.max) if i < len(self.buckets) else self.max
+                lo = min(lo, hi)
+                return lo + (hi - lo) * (rank - seen) / n
+            seen += n
+        return self.max
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.sum += other.sum
+        self.count += other.count
+        self.max = max(self.max, other.max)
+
+    def summary(self):
+        if not self.count:
+            return {"count": 0}
+        return {"count": self.count, "sum": round(self.sum, 6), "mean": round(self.sum / self.count, 6),
+                "p50": round(self.quantile(0.5), 6), "p90": round(self.quantile(0.9), 6),
+                "p99": round(self.quantile(0.99), 6), "max": round(self.max, 6)}
+
+
+# ========================
+# 指标表
+# ========================
+class Registry:
+    """计数器和直方图，键为 (名字, 排好序的标签元组)"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+            self.started = time.time()
+
+    def inc(self, name, n=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = Histogram(buckets)
+            hist.observe(value)
+
+    @contextmanager
+    def timer(self, name, buckets=STAGE_BUCKETS, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.observe(name, elapsed, buckets, **labels)
+            tracing.complete(name, start, elapsed, "stage", **labels)   # 开了追踪时同时是时间线上的一段
+
+    # ---------- 查询 ----------
+    def total(self, name, **match):
+        """名字为 name、标签包含 match 的计数器之和"""
+        with self.lock:
+            return sum(v for (n, labels), v in self.counters.items()
+                       if n == name and all(dict(labels).get(k) == w for k, w in match.items()))
+
+    def by_label(self, name, label):
+        """{标签值: 计数}"""
+        out = {}
+        with self.lock:
+            for (n, labels), v in self.counters.items():
+                if n == name:
+                    k = dict(labels).get(label)
+                    out[k] = out.get(k, 0) + v
+        return out
+
+    def histogram(self, name):
+        """名字为 name 的所有直方图合并成一个（不区分标签）"""
+        merged = None
+        with self.lock:
+            for (n, _), hist in self.histograms.items():
+                if n == name:
+                    if merged is None:
+                        merged = Histogram(hist.buckets)
+                    merged.merge(hist)
+        return merged
+
+    # ---------- 跨进程 ----------
+    def snapshot(self):
+        """可 pickle 的副本（子进程交回主进程用）"""
+        with self.lock:
+            return {"counters": dict(self.counters),
+                    "histograms": {k: (h.buckets, list(h.counts), h.sum, h.count, h.max)
+                                   for k, h in self.histograms.items()}}
+
+    def merge(self, snap):
+        with self.lock:
+            for key, v in snap["counters"].items():
+                self.counters[key] = self.counters.get(key, 0) + v
+            for key, (buckets, counts, total, count, peak) in snap["histograms"].items():
+                other = Histogram(buckets)
+                other.counts, other.sum, other.count, other.max = counts, total, count, peak
+                hist = self.histograms.get(key)
+                if hist is None:
+                    hist = self.histograms[key] = Histogram(buckets)
+                hist.merge(other)
+
+
+REGISTRY = Registry()
+inc = REGISTRY.inc
+observe = REGISTRY.observe
+timer = REGISTRY.timer
+snapshot = REGISTRY.snapshot
+merge = REGISTRY.merge
+reset = REGISTRY.reset
+
+
+def peak_rss():
+    """本进程和已回收子进程中最大的峰值 RSS（字节）；拿不到时返回 None"""
+    if resource is None:
+        return None
+    scale = 1 if sys.platform == "darwin" else 1024   # Linux 上 ru_maxrss 单位是 KB
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own, children) * scale
+
+
+# ========================
+# 汇总
+# ========================
+def summary(registry=REGISTRY):
+    elapsed = max(time.time() - registry.started, 1e-9)
+    transferred = registry.total("http_bytes")
+    hits = registry.total("cache", result="hit")
+    misses = registry.total("cache", result="miss")
+    out = {
+        "elapsed_s": round(elapsed, 3),
+        "requests": registry.total("http_requests"),
+        "status": {str(k): v for k, v in sorted(registry.by_label("http_requests", "status").items(),
+                                                key=lambda kv: str(kv[0]))},
+        "retries": registry.total("http_retries"),
+        "bytes": transferred,
+        "bytes_per_s": round(transferred / elapsed, 1),
+        "tiles": registry.by_label("tiles", "result"),
+        "cache_hits": hits,
+        "cache_misses": misses,
+        "cache_hit_ratio": round(hits / (hits + misses), 4) if hits + misses else None,
+        "decode_reused": registry.total("decode_reused"),
+        "peak_rss_bytes": peak_rss(),
+    }
+    for name in ("http_latency_seconds", "decode_seconds", "paste_seconds"):
+        hist = registry.histogram(name)
+        out[name] = hist.summary() if hist else {"count": 0}
+    # 流水线各段被卡住的总秒数（见 pipeline.py）：哪段等得最多，瓶颈就在它的下游 / 上游
+    with registry.lock:
+        waits = {dict(labels).get("stage"): round(h.sum, 3) for (n, labels), h in registry.histograms.items()
+                 if n == "pipeline_wait_seconds"}
+    if waits:
+        out["pipeline_wait_s"] = waits
+    # 输出编码（见 encode.py）：每种格式的像素数、耗时、MP/s
+    pixels = registry.by_label("encode_pixels", "format")
+    if pixels:
+        with registry.lock:
+            seconds = {dict(labels).get("format"): h.sum for (n, labels), h in registry.histograms.items()
+                       if n == "encode_seconds"}
+        out["encode"] = {fmt: {"megapixels": round(p / 1e6, 3), "seconds": round(seconds.get(fmt, 0), 3),
+                               "mp_per_s": round(p / 1e6 / seconds[fmt], 1) if seconds.get(fmt) else None}
+                         for fmt, p in pixels.items()}
+    return out
+
+
+def report(path=None, registry=REGISTRY):
+    """打印一行汇总；给出 path 时把完整汇总写成 JSON"""
+    s = summary(registry)
+    latency = s["http_latency_seconds"]
+    line = f"[INFO] 指标：{s['requests']} 次请求，{fmt_bytes(s['bytes'])}（{fmt_bytes(s['bytes_per_s'])}/s），" \
+           f"重试 {s['retries']}"
+    if latency["count"]:
+        line += f"，耗时 p50 {latency['p50'] * 1000:.0f}ms / p99 {latency['p99'] * 1000:.0f}ms"
+    if s["cache_hit_ratio"] is not None:
+        line += f"，缓存命中 {s['cache_hit_ratio']:.1%}"
+    for name, label in (("decode_seconds", "解码"), ("paste_seconds", "粘贴")):
+        if s[name]["count"]:
+            line += f"，{label} {s[name]['count']} 次 {s[name]['sum']:.2f}s"
+    for fmt, e in s.get("encode", {}).items():
+        if e["mp_per_s"]:
+            line += f"，编码 {fmt.upper()} {e['mp_per_s']:.1f} MP/s"
+    if s["peak_rss_bytes"]:
+        line += f"，峰值内存 {fmt_bytes(s['peak_rss_bytes'])}"
+    print(line)
+
+    if path:
+        folder = os.path.dirname(os.path.abspath(path))
+        os.makedirs(folder, exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(s, f, ensure_ascii=False, indent=2)
+        print(f"[OK] 指标汇总 → {path}")
+    return s
+
+
+# ========================
+# Prometheus 文本端点
+# ========================
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+
+def prometheus(registry=REGISTRY):
+    """Prometheus 文本格式（text/plain; version=0.0.4）"""
+    lines = []
+    with registry.lock:
+        counters = sorted(registry.counters.items(), key=lambda kv: (kv[0][0], str(kv[0][1])))
+        histograms = sorted(registry.histograms.items(), key=lambda kv: (kv[0][0], str(kv[0][1])))
+        seen = set()
+        for (name, labels), v in counters:
+            if name not in seen:
+                lines.append(f"# TYPE {PREFIX}{name}_total counter")
+                seen.add(name)
+            lines.append(f"{PREFIX}{name}_total{_labels(labels)} {v}")
+        for (name, labels), hist in histograms:
+            if name not in seen:
+                lines.append(f"# TYPE {PREFIX}{name} histogram")
+                seen.add(name)
+            cumulative = 0
+            for bound, n in zip(hist.buckets + ("+Inf",), hist.counts):
+                cumulative += n
+                lines.append(f"{PREFIX}{name}_bucket{_labels(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{PREFIX}{name}_sum{_labels(labels)} {hist.sum}")
+            lines.append(f"{PREFIX}{name}_count{_labels(labels)} {hist.count}")
+    rss = peak_rss()
+    if rss is not None:
+        lines.append(f"# TYPE {PREFIX}peak_rss_bytes gauge")
+        lines.append(f"{PREFIX}peak_rss_bytes {rss}")
+    return "\n".join(lines) + "\n"
+
+
+def serve(port, host="127.0.0.1"):
+    """后台线程提供 /metrics（Prometheus）和 /summary（JSON），返回 server（shutdown() 停止）"""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] == "/metrics":
+                body, ctype = prometheus().encode(), "text/plain; version=0.0.4; charset=utf-8"
+            elif self.path.split("?")[0] == "/summary":
+                body, ctype = json.dumps(summary(), ensure_ascii=False).encode(), "application/json"
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", ctype)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"[INFO] 指标端点 → http://{host}:{server.server_port}/metrics")
+    return server
+
+
+# ========================
+# 进度行
+# ========================
+class Progress:
+    """代替逐张 print：最多每 interval 秒打一行进度（张数 / 速率 / 流量 / 重试 / 剩余时间）"""
+
+    def __init__(self, total=None, label="下载", interval=PROGRESS_INTERVAL, registry=REGISTRY):
+        self.total = total
+        self.label = label
+        self.interval = interval
+        self.registry = registry
+        self.done = 0
+        self.failed = 0
+        self.started = self.last = time.monotonic()
+        self.bytes0 = registry.total("http_bytes")
+        self.retries0 = registry.total("http_retries")
+
+    def update(self, n=1, ok=True):
+        self.done += n
+        self.registry.inc("tiles", n, result="ok" if ok else "failed")
+        if not ok:
+            self.failed += n
+        now = time.monotonic()
+        if now - self.last >= self.interval:
+            self.last = now
+            self.show(now)
+
+    def show(self, now=None):
+        elapsed = max((now or time.monotonic()) - self.started, 1e-9)
+        rate = self.done / elapsed
+        transferred = self.registry.total("http_bytes") - self.bytes0
+        line = f"[INFO] {self.label} {self.done}"
+        if self.total:
+            line += f"/{self.total}（{self.done / self.total:.1%}）"
+        line += f"，{rate:.1f} 张/s，{fmt_bytes(transferred / elapsed)}/s"
+        retries = self.registry.total("http_retries") - self.retries0
+        if retries:
+            line += f"，重试 {retries}"
+        if self.failed:
+            line += f"，失败 {self.failed}"
+        if self.total and rate > 0 and self.done < self.total:
+            line += f"，剩余约 {fmt_time((self.total - self.done) / rate)}"
+        print(line)
+
+    def close(self):
+        if self.done:
+            self.show()
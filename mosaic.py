@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""
+多进程并行拼接：解码 + 粘贴分摊到所有 CPU 核
+
+- 画布是磁盘上的共享 memmap（canvas.MemmapCanvas），主进程和子进程映射同一个文件
+- 画布按“瓦片行条带”切成互不重叠的区域，每个条带是一个任务：
+  子进程自己只读打开瓦片库、取出该条带的瓦片、解码后直接写进自己那一段画布
+  （按内容哈希去重：条带内重复的瓦片只解码一次）
+- 子进程之间不共享任何可写区域，不需要锁；结果不经过管道回传，也不需要再合并拷贝
+- 主进程只负责分配条带，最后把画布写成 COG 或 PNG / JPEG / WebP / RAW（encode.py）
+- 子进程的解码 / 粘贴指标随结果交回主进程合并（metrics.merge）
+- stitch_store：各来源共用的拼接入口，按输出格式 / 配置选流式、COG、磁盘画布或内存画布
+"""
+
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import canvas
+import encode
+import geotiff
+import mercator
+import metrics
+import stitch
+import tilestore
+import tracing
+
+MAX_PROCESSES = os.cpu_count() or 1
+BANDS_PER_PROCESS = 4   # 每个进程平均分到的条带数（条带越多负载越均衡）
+
+
+# ========================
+# 子进程：一个条带
+# ========================
+def paste_rows(tile_db, provider, zoom, bounds, band, pixels, tile_size, keep=None):
+    """
+    bounds：整幅图的瓦片范围 (min_x, max_x, min_y, max_y)
+    band：要拼的瓦片行 (y0, y1)，含两端；pixels：整幅画布 (H, W, 3)
+    keep：只拼这些 (x, y)（AOI 稀疏瓦片集合），None 表示范围内全部
+    返回 (成功瓦片数, 解码次数)；同一内容哈希在条带内只解码一次
+    """
+    min_x, max_x, min_y, _ = bounds
+    tile_w, tile_h = tile_size
+    ok = 0
+
+    with tilestore.TileStore(tile_db, readonly=True) as store:
+        get_row = stitch.store_rows(store, provider, zoom, (min_x, max_x, band[0], band[1]), keep)
+        for y in range(band[0], band[1] + 1):
+            py = (y - min_y) * tile_h
+            for x, img in get_row(y).items():
+                tile = np.asarray(img)
+                px = (x - min_x) * tile_w
+                h, w = min(tile.shape[0], tile_h), min(tile.shape[1], tile_w)
+                with metrics.timer("paste_seconds"):
+                    pixels[py:py + h, px:px + w] = tile[:h, :w]
+                ok += 1
+    return ok, get_row.decoder.decoded
+
+
+def paste_band(tile_db, provider, zoom, bounds, band, canvas_path, shape, tile_size, keep=None):
+    """子进程任务：映射共享画布后 paste_rows，返回 (成功瓦片数, 解码次数, 本条带的指标快照)"""
+    metrics.reset()   # 进程池复用子进程（fork 时还带着主进程的计数），每个条带从零开始
+    pixels = np.memmap(canvas_path, dtype=np.uint8, mode="r+", shape=shape)
+    ok, decoded = paste_rows(tile_db, provider, zoom, bounds, band, pixels, tile_size, keep)
+    pixels.flush()
+    del pixels
+    return ok, decoded, metrics.snapshot()
+
+
+def split_bands(min_y, max_y, count):
+    """把 [min_y, max_y] 分成不超过 count 段连续的瓦片行"""
+    rows = max_y - min_y + 1
+    step = max(1, math.ceil(rows / count))
+    return [(y, min(y + step - 1, max_y)) for y in range(min_y, max_y + 1, step)]
+
+
+# ========================
+# 主进程
+# ========================
+def stitch_parallel(tile_db, provider, zoom, bounds, output_image, tile_size,
+                    processes=MAX_PROCESSES, tiles=None, top_left=None, resolution=None, **cog_options):
+    """
+    并行拼接瓦片库中 bounds 范围内的瓦片
+    tiles：{(x, y), ...} 稀疏瓦片集合（AOI 任务），None 表示范围内全部
+    output_image：.tif/.tiff（COG，需要 top_left / resolution，见 mercator.py）或 encode.py 支持的格式
+    返回实际输出路径（预览模式下是 <原名>.preview.jpg）
+    """
+    is_tiff = output_image.lower().endswith((".tif", ".tiff"))
+    if not is_tiff:
+        encode.format_of(output_image)   # 不支持的格式在拼接前就报错
+
+    min_x, max_x, min_y, max_y = bounds
+    tile_w, tile_h = tile_size
+    width = (max_x - min_x + 1) * tile_w
+    height = (max_y - min_y + 1) * tile_h
+
+    folder = os.path.dirname(os.path.abspath(output_image))
+    os.makedirs(folder, exist_ok=True)
+    canvas.check_disk_space(width, height, folder)
+
+    ok = decoded = 0
+    with canvas.MemmapCanvas(width, height, folder=folder) as mosaic:
+        if processes <= 1:
+            # 单进程：不起进程池，直接在本进程里贴进画布
+            print(f"[INFO] 拼接进磁盘画布：{width} x {height}")
+            with tracing.span("stitch.bands", "stitch", bands=1, processes=1):
+                ok, decoded = paste_rows(tile_db, provider, zoom, bounds, (min_y, max_y), mosaic.array,
+                                         tile_size, tiles)
+        else:
+            bands = split_bands(min_y, max_y, processes * BANDS_PER_PROCESS)
+            print(f"[INFO] 并行拼接：{width} x {height}，{len(bands)} 个条带，{processes} 进程")
+            shape = mosaic.array.shape
+            with tracing.span("stitch.bands", "stitch", bands=len(bands), processes=processes), \
+                    ProcessPoolExecutor(max_workers=processes) as pool:
+                futures = []
+                for band in bands:
+                    keep = None
+                    if tiles is not None:
+                        keep = {(x, y) for x, y in tiles if band[0] <= y <= band[1]}
+                    futures.append(pool.submit(paste_band, tile_db, provider, zoom, bounds, band,
+                                               mosaic.path, shape, tile_size, keep))
+                for fut in futures:
+                    n_ok, n_decoded, snap = fut.result()
+                    ok += n_ok
+                    decoded += n_decoded
+                    metrics.merge(snap)
+
+        if ok == 0:
+            raise ValueError("范围内没有瓦片。")
+        print(f"[INFO] 粘贴完成：{ok} 张瓦片，解码 {decoded} 次（重复内容只解码一次）")
+
+        if is_tiff:
+            geotiff.write_cog(output_image, mosaic.array, top_left, resolution, **cog_options)
+        else:
+            output_image = mosaic.save(output_image)
+
+    return output_image
+
+
+# ========================
+# 按输出格式 / 配置选择拼接方式（osm.py / osma.py / jim.py / 服务端共用）
+# ========================
+def stitch_store(store, provider, zoom, output_image, job=None, streaming=True, processes=1,
+                 incremental=False, compression=geotiff.COMPRESSION):
+    """
+    拼接瓦片库中 job（瓦片范围 / AOI 任务，为空时取库中该 zoom 的全部瓦片）的瓦片
+    拼接方式由 plan.stitch_backend 决定（和 plan 的估算一致）：
+    * incremental：只重写变了的瓦片（patch.py）
+    * parallel / memmap：磁盘共享画布（stitch_parallel，多进程 / 单进程）
+    * cog：.tif / .tiff；streaming：逐行写 PNG；memory：整幅拼进内存再 encode.save
+    compression：COG 的压缩方式（卫星图本身是 JPEG 时用 "jpeg"）
+    返回实际输出路径（预览模式下是 <原名>.preview.jpg）
+    """
+    import aoi
+    import plan
+
+    if job is None:
+        bounds = store.bounds(provider, zoom)
+        if bounds is None:
+            raise ValueError(f"瓦片库中没有 {provider} z={zoom} 的瓦片。")
+    else:
+        bounds = (job["min_x"], job["max_x"], job["min_y"], job["max_y"])
+    wanted = aoi.tile_set(job)   # AOI 任务只拼 AOI 覆盖的瓦片，其余留黑
+    min_x, max_x, min_y, max_y = bounds
+
+    backend = plan.stitch_backend(output_image, streaming, processes, incremental)
+    if backend == "incremental":
+        import patch
+        patch.stitch_incremental(store, provider, zoom, bounds, output_image, wanted, compression=compression)
+        return output_image
+
+    tile_size = stitch.store_tile_size(store, provider, zoom, bounds)
+    top_left = mercator.tile_top_left(min_x, min_y, zoom)
+    resolution = mercator.tile_resolution(zoom, tile_size[0])
+
+    if backend in ("parallel", "memmap"):
+        return stitch_parallel(store.path, provider, zoom, bounds, output_image, tile_size, processes, wanted,
+                               top_left=top_left, resolution=resolution, compression=compression)
+
+    # 按内容哈希去重解码：重复的瓦片（海面、无影像占位图）只解码一次
+    get_row = stitch.store_rows(store, provider, zoom, bounds, wanted)
+    xs, ys = range(min_x, max_x + 1), range(min_y, max_y + 1)
+    if backend == "cog":
+        geotiff.stitch_to_cog(xs, ys, get_row, output_image, tile_size, top_left, resolution,
+                              compression=compression)
+    elif backend == "streaming":
+        stitch.stitch_streaming(xs, ys, get_row, output_image, tile_size)
+    else:
+        from PIL import Image
+
+        tile_w, tile_h = tile_size
+        width, height = len(xs) * tile_w, len(ys) * tile_h
+        print(f"[INFO] 拼接大图尺寸：{width} x {height}")
+        big = Image.new("RGB", (width, height))
+        for y in ys:
+            for x, img in get_row(y).items():
+                with metrics.timer("paste_seconds"):
+                    big.paste(img, ((x - min_x) * tile_w, (y - min_y) * tile_h))
+        folder = os.path.dirname(output_image)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        output_image = encode.save(big, output_image)
+    get_row.decoder.report()
+    return output_image
@@ -1,17 +1,26 @@
-import os
 import math
-import time
-import requests
-from PIL import Image
+
+import journal
+import metrics
+import tilestore
+# requests / NumPy / PIL 等重模块在用到的函数里才导入：只做估算（plan）时启动很快，import 时不做任何事
 
 # ========================
 # 配置：可以自己修改
 # ========================
 USER_AGENT = "MapTool/1.0 (yu.xia@tmdesign.ie)"
 OSM_TILE_URL = "https://tile.openstreetmap.org/{z}/{x}/{y}.png"
+PROVIDER = "osm"         # 瓦片库中的来源名
 
-DOWNLOAD_DELAY = 0.15    # 每张瓦片之间的延迟
+RATE_LIMIT = 6           # 每个 host 每秒最多请求数（令牌桶限速，≈ 原来 0.15s 间隔）
+MAX_WORKERS = 2          # 并发下载线程数（OSM 使用政策：最多 2 个连接）
 TIMEOUT = 10             # 网络超时时间
+RETRIES = 4              # 每张瓦片最多尝试次数（429 / 5xx / 网络异常，指数退避 + 抖动，遵守 Retry-After）
+STREAMING_STITCH = True  # 流式拼接：逐行瓦片写 PNG，内存只占一行瓦片（其他格式 / 预览先拼进磁盘画布）
+STITCH_PROCESSES = 1     # >1：多进程并行解码 + 粘贴到磁盘共享画布（见 mosaic.py），瓦片多时设成 CPU 核数
+INCREMENTAL_STITCH = False # True：只重写变了的瓦片（输出旁边保留索引和原始像素，见 patch.py）
+REFRESH = False          # True：库中已有瓦片发条件请求刷新（304 不动）；False：已有瓦片直接跳过
+METRICS_PORT = 0         # >0：运行期间在 http://127.0.0.1:端口/metrics 提供 Prometheus 指标
 
 # ========================
 # 工具函数
@@ -40,94 +49,68 @@ def calculate_tile_range(lat, lon, zoom, half_range):
     }
 
 
-def download_tile(x, y, z, save_path):
-    """下载单张瓦片"""
-    url = OSM_TILE_URL.format(z=z, x=x, y=y)
-    headers = {"User-Agent": USER_AGENT}
-
-    try:
-        r = requests.get(url, headers=headers, timeout=TIMEOUT)
-    except Exception as e:
-        print(f"[ERROR] 下载失败：{url} -> {e}")
-        return False
-
-    if r.status_code == 200:
-        with open(save_path, "wb") as f:
-            f.write(r.content)
-        return True
-    else:
-        print(f"[WARN] HTTP {r.status_code} : {url}")
-        return False
-
-
-def download_tiles(tile_range, output_dir):
-    """批量下载瓦片"""
-    os.makedirs(output_dir, exist_ok=True)
-
-    z = tile_range["zoom"]
-    print(f"[INFO] 开始下载瓦片，zoom={z}")
-
-    for x in range(tile_range["min_x"], tile_range["max_x"] + 1):
-        for y in range(tile_range["min_y"], tile_range["max_y"] + 1):
+def download_tile(x, y, z, validators=None):
+    """
+    下载单张瓦片；带 validators 时做条件请求
+    返回 (状态码, 内容, 附加信息)：200 / 304 → 附加信息为 validators（304 时内容为 None）；
+    失败 → 内容为 None，附加信息为失败原因
+    """
+    import engine
 
-            save_name = f"{z}_{x}_{y}.png"
-            save_path = os.path.join(output_dir, save_name)
+    return engine.fetch_tile(OSM_TILE_URL.format(z=z, x=x, y=y), rate=RATE_LIMIT, validators=validators,
+                             retries=RETRIES, headers={"User-Agent": USER_AGENT}, timeout=TIMEOUT)
 
-            print(f"Downloading z={z} x={x} y={y}")
 
-            ok = download_tile(x, y, z, save_path)
+def fetch_tiles(store, job_log, tiles, total=None):
+    """下载 tiles 中的 (z, x, y)，成功写库，结果逐条记进任务日志；库中已有的瓦片 REFRESH=False 时直接跳过"""
+    import engine
 
-            if not ok:
-                print(f"[WARN] 跳过缺失瓦片：z={z} x={x} y={y}")
+    engine.fetch_tiles(store, job_log, tiles, PROVIDER, download_tile, MAX_WORKERS, total, refresh=REFRESH)
 
-            time.sleep(DOWNLOAD_DELAY)
 
-    print("[OK] 完成所有瓦片下载！")
+def download_tiles(tile_range, tile_db, journal_path=None):
+    """
+    批量下载瓦片，写入 MBTiles 瓦片库
+    * 每张瓦片的结果记进任务日志；中断后重跑同一任务（或调用 resume）从断点继续
+    * 最后对失败的瓦片再补一遍；全部成功时删除日志
+    """
+    import engine
 
+    print(f"[INFO] 开始下载瓦片，zoom={tile_range['zoom']}")
+    summary, journal_path = engine.download_job(tile_db, {"provider": PROVIDER, **tile_range}, fetch_tiles,
+                                                "png", journal_path)
 
-def stitch_tiles(tile_folder, output_image):
-    """拼接瓦片为大图"""
-    tiles = [f for f in os.listdir(tile_folder) if f.endswith(".png")]
-    if not tiles:
-        raise ValueError("瓦片目录为空或没有 PNG 文件。")
-
-    xs, ys = [], []
-    imgs = {}
+    if summary[journal.FAILED]:
+        print(f"[WARN] 仍有 {summary[journal.FAILED]} 张瓦片失败，可用 resume('{journal_path}') 继续")
+    else:
+        print("[OK] 完成所有瓦片下载！")
+    return summary
 
-    for fn in tiles:
-        try:
-            z, x, y = fn.replace(".png", "").split("_")
-            x = int(x)
-            y = int(y)
-        except:
-            continue
 
-        img = Image.open(os.path.join(tile_folder, fn))
-        imgs[(x, y)] = img
-        xs.append(x)
-        ys.append(y)
+def plan_download(tile_range, tile_db, output_image=None, streaming=STREAMING_STITCH,
+                  processes=STITCH_PROCESSES, incremental=INCREMENTAL_STITCH):
+    """只估算不下载：请求数、流量、时间、已缓存瓦片数（REFRESH=False 时不再请求）、拼接内存 / 磁盘"""
+    import plan
 
-    min_x, max_x = min(xs), max(xs)
-    min_y, max_y = min(ys), max(ys)
+    return plan.plan_tiles(tile_db, PROVIDER, [tile_range], RATE_LIMIT, MAX_WORKERS,
+                           output_image, streaming, processes, revalidate=REFRESH, incremental=incremental)
 
-    w, h = next(iter(imgs.values())).size
-    total_w = (max_x - min_x + 1) * w
-    total_h = (max_y - min_y + 1) * h
 
-    print(f"[INFO] 拼接大图尺寸：{total_w} x {total_h}")
+def resume(journal_path, tile_db):
+    """按任务日志继续中断的下载任务"""
+    job = journal.job_of(journal_path)
+    tile_range = {k: v for k, v in job.items() if k != "provider"}
+    return download_tiles(tile_range, tile_db, journal_path)
 
-    big = Image.new("RGB", (total_w, total_h))
 
-    for x in range(min_x, max_x + 1):
-        for y in range(min_y, max_y + 1):
-            if (x, y) not in imgs:
-                continue
-            px = (x - min_x) * w
-            py = (y - min_y) * h
-            big.paste(imgs[(x, y)], (px, py))
+def stitch_tiles(tile_db, output_image, zoom, tile_range=None, streaming=STREAMING_STITCH,
+                 processes=STITCH_PROCESSES, incremental=INCREMENTAL_STITCH):
+    """拼接瓦片为大图（tile_range 为空时拼接库中该 zoom 的全部瓦片）；返回实际输出路径"""
+    import mosaic
 
-    os.makedirs(os.path.dirname(output_image), exist_ok=True)
-    big.save(output_image)
+    with tilestore.TileStore(tile_db) as store:
+        output_image = mosaic.stitch_store(store, PROVIDER, zoom, output_image, tile_range, streaming,
+                                           processes, incremental)
     print(f"[OK] 拼接完成 → {output_image}")
 
     return output_image
@@ -137,6 +120,8 @@ def stitch_tiles(tile_folder, output_image):
 # 主流程（已修改为十进制度输入）
 # ========================
 if __name__ == "__main__":
+    import aoi
+    import pyramid
 
     #  你给的十进制度坐标
     lat, lon = 52.867051505476866, -8.755773213659058 #纬度,经度
@@ -144,14 +129,38 @@ if __name__ == "__main__":
     zoom = 15          # 地图缩放等级 13.14.15 =15
     half_range = 10     # tile 范围（越大越宽）  范围area Map Zoom Level 1 2  3 5 10
 
-    tile_dir = f"./tiles/a{zoom}"
+    tile_db = "./tiles/tiles.mbtiles"   # 所有 zoom / 来源共用一个瓦片库
     output_image = f"./output/merged_{zoom}.png"
 
+    # 可选：多边形 / 走廊 AOI（GeoJSON 或 WKT，字符串或文件路径），设置后代替中心点 + half_range
+    AOI = None
+    BUFFER_M = 0        # 折线走廊的缓冲距离（米）
+
     # 步骤 1：计算瓦片范围
-    tile_range = calculate_tile_range(lat, lon, zoom, half_range)
+    if AOI is not None:
+        tile_range = aoi.aoi_job(AOI, zoom, BUFFER_M)
+    else:
+        tile_range = calculate_tile_range(lat, lon, zoom, half_range)
+
+    # 只估算不下载（请求数 / 流量 / 时间 / 拼接内存），确认后改回 False
+    plan_only = False
+    if plan_only:
+        plan_download(tile_range, tile_db, output_image)
+        raise SystemExit
+
+    if METRICS_PORT:
+        metrics.serve(METRICS_PORT)
 
     # 步骤 2：下载瓦片
-    download_tiles(tile_range, tile_dir)
+    download_tiles(tile_range, tile_db)
 
     # 步骤 3：拼接成大图
-    stitch_tiles(tile_dir, output_image)
\ No newline at end of file
+    stitch_tiles(tile_db, output_image, zoom, tile_range)
+
+    # 步骤 4（可选）：由本层瓦片在本地生成更低的 zoom 层（不走网络）
+    pyramid_levels = 0
+    if pyramid_levels > 0:
+        pyramid.build_pyramid(tile_db, PROVIDER, zoom, pyramid_levels, tile_range)
+
+    # 下载 / 拼接各阶段指标（请求耗时分位数、流量、重试、缓存命中、解码 / 粘贴耗时、峰值内存）
+    metrics.report(f"./output/metrics_z{zoom}.json")
@@ -1,17 +1,26 @@
-import os
 import math
-import time
-import requests
-from PIL import Image
+
+import journal
+import metrics
+import tilestore
+# requests / NumPy / PIL 等重模块在用到的函数里才导入：只做估算（plan）时启动很快，import 时不做任何事
 
 # ========================
 # 配置：可以自己修改
 # ========================
 USER_AGENT = "MapTool/1.0 (yu.xia@tmdesign.ie)"
 OSM_TILE_URL = "https://tile.openstreetmap.org/{z}/{x}/{y}.png"
+PROVIDER = "osm"     # 瓦片库中的来源名
 
-DOWNLOAD_DELAY = 0.15
+RATE_LIMIT = 6       # 每个 host 每秒最多请求数（令牌桶限速）
+MAX_WORKERS = 2      # 并发下载线程数
 TIMEOUT = 10
+RETRIES = 4          # 每张瓦片最多尝试次数（429 / 5xx / 网络异常时指数退避重试）
+STREAMING_STITCH = True   # 流式拼接：逐行瓦片写 PNG，峰值内存只占一行瓦片（其他格式 / 预览先拼进磁盘画布）
+STITCH_PROCESSES = 1      # >1：多进程并行解码 + 粘贴（见 mosaic.py），瓦片很多时设成 CPU 核数
+INCREMENTAL_STITCH = False # True：只重写变了的瓦片（输出旁边保留索引和原始像素，见 patch.py）
+REFRESH = False      # True：库中已有瓦片发条件请求刷新（304 不动）；False：已有瓦片直接跳过
+METRICS_PORT = 0     # >0：运行期间在 http://127.0.0.1:端口/metrics 提供 Prometheus 指标
 
 
 # ========================
@@ -52,91 +61,72 @@ def calculate_tile_range_from_area(min_lat, min_lon, max_lat, max_lon, zoom):
 
 # ========================
 # 下载单张瓦片
+# 返回 (状态码, 内容, 附加信息)：200 / 304 → validators（304 时内容为 None）；失败 → 内容为 None + 原因
 # ========================
-def download_tile(x, y, z, save_path):
-    url = OSM_TILE_URL.format(z=z, x=x, y=y)
-    headers = {"User-Agent": USER_AGENT}
-
-    try:
-        r = requests.get(url, headers=headers, timeout=TIMEOUT)
-    except Exception as e:
-        print(f"[ERROR] {url} -> {e}")
-        return False
+def download_tile(x, y, z, validators=None):
+    import engine
 
-    if r.status_code == 200:
-        with open(save_path, "wb") as f:
-            f.write(r.content)
-        return True
-    else:
-        print(f"[WARN] HTTP {r.status_code}: {url}")
-        return False
+    return engine.fetch_tile(OSM_TILE_URL.format(z=z, x=x, y=y), rate=RATE_LIMIT, validators=validators,
+                             retries=RETRIES, headers={"User-Agent": USER_AGENT}, timeout=TIMEOUT)
 
 
 # ========================
-# 批量下载瓦片
+# 下载一批瓦片，结果记进任务日志
 # ========================
-def download_tiles(tile_range, output_dir):
-    os.makedirs(output_dir, exist_ok=True)
+def fetch_tiles(store, job_log, tiles, total=None):
+    import engine
 
-    z = tile_range["zoom"]
-    print(f"[INFO] 开始下载瓦片, zoom={z}")
+    engine.fetch_tiles(store, job_log, tiles, PROVIDER, download_tile, MAX_WORKERS, total, refresh=REFRESH)
 
-    for x in range(tile_range["min_x"], tile_range["max_x"] + 1):
-        for y in range(tile_range["min_y"], tile_range["max_y"] + 1):
-            save_name = f"{z}_{x}_{y}.png"
-            save_path = os.path.join(output_dir, save_name)
 
-            print(f"Downloading z={z} x={x} y={y}")
-            ok = download_tile(x, y, z, save_path)
-
-            if not ok:
-                print(f"[WARN] 缺失瓦片: {z}/{x}/{y}")
+# ========================
+# 批量下载瓦片（写入 MBTiles 瓦片库，可断点续传）
+# ========================
+def download_tiles(tile_range, tile_db, journal_path=None):
+    import engine
 
-            time.sleep(DOWNLOAD_DELAY)
+    print(f"[INFO] 开始下载瓦片, zoom={tile_range['zoom']}")
+    summary, journal_path = engine.download_job(tile_db, {"provider": PROVIDER, **tile_range}, fetch_tiles,
+                                                "png", journal_path)
 
-    print("[OK] 所有瓦片下载完成！")
+    if summary[journal.FAILED]:
+        print(f"[WARN] 仍有 {summary[journal.FAILED]} 张瓦片失败, 可用 resume('{journal_path}') 继续")
+    else:
+        print("[OK] 所有瓦片下载完成！")
+    return summary
 
 
 # ========================
-# 拼接瓦片为大图
+# 只估算不下载（dry run）
 # ========================
-def stitch_tiles(tile_folder, output_image):
-    tiles = [f for f in os.listdir(tile_folder) if f.endswith(".png")]
-    if not tiles:
-        raise ValueError("瓦片目录为空!!")
-
-    xs, ys = [], []
-    imgs = {}
-
-    for fn in tiles:
-        z, x, y = fn.replace(".png", "").split("_")
-        x, y = int(x), int(y)
-
-        img = Image.open(os.path.join(tile_folder, fn))
-        imgs[(x, y)] = img
-        xs.append(x)
-        ys.append(y)
+def plan_download(tile_range, tile_db, output_image=None, streaming=STREAMING_STITCH,
+                  processes=STITCH_PROCESSES, incremental=INCREMENTAL_STITCH):
+    """只估算不下载：请求数、流量、时间、已缓存瓦片数、拼接内存 / 磁盘"""
+    import plan
 
-    min_x, max_x = min(xs), max(xs)
-    min_y, max_y = min(ys), max(ys)
+    return plan.plan_tiles(tile_db, PROVIDER, [tile_range], RATE_LIMIT, MAX_WORKERS,
+                           output_image, streaming, processes, revalidate=REFRESH, incremental=incremental)
 
-    w, h = next(iter(imgs.values())).size
-    total_w = (max_x - min_x + 1) * w
-    total_h = (max_y - min_y + 1) * h
 
-    print(f"[INFO] 拼接图像大小: {total_w} x {total_h}")
+# ========================
+# 按任务日志继续中断的下载
+# ========================
+def resume(journal_path, tile_db):
+    job = journal.job_of(journal_path)
+    tile_range = {k: v for k, v in job.items() if k != "provider"}
+    return download_tiles(tile_range, tile_db, journal_path)
 
-    canvas = Image.new("RGB", (total_w, total_h))
 
-    for x in range(min_x, max_x + 1):
-        for y in range(min_y, max_y + 1):
-            if (x, y) in imgs:
-                px = (x - min_x) * w
-                py = (y - min_y) * h
-                canvas.paste(imgs[(x, y)], (px, py))
+# ========================
+# 拼接瓦片为大图（返回实际输出路径）
+# ========================
+def stitch_tiles(tile_db, output_image, zoom, tile_range=None, streaming=STREAMING_STITCH,
+                 processes=STITCH_PROCESSES, incremental=INCREMENTAL_STITCH):
+    import mosaic
 
-    os.makedirs(os.path.dirname(output_image), exist_ok=True)
-    canvas.save(output_image)
+    with tilestore.TileStore(tile_db) as store:
+        output_image = mosaic.stitch_store(store, PROVIDER, zoom, output_image, tile_range, streaming,
+                                           processes, incremental)
     print(f"[OK] 拼接完成 → {output_image}")
 
     return output_image
@@ -146,6 +136,8 @@ def stitch_tiles(tile_folder, output_image):
 # 主程序
 # ========================
 if __name__ == "__main__":
+    import aoi
+    import pyramid
 
     
     # 左下角 (bottom-left)
@@ -155,18 +147,43 @@ if __name__ == "__main__":
 
     zoom = 14 #地图缩放等级 13.14.15 =15
 
-    tile_dir = f"./tiles/z{zoom}"
+    # 可选：多边形 / 道路走廊（GeoJSON 或 WKT，字符串或文件路径），设置后代替上面的矩形
+    # 例如 AOI = "LINESTRING(-8.78 52.87, -8.77 52.96)", BUFFER_M = 100（走廊半宽，米）
+    AOI = None
+    BUFFER_M = 0
+
+    tile_db = "./tiles/tiles.mbtiles"   # 所有 zoom / 来源共用一个瓦片库
     output_image = f"./output/z{zoom}.png"
 
     # 计算瓦片范围（基于区域）
-    tile_range = calculate_tile_range_from_area(
-        MIN_LAT, MIN_LON,
-        MAX_LAT, MAX_LON,
-        zoom
-    )
+    if AOI is not None:
+        tile_range = aoi.aoi_job(AOI, zoom, BUFFER_M)
+    else:
+        tile_range = calculate_tile_range_from_area(
+            MIN_LAT, MIN_LON,
+            MAX_LAT, MAX_LON,
+            zoom
+        )
+
+    # 只估算不下载（请求数 / 流量 / 时间 / 拼接内存），确认后改回 False
+    plan_only = False
+    if plan_only:
+        plan_download(tile_range, tile_db, output_image)
+        raise SystemExit
+
+    if METRICS_PORT:
+        metrics.serve(METRICS_PORT)
 
     # 下载瓦片
-    download_tiles(tile_range, tile_dir)
+    download_tiles(tile_range, tile_db)
 
     # 拼接大图
-    stitch_tiles(tile_dir, output_image)
\ No newline at end of file
+    stitch_tiles(tile_db, output_image, zoom, tile_range)
+
+    # 低层级 zoom 由本层在本地生成（只有最深一层走网络）
+    pyramid_levels = 0
+    if pyramid_levels > 0:
+        pyramid.build_pyramid(tile_db, PROVIDER, zoom, pyramid_levels, tile_range)
+
+    # 下载 / 拼接各阶段指标（请求耗时分位数、流量、重试、缓存命中、解码 / 粘贴耗时、峰值内存）
+    metrics.report(f"./output/metrics_z{zoom}.json")
@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+"""
+增量拼接：刷新后大部分瓦片没变（304 / 内容相同）时，只重写变了的那部分，不再整幅重新拼接、重新编码
+
+- 输出旁边放两个附属文件：
+  {output}.index.json  每张瓦片的内容哈希（像素窗口由瓦片范围直接算出）；COG 还记每个块在文件里的偏移 / 长度
+  {output}.canvas/     原图和 COG 每级金字塔的原始像素（level0.raw、level1.raw ...，memmap）
+- 重跑时先拿库里的内容哈希和索引比对：
+  * 全部相同（且输出文件没被别的程序改过）→ 直接跳过
+  * 有变化 → 只解码变了的瓦片贴进画布；COG 只重新编码受影响的块（原图块 + 各级金字塔里盖住它的块），
+    其余块从旧文件原样拷贝，不解码也不重新压缩
+  * PNG 是一整个压缩流，只能整幅重新编码，但仍然只解码变了的瓦片
+- 范围 / zoom / 瓦片尺寸 / 压缩方式和索引对不上、附属文件缺失时自动完整拼接一次（同时建好索引）
+- 附属文件约等于未压缩像素大小（COG 再加约 1/3），用磁盘换每天刷新的时间
+
+  python cli.py stitch osm --bbox ... --zoom 17 --output output/site.tif --incremental
+"""
+
+import json
+import os
+import tempfile
+from collections import Counter
+from io import BytesIO
+
+import numpy as np
+
+import canvas
+import encode
+import geotiff
+import mercator
+import metrics
+import stitch
+import tracing
+from pyramid import downsample_box
+
+INDEX_VERSION = 1
+
+
+def index_path(output_image):
+    return output_image + ".index.json"
+
+
+def canvas_dir(output_image):
+    return output_image + ".canvas"
+
+
+def level_shapes(height, width, block):
+    """原图和各级金字塔的 (H, W)，同 geotiff.write_cog：每级 2× 缩小直到不超过一个块"""
+    shapes = [(height, width)]
+    while max(shapes[-1]) > block:
+        h, w = shapes[-1]
+        shapes.append(((h + 1) // 2, (w + 1) // 2))
+    return shapes
+
+
+def open_levels(folder, shapes, mode):
+    return [np.memmap(os.path.join(folder, f"level{i}.raw"), dtype=np.uint8, mode=mode, shape=(h, w, 3))
+            for i, (h, w) in enumerate(shapes)]
+
+
+# ========================
+# 索引
+# ========================
+def current_hashes(store, provider, zoom, bounds, wanted=None):
+    """库里范围内每张瓦片的 {(x, y): 内容哈希 hex}（只读哈希，不读瓦片数据）"""
+    min_x, max_x, min_y, max_y = bounds
+    hashes = {}
+    for y in range(min_y, max_y + 1):
+        for x, h in store.row_refs(provider, zoom, y, min_x, max_x).items():
+            if wanted is None or (x, y) in wanted:
+                hashes[(x, y)] = h.hex()
+    return hashes
+
+
+def output_stamp(output_image):
+    st = os.stat(output_image)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def load_index(output_image, params, shapes):
+    """参数一致、输出和画布都还在时返回索引，否则 None（需要完整拼接）"""
+    try:
+        with open(index_path(output_image), "r", encoding="utf-8") as f:
+            index = json.load(f)
+        if index.get("version") != INDEX_VERSION or index.get("params") != params:
+            return None
+        if index.get("output") != output_stamp(output_image):
+            return None   # 输出被删掉或被别的程序改过
+    except (OSError, ValueError):
+        return None
+    for i, (h, w) in enumerate(shapes):
+        path = os.path.join(canvas_dir(output_image), f"level{i}.raw")
+        if not os.path.exists(path) or os.path.getsize(path) != h * w * 3:
+            return None
+    return index
+
+
+def save_index(output_image, params, hashes, blocks):
+    index = {
+        "version": INDEX_VERSION,
+        "params": params,
+        "output": output_stamp(output_image),
+        "tiles": {f"{x},{y}": h for (x, y), h in hashes.items()},
+        "blocks": blocks,
+    }
+    tmp = index_path(output_image) + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(index, f)
+    os.replace(tmp, index_path(output_image))
+
+
+# ========================
+# 画布
+# ========================
+def paste_tiles(store, zoom, level0, keys, hashes, bounds, tile_size):
+    """把 keys 里的瓦片解码贴进原图画布（库里已经没有的清零），返回解码失败的 {(x, y)}"""
+    min_x, _, min_y, _ = bounds
+    tile_w, tile_h = tile_size
+    counts = Counter(hashes[k] for k in keys if k in hashes)
+    decoder = stitch.TileDecoder({h for h, n in counts.items() if n > 1})
+    failed = set()
+    for x, y in sorted(keys, key=lambda k: (k[1], k[0])):
+        window = level0[(y - min_y) * tile_h:(y - min_y + 1) * tile_h, (x - min_x) * tile_w:(x - min_x + 1) * tile_w]
+        h = hashes.get((x, y))
+        window[:] = 0
+        if h is None:
+            continue
+        try:
+            tile = np.asarray(decoder.get(h, lambda h=h: store.blob(bytes.fromhex(h))))
+        except Exception as e:
+            print(f"[WARN] 解码失败 z={zoom} x={x} y={y}: {e}")
+            failed.add((x, y))
+            continue
+        with metrics.timer("paste_seconds"):
+            window[:tile.shape[0], :tile.shape[1]] = tile[:tile_h, :tile_w]
+    decoder.report()
+    return failed
+
+
+def dirty_blocks(keys, bounds, tile_size, shapes, block):
+    """变了的瓦片 → 每层要重新编码的块 {层号: {(by, bx), ...}}；每缩小一级像素窗口坐标减半"""
+    min_x, _, min_y, _ = bounds
+    tile_w, tile_h = tile_size
+    dirty = {i: set() for i in range(len(shapes))}
+    for x, y in keys:
+        x0, y0 = (x - min_x) * tile_w, (y - min_y) * tile_h
+        x1, y1 = x0 + tile_w - 1, y0 + tile_h - 1
+        for i, (h, w) in enumerate(shapes):
+            r0, r1 = (y0 >> i) // block, min(y1 >> i, h - 1) // block
+            c0, c1 = (x0 >> i) // block, min(x1 >> i, w - 1) // block
+            dirty[i].update((by, bx) for by in range(r0, r1 + 1) for bx in range(c0, c1 + 1))
+    return dirty
+
+
+def all_blocks(shapes, block):
+    return {i: {(by, bx) for by in range(-(-h // block)) for bx in range(-(-w // block))}
+            for i, (h, w) in enumerate(shapes)}
+
+
+def downsample_block(src, dst, by, bx, block):
+    """由上一级重算 dst 的一个块；和 geotiff.downsample_level 结果一致（奇数边复制最后一行 / 列）"""
+    h, w = dst.shape[:2]
+    r0, c0 = by * block, bx * block
+    r1, c1 = min(r0 + block, h), min(c0 + block, w)
+    part = np.asarray(src[2 * r0:2 * r1, 2 * c0:2 * c1])
+    if part.shape[0] < 2 * (r1 - r0):
+        part = np.concatenate([part, part[-1:]], axis=0)
+    if part.shape[1] < 2 * (c1 - c0):
+        part = np.concatenate([part, part[:, -1:]], axis=1)
+    dst[r0:r1, c0:c1] = downsample_box(part)
+
+
+# ========================
+# 输出
+# ========================
+def write_cog(output_image, levels, dirty, old_blocks, top_left, resolution, compression, quality, block):
+    """
+    从最小的金字塔层到原图依次写块：dirty 里的重新编码，其余从旧文件原样拷贝；
+    写到临时文件后原子替换输出。返回 (各层 [绝对偏移列表, 长度列表], 重新编码的块数)
+    """
+    folder = os.path.dirname(os.path.abspath(output_image))
+    fd, spool_path = tempfile.mkstemp(suffix=".spool", prefix="cog_", dir=folder)
+    os.close(fd)
+    fd, tmp_path = tempfile.mkstemp(suffix=".tif", prefix="patch_", dir=folder)
+    os.close(fd)
+    old = open(output_image, "rb") if old_blocks else None
+    tiles = {}
+    encoded = 0
+    try:
+        with open(spool_path, "wb") as spool:
+            for i in range(len(levels) - 1, -1, -1):
+                h, w = levels[i].shape[:2]
+                offsets, counts = [], []
+                n = 0
+                for by in range(-(-h // block)):
+                    for bx in range(-(-w // block)):
+                        if old is None or (by, bx) in dirty[i]:
+                            tile = geotiff.pad_block(levels[i][by * block:(by + 1) * block,
+                                                               bx * block:(bx + 1) * block], block)
+                            data = geotiff.encode_tile(tile, compression, quality)
+                            encoded += 1
+                        else:
+                            old.seek(old_blocks[i][0][n])
+                            data = old.read(old_blocks[i][1][n])
+                        geotiff.spool_block(spool, data, offsets, counts)
+                        n += 1
+                tiles[i] = offsets, counts
+        start = geotiff.assemble(tmp_path, [level.shape[:2] for level in levels], tiles, spool_path,
+                                 top_left, resolution, compression, block)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    finally:
+        if old is not None:
+            old.close()
+        os.remove(spool_path)
+    os.replace(tmp_path, output_image)
+    return [[[start + o for o in tiles[i][0]], tiles[i][1]] for i in range(len(levels))], encoded
+
+
+def write_png(output_image, level0):
+    """整幅重新编码 PNG（按行分块读画布），写到临时文件后原子替换"""
+    height, width = level0.shape[:2]
+    tmp_path = output_image + ".tmp"
+    with encode.png_writer(tmp_path, width, height) as writer:
+        for y in range(0, height, canvas.CHUNK_ROWS):
+            writer.write_rows(level0[y:y + canvas.CHUNK_ROWS].tobytes())
+    os.replace(tmp_path, output_image)
+
+
+# ========================
+# 入口
+# ========================
+def stitch_incremental(store, provider, zoom, bounds, output_image, wanted=None,
+                       compression=geotiff.COMPRESSION, quality=geotiff.JPEG_QUALITY):
+    """
+    增量拼接 bounds = (min_x, max_x, min_y, max_y) 的瓦片，输出 .png 或 .tif / .tiff（COG）
+    wanted：只拼这些 (x, y)（AOI 稀疏瓦片集合）
+    返回 (重新贴入的瓦片数, 重新编码的块数)；没有变化时为 (0, 0)，PNG 整幅重新编码记 1 个块
+    """
+    cog = output_image.lower().endswith((".tif", ".tiff"))
+    if not cog and not output_image.lower().endswith(".png"):
+        raise ValueError("增量拼接只支持输出 PNG 或 GeoTIFF。")
+
+    min_x, max_x, min_y, max_y = bounds
+    hashes = current_hashes(store, provider, zoom, bounds, wanted)
+    if not hashes:
+        raise ValueError("范围内没有瓦片。")
+    tile_size = stitch.probe_tile_size(BytesIO(store.blob(bytes.fromhex(next(iter(hashes.values()))))))
+    width, height = (max_x - min_x + 1) * tile_size[0], (max_y - min_y + 1) * tile_size[1]
+    block = geotiff.TILE_SIZE
+    shapes = level_shapes(height, width, block) if cog else [(height, width)]
+    params = {"provider": provider, "zoom": zoom, "bounds": list(bounds), "tile_size": list(tile_size),
+              "format": "cog" if cog else "png",
+              "compression": compression if cog else None,
+              "quality": quality if cog and compression == "jpeg" else None}
+
+    folder = canvas_dir(output_image)
+    index = load_index(output_image, params, shapes) if os.path.exists(output_image) else None
+    if index is None:
+        print(f"[INFO] 增量拼接：没有可用的索引，完整拼接 {width} x {height}")
+        os.makedirs(folder, exist_ok=True)
+        canvas.check_disk_space(width, height, folder)
+        changed = set(hashes)
+        levels = open_levels(folder, shapes, "w+")
+    else:
+        old = {tuple(int(v) for v in k.split(",")): h for k, h in index["tiles"].items()}
+        changed = {k for k in set(hashes) | set(old) if hashes.get(k) != old.get(k)}
+        metrics.inc("incremental_tiles", len(hashes) - len(changed & set(hashes)), result="unchanged")
+        if not changed:
+            print(f"[OK] 瓦片没有变化，跳过拼接：{output_image}")
+            return 0, 0
+        print(f"[INFO] 增量拼接：{len(changed)} / {len(hashes)} 张瓦片有变化")
+        levels = open_levels(folder, shapes, "r+")
+    metrics.inc("incremental_tiles", len(changed), result="changed")
+
+    with tracing.span("incremental.paste", "stitch", tiles=len(changed)):
+        for key in paste_tiles(store, zoom, levels[0], changed, hashes, bounds, tile_size):
+            del hashes[key]   # 解码失败的不记哈希，下次重跑时再试
+
+    encoded = 1
+    blocks = None
+    if cog:
+        dirty = all_blocks(shapes, block) if index is None else dirty_blocks(changed, bounds, tile_size, shapes, block)
+        with tracing.span("incremental.overviews", "encode"):
+            for i in range(1, len(levels)):
+                for by, bx in dirty[i]:
+                    downsample_block(levels[i - 1], levels[i], by, bx, block)
+        with tracing.span("incremental.write", "encode", path=output_image) as info:
+            blocks, encoded = write_cog(output_image, levels, dirty, index and index["blocks"],
+                                        mercator.tile_top_left(min_x, min_y, zoom),
+                                        mercator.tile_resolution(zoom, tile_size[0]), compression, quality, block)
+            if info is not None:
+                info["encoded_blocks"] = encoded
+    else:
+        with tracing.span("png.save", "encode", path=output_image):
+            write_png(output_image, levels[0])
+    for level in levels:
+        level.flush()
+    save_index(output_image, params, hashes, blocks)
+
+    if cog:
+        total = sum(len(b) for b in all_blocks(shapes, block).values())
+        print(f"[OK] 增量拼接完成 → {output_image}（重新编码 {encoded} / {total} 个块）")
+    else:
+        print(f"[OK] 增量拼接完成 → {output_image}")
+    return len(changed), encoded
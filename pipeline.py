@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+"""
+分阶段流水线：下载 → 有界队列 → 解码线程池 → 有界队列 → 合成（调用方所在线程）
+
+  tasks ──engine.run（按 host 限速 + AIMD 并发）──▶ 原始字节队列 ──解码线程池──▶ 像素队列 ──▶ 贴进画布
+
+- 三段同时进行：网络等待时 CPU 在解码，解码时网络照样在下载（Pillow 解码时释放 GIL，线程池就够用）
+- 背压：两个队列都有上限。合成跟不上时解码线程阻塞在像素队列上，原始字节队列满了下载线程就不再提交新请求，
+  内存里最多 RAW_QUEUE 份原始字节 + PIXEL_QUEUE 张解码后的图，和任务总数无关
+- 各段被上 / 下游卡住的时间记进 pipeline_wait_seconds{stage=fetch|decode|composite}：
+  fetch 等得多 → 解码是瓶颈；decode 等得多 → 合成是瓶颈；composite 等得多 → 网络是瓶颈
+- run() 是生成器，用法同 engine.run：for task, result, img in pipeline.run(...): 画布.paste(img, ...)
+  go.py 的静态图拼接直接用它；瓦片来源（osm / apple）用 fetch_and_stitch()：库里已有的读库，
+  缺的下载（顺便写库），同时贴进磁盘画布，最后输出 COG 或 PNG / JPEG / WebP / RAW（encode.py）
+- 合成目标是随机访问的磁盘画布（canvas.MemmapCanvas），瓦片按完成顺序贴，不需要排序
+
+  python cli.py fetch osm --bbox ... --zoom 16 --output output/z16.tif --pipeline
+"""
+
+import os
+import queue
+import threading
+import time
+from contextlib import closing
+from io import BytesIO
+
+import metrics
+
+RAW_QUEUE = 64       # 已下载、待解码的原始字节最多这么多份
+PIXEL_QUEUE = 32     # 已解码、待合成的图最多这么多张
+DECODE_WORKERS = max(1, min(4, (os.cpu_count() or 2) - 1))   # 解码线程数（留一个核给合成）
+POLL = 0.1           # 等队列时检查取消的间隔（秒）
+
+_DONE = object()
+
+
+def decode_image(data):
+    """原始字节 → RGB PIL Image（在解码线程里完整解码，合成时不再有惰性解码）；None 原样返回"""
+    if data is None:
+        return None
+    from PIL import Image
+    with Image.open(BytesIO(data)) as src:
+        return src.convert("RGB")
+
+
+def download_tile(src, z, x, y, validators=None, access_key=None):
+    """各来源 download_tile 的参数顺序不同，这里统一成 (z, x, y)；返回 (状态码, 内容, 附加信息)"""
+    if src.__name__ == "jim":
+        return src.download_tile(z, x, y, access_key or src.ACCESS_KEY, validators)
+    return src.download_tile(x, y, z, validators)
+
+
+# ========================
+# 流水线
+# ========================
+def run(tasks, fetch, decode=decode_image, fetch_workers=4, decode_workers=DECODE_WORKERS,
+        raw_queue=RAW_QUEUE, pixel_queue=PIXEL_QUEUE):
+    """
+    对每个 task（元组）：fetch(*task) → result（下载线程池）→ decode(result) → img（解码线程池），
+    按完成顺序 yield (task, result, img)；fetch 异常时 result 为 None，解码失败时 img 为 None。
+    调用方提前退出循环时各线程停止（已在途的请求会等它结束）。
+    """
+    import engine
+
+    raw = queue.Queue(raw_queue)
+    pixels = queue.Queue(pixel_queue)
+    stop = threading.Event()
+    errors = []
+
+    def put(q, item, stage):
+        t0 = time.perf_counter()
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=POLL)
+                break
+            except queue.Full:
+                pass
+        metrics.observe("pipeline_wait_seconds", time.perf_counter() - t0, metrics.STAGE_BUCKETS, stage=stage)
+
+    def fetcher():
+        try:
+            with closing(engine.run(tasks, fetch, fetch_workers)) as results:
+                for task, result in results:
+                    put(raw, (task, result), "fetch")
+                    if stop.is_set():
+                        return
+        except Exception as e:   # tasks 生成器本身出错：交给调用方线程抛出
+            errors.append(e)
+        finally:
+            for _ in range(decode_workers):
+                put(raw, _DONE, "fetch")
+
+    def decoder():
+        while not stop.is_set():
+            try:
+                item = raw.get(timeout=POLL)
+            except queue.Empty:
+                continue
+            if item is _DONE:
+                break
+            task, result = item
+            try:
+                with metrics.timer("decode_seconds"):
+                    img = decode(result)
+            except Exception as e:
+                print(f"[WARN] 解码失败 {task}: {e}")
+                img = None
+            put(pixels, (task, result, img), "decode")
+        put(pixels, _DONE, "decode")
+
+    threads = [threading.Thread(target=fetcher, name="pipeline-fetch", daemon=True)]
+    threads += [threading.Thread(target=decoder, name=f"pipeline-decode-{i}", daemon=True)
+                for i in range(decode_workers)]
+    for t in threads:
+        t.start()
+    try:
+        finished = 0
+        while finished < decode_workers:
+            t0 = time.perf_counter()
+            item = pixels.get()
+            metrics.observe("pipeline_wait_seconds", time.perf_counter() - t0, metrics.STAGE_BUCKETS,
+                            stage="composite")
+            if item is _DONE:
+                finished += 1
+                continue
+            yield item
+        if errors:
+            raise errors[0]
+    finally:
+        stop.set()
+        for t in threads:
+            t.join()
+
+
+# ========================
+# 瓦片来源：边下载边拼接
+# ========================
+def fetch_and_stitch(src, tile_db, job, output_image, refresh=False, access_key=None):
+    """
+    osm / apple：job 范围内的瓦片边下载边拼接，输出 .tif / .tiff（COG）或 encode.py 支持的格式
+    * 库里已有的瓦片直接读库（refresh 时发条件请求，304 读库），新下载的写库（写库只在本线程）
+    * 失败的瓦片留黑，之后重跑只会下载这些
+    返回 {"ok": 张数, "failed": 张数, "cached": 张数}
+    """
+    import aoi
+    import cache
+    import canvas
+    import encode
+    import geotiff
+    import mercator
+    import tilestore
+
+    if not output_image.lower().endswith((".tif", ".tiff")):
+        encode.format_of(output_image)   # 不支持的格式在下载前就报错
+    provider = src.PROVIDER
+    zoom, min_x, max_x, min_y, max_y = job["zoom"], job["min_x"], job["max_x"], job["min_y"], job["max_y"]
+    folder = os.path.dirname(os.path.abspath(output_image))
+    os.makedirs(folder, exist_ok=True)
+    summary = {"ok": 0, "failed": 0, "cached": 0}
+
+    with tilestore.TileStore(tile_db) as store:
+        with cache.pinned(store, provider, job):   # 下载 + 拼接期间这些瓦片不会被淘汰
+            store.set_metadata(name="imagetool")
+            cached = store.keys_in_range(provider, zoom, min_x, max_x, min_y, max_y)
+            local = threading.local()
+
+            def reader():
+                # 下载线程各自只读打开瓦片库（SQLite 连接不能跨线程），线程结束时随之关闭
+                ro = getattr(local, "store", None)
+                if ro is None:
+                    ro = local.store = tilestore.TileStore(tile_db, readonly=True)
+                return ro
+
+            def fetch(z, x, y):
+                if (x, y) in cached and not refresh:
+                    return "cached", reader().get(provider, z, x, y), None
+                validators = reader().validators(provider, z, x, y) if (x, y) in cached else None
+                status, content, info = download_tile(src, z, x, y, validators, access_key)
+                if status == 304:
+                    return "cached", reader().get(provider, z, x, y), info or {}
+                return status, content, info
+
+            def decode(result):
+                return decode_image(result[1]) if result else None
+
+            mosaic = None
+            progress = metrics.Progress(aoi.tile_count(job), label="下载+拼接")
+            for (z, x, y), result, img in run(aoi.job_tiles(job), fetch, decode, src.MAX_WORKERS):
+                status, content, info = result or (None, None, "下载线程异常")
+                if status == 200 and content is not None:
+                    store.put(provider, z, x, y, content, **info)
+                elif status == "cached":
+                    # 记访问时间（读是在只读连接上做的）；304 重新验证过的还要刷新下载时间，TTL 不会误删
+                    store.touch(provider, z, x, y, info)
+                if img is None:
+                    print(f"[WARN] 跳过缺失瓦片：z={z} x={x} y={y}（{info}）")
+                    summary["failed"] += 1
+                    progress.update(ok=False)
+                    continue
+                summary["cached" if status == "cached" else "ok"] += 1
+                progress.update()
+
+                if mosaic is None:
+                    tile_w, tile_h = img.size
+                    width, height = (max_x - min_x + 1) * tile_w, (max_y - min_y + 1) * tile_h
+                    canvas.check_disk_space(width, height, folder)
+                    print(f"[INFO] 拼接大图尺寸：{width} x {height}")
+                    mosaic = canvas.MemmapCanvas(width, height, folder=folder)
+                with metrics.timer("paste_seconds"):
+                    mosaic.paste(img, ((x - min_x) * tile_w, (y - min_y) * tile_h))
+            progress.close()
+
+            if mosaic is None:
+                raise ValueError("范围内没有可用的瓦片。")
+            try:
+                if output_image.lower().endswith((".tif", ".tiff")):
+                    # 卫星图本身是 JPEG，COG 也用 JPEG 压缩
+                    geotiff.write_cog(output_image, mosaic.array, mercator.tile_top_left(min_x, min_y, zoom),
+                                      mercator.tile_resolution(zoom, tile_w),
+                                      compression="jpeg" if src.__name__ == "jim" else "deflate")
+                else:
+                    output_image = mosaic.save(output_image)
+            finally:
+                mosaic.close()
+        cache.enforce(store)
+
+    print(f"[OK] 拼接完成 → {output_image}（新下载 {summary['ok']}，读库 {summary['cached']}，"
+          f"失败 {summary['failed']}）")
+    return summary
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""
+只估算不下载（dry run）：大任务开跑前先看要花多少请求、流量、时间、内存和磁盘
+
+- 每个 zoom 的瓦片数 / 请求数，其中多少已经在瓦片库里
+- 流量 = 要下载的瓦片数 × 该来源已缓存瓦片的平均大小（库里没有时用 DEFAULT_TILE_BYTES）
+- 时间 = 按 host 令牌桶限速和线程数估算：max(请求数 / 速率, 请求数 × 单次耗时 / 线程数)
+- 拼接：按所选拼接方式估算峰值内存和临时磁盘
+- 只依赖 sqlite 和标准库（AOI 任务才加载 NumPy），命令行 plan 启动只要几十毫秒
+"""
+
+import os
+import shutil
+
+import canvas
+import tilestore
+from metrics import fmt_bytes, fmt_time
+
+LATENCY = 0.3            # 单次请求的平均耗时估计（秒）
+REVALIDATE_BYTES = 300   # 条件请求 304 只有响应头，按这么多字节估
+
+# 库里还没有该来源的瓦片时用的平均瓦片大小（字节）
+DEFAULT_TILE_BYTES = {
+    "osm": 15_000,
+    "apple-sat": 25_000,
+    "google-static": 900_000,   # 1280×1280 卫星图
+}
+FALLBACK_TILE_BYTES = 20_000
+
+
+# ========================
+# 成本模型
+# ========================
+def mean_tile_bytes(store, provider):
+    """(平均瓦片字节数, 是否来自实测)"""
+    count, mean = store.tile_stats(provider)
+    if count and mean:
+        return mean, True
+    return DEFAULT_TILE_BYTES.get(provider, FALLBACK_TILE_BYTES), False
+
+
+def wall_time(requests, rate, workers, latency=LATENCY):
+    """令牌桶限速 和 线程数 × 单次耗时 两个瓶颈取较慢的一个"""
+    if requests <= 0:
+        return 0.0
+    return max(requests / rate, requests * latency / max(workers, 1))
+
+
+def stitch_backend(output_image, streaming=True, processes=1, incremental=False):
+    """
+    拼接方式名（mosaic.stitch_store 按它分派，估算和实际走的是同一条分支）
+    - incremental：patch.py，输出旁边常驻原始像素画布
+    - parallel / memmap：磁盘共享画布，多进程 / 单进程（流式拼接但格式要整幅编码：JPEG / WebP / RAW / 预览）
+    - cog / streaming / memory：COG、逐行写 PNG、整幅放内存
+    """
+    import encode   # 预览开关在 encode.PREVIEW（命令行 --preview），只在估算拼接时才加载
+
+    tiff = output_image.lower().endswith((".tif", ".tiff"))
+    if incremental:
+        return "incremental"
+    if processes > 1:
+        return "parallel"
+    if streaming and not tiff and not encode.streamable(output_image):
+        return "memmap"
+    if tiff:
+        return "cog"
+    if streaming:
+        return "streaming"
+    return "memory"
+
+
+def stitch_cost(width, height, tile_size, backend, processes=1):
+    """
+    拼接的 (峰值内存, 临时磁盘) 字节数估计
+    - memory：PIL 的 RGB 图像内部每像素 4 字节，整幅放内存
+    - streaming：一行瓦片的条带 + 加滤波字节后的拷贝
+    - memmap / parallel / cog：磁盘 memmap 画布（页缓存由系统回收，不算进内存）+ 每进程一张瓦片 + 写出时的分块
+    - incremental：常驻在输出旁边的原始像素画布（COG 再加各级金字塔约 1/3），不是临时文件但同样占磁盘
+    """
+    tile_w, tile_h = tile_size
+    tile_bytes = tile_w * tile_h * 4
+    if backend == "memory":
+        return width * height * 4, 0
+    if backend == "streaming":
+        return width * tile_h * 3 * 2 + tile_bytes, 0
+    if backend in ("memmap", "parallel"):
+        ram = processes * tile_bytes + canvas.CHUNK_ROWS * width * 3 * 2
+        return ram, canvas.required_bytes(width, height)
+    if backend == "cog":
+        import geotiff
+        # 画布 + 各级金字塔（合计约 1/3）+ 压缩后的块数据暂存
+        disk = width * height * 3 * 4 // 3 + width * height * 3 // 2
+        return tile_bytes + geotiff.CHUNK_ROWS * width * 3 * 2, disk
+    if backend == "incremental":
+        return tile_bytes + canvas.CHUNK_ROWS * width * 3 * 2, width * height * 3 * 4 // 3
+    raise ValueError(f"未知的拼接方式：{backend}")
+
+
+# ========================
+# 瓦片任务
+# ========================
+def plan_tiles(tile_db, provider, jobs, rate, workers, output_image=None, streaming=True,
+               processes=1, revalidate=False, latency=LATENCY, incremental=False):
+    """
+    jobs：tile_range 列表（每个带 zoom，可以是 AOI 任务），一个 zoom 一个
+    revalidate=True：已缓存的瓦片也发条件请求（各来源的 REFRESH / --refresh）；False：已缓存直接跳过
+    output_image：给出时按最深一层估算拼接成本
+    返回汇总 dict（同时打印 [PLAN] 报告）
+    """
+    rows = []
+    exists = os.path.exists(tile_db)   # 库还不存在时用空的内存库，不在磁盘上建文件
+    with tilestore.TileStore(tile_db if exists else ":memory:", readonly=exists) as store:
+        mean, measured = mean_tile_bytes(store, provider)
+        first = None
+        for job in jobs:
+            z = job["zoom"]
+            bounds = (job["min_x"], job["max_x"], job["min_y"], job["max_y"])
+            wanted = None
+            if job.get("aoi") is not None:
+                import aoi
+                wanted = aoi.tile_set(job)
+            total = len(wanted) if wanted is not None else \
+                (bounds[1] - bounds[0] + 1) * (bounds[3] - bounds[2] + 1)
+            cached_keys = store.keys_in_range(provider, z, *bounds)
+            cached = len(cached_keys & wanted) if wanted is not None else len(cached_keys)
+            rows.append((z, total, cached, bounds))
+            if first is None:
+                first = next(store.tiles_in_range(provider, z, *bounds), None)
+
+        tile_size = (256, 256)
+        if first is not None:
+            tile_size = tilestore.image_size(first[2]) or tile_size
+
+    print(f"[PLAN] 来源 {provider}，瓦片库 {tile_db}")
+    print(f"[PLAN] 平均瓦片大小 {fmt_bytes(mean)}（{'库中实测' if measured else '默认值，库里还没有该来源的瓦片'}）")
+
+    total_requests = total_bytes = 0
+    for z, total, cached, bounds in rows:
+        missing = total - cached
+        requests = total if revalidate else missing
+        transfer = missing * mean + (cached * REVALIDATE_BYTES if revalidate else 0)
+        total_requests += requests
+        total_bytes += transfer
+        print(f"[PLAN] z={z}: {total} 张瓦片（x {bounds[0]}→{bounds[1]}，y {bounds[2]}→{bounds[3]}），"
+              f"已缓存 {cached}，请求 {requests}，约 {fmt_bytes(transfer)}")
+
+    seconds = wall_time(total_requests, rate, workers, latency)
+    print(f"[PLAN] 合计请求 {total_requests}，下载约 {fmt_bytes(total_bytes)}，"
+          f"预计 {fmt_time(seconds)}（{rate}/s 限速，{workers} 线程，单次约 {latency}s）")
+
+    result = {"provider": provider, "requests": total_requests, "bytes": total_bytes, "seconds": seconds,
+              "zooms": [{"zoom": z, "tiles": t, "cached": c} for z, t, c, _ in rows]}
+
+    if output_image and rows:
+        z, total, _, (min_x, max_x, min_y, max_y) = max(rows)
+        width = (max_x - min_x + 1) * tile_size[0]
+        height = (max_y - min_y + 1) * tile_size[1]
+        backend = stitch_backend(output_image, streaming, processes, incremental)
+        ram, disk = stitch_cost(width, height, tile_size, backend, processes)
+        output_bytes = total * mean
+        print(f"[PLAN] 拼接 z={z}：{width} x {height}（{backend}），峰值内存约 {fmt_bytes(ram)}，"
+              f"临时磁盘约 {fmt_bytes(disk)}，输出约 {fmt_bytes(output_bytes)}")
+        free = os.path.dirname(os.path.abspath(output_image))
+        while not os.path.isdir(free):
+            free = os.path.dirname(free)
+        free_bytes = shutil.disk_usage(free).free
+        if disk + output_bytes > free_bytes:
+            print(f"[WARN] 磁盘剩余 {fmt_bytes(free_bytes)}，不够拼接")
+        result.update(width=width, height=height, backend=backend, ram=ram, disk=disk)
+
+    return result
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+本地生成低层级金字塔：只下载最高 zoom，z-1 … z-k 由 2×2 子瓦片缩小得到
+
+- 每张父瓦片 = 4 张子瓦片拼成 2 倍大小后缩小一半
+  * 'box'：NumPy 向量化 2×2 平均（最快）
+  * 'lanczos'：PIL Lanczos 重采样（更锐利）
+- 一行父瓦片是一个任务，交给进程池并行处理；同时在途的行数有上限，内存不随范围增长
+- 结果写回同一个瓦片库（同一 provider），下载多层级任务时只有最深一层走网络
+- 只生成 4 张子瓦片都在的父瓦片（任务范围外的子瓦片留黑）；范围内缺子瓦片时跳过，不写半黑的瓦片
+- 库里已有的父瓦片（比如下载过的）默认不覆盖，overwrite=True 时才重新生成
+- 子瓦片是 JPEG（卫星图）时父瓦片也存 JPEG，否则存 PNG
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+import stitch
+import tilestore
+
+JPEG_QUALITY = 90
+MAX_PROCESSES = os.cpu_count() or 1
+
+
+# ========================
+# 子进程：一行父瓦片
+# ========================
+def downsample_box(pixels):
+    """(2h, 2w, 3) uint8 → (h, w, 3)，2×2 平均（四舍五入）"""
+    h, w = pixels.shape[0] // 2, pixels.shape[1] // 2
+    blocks = pixels[:h * 2, :w * 2].reshape(h, 2, w, 2, 3).astype(np.uint16)
+    return ((blocks.sum(axis=(1, 3)) + 2) >> 2).astype(np.uint8)
+
+
+def build_parent_row(row, tile_size, method):
+    """
+    row：[(px, [左上, 右上, 左下, 右下] 子瓦片字节或 None), ...]
+    返回 [(px, 父瓦片字节), ...]
+    """
+    w, h = tile_size
+    results = []
+    for px, children in row:
+        big = np.zeros((h * 2, w * 2, 3), dtype=np.uint8)
+        fmt = "png"
+        for i, data in enumerate(children):
+            if data is None:
+                continue
+            if tilestore.detect_format(data) == "jpg":
+                fmt = "jpg"
+            with Image.open(BytesIO(data)) as img:
+                ox, oy = (i % 2) * w, (i // 2) * h
+                big[oy:oy + h, ox:ox + w] = np.asarray(img.convert("RGB"))
+
+        if method == "lanczos":
+            small = Image.fromarray(big).resize((w, h), Image.LANCZOS)
+        else:
+            small = Image.fromarray(downsample_box(big))
+
+        buf = BytesIO()
+        if fmt == "jpg":
+            small.save(buf, "JPEG", quality=JPEG_QUALITY)
+        else:
+            small.save(buf, "PNG")
+        results.append((px, buf.getvalue()))
+    return results
+
+
+# ========================
+# 主进程：逐层生成
+# ========================
+def build_level(store, provider, child_z, bounds, method="box", processes=MAX_PROCESSES,
+                covered=None, overwrite=False):
+    """
+    由 child_z 层生成 child_z - 1 层
+    covered：child_z 层任务覆盖的 {(x, y), ...}（AOI 任务），None 表示 bounds 整个矩形
+    overwrite：库里已有的父瓦片也重新生成（默认保留，不覆盖下载来的瓦片）
+    返回 (父层范围 (min_x, max_x, min_y, max_y), 父层覆盖的瓦片集合或 None)
+    """
+    min_x, max_x, min_y, max_y = bounds
+    pmin_x, pmax_x = min_x // 2, max_x // 2
+    pmin_y, pmax_y = min_y // 2, max_y // 2
+    z = child_z - 1
+    skipped = {"existing": 0, "incomplete": 0}
+
+    def inside(x, y):
+        if covered is not None:
+            return (x, y) in covered
+        return min_x <= x <= max_x and min_y <= y <= max_y
+
+    tile_size = stitch.store_tile_size(store, provider, child_z, bounds)
+
+    def rows():
+        for py in range(pmin_y, pmax_y + 1):
+            children = {(x, y): d for x, y, d in store.tiles_in_range(
+                provider, child_z, pmin_x * 2, pmax_x * 2 + 1, py * 2, py * 2 + 1)}
+            existing = set() if overwrite else store.keys_in_range(provider, z, pmin_x, pmax_x, py, py)
+            row = []
+            for px in range(pmin_x, pmax_x + 1):
+                keys = [(px * 2 + dx, py * 2 + dy) for dy in (0, 1) for dx in (0, 1)]
+                if not any(inside(x, y) for x, y in keys):
+                    continue
+                if (px, py) in existing:
+                    skipped["existing"] += 1
+                    continue
+                quad = [children.get(key) for key in keys]
+                # 范围内的子瓦片缺了（下载失败 / 还没下）：不生成，免得半黑的瓦片顶替真实的父瓦片
+                if any(d is None and inside(*key) for key, d in zip(keys, quad)):
+                    skipped["incomplete"] += 1
+                    continue
+                row.append((px, quad))
+            if row:
+                yield py, row
+
+    print(f"[INFO] 生成 z={z}：x {pmin_x}→{pmax_x}，y {pmin_y}→{pmax_y}（{method}，{processes} 进程）")
+
+    count = 0
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        pending = {}
+        source = rows()
+        limit = processes * 2
+
+        def fill():
+            while len(pending) < limit:
+                item = next(source, None)
+                if item is None:
+                    return
+                py, row = item
+                pending[pool.submit(build_parent_row, row, tile_size, method)] = py
+
+        fill()
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                py = pending.pop(fut)
+                for px, data in fut.result():
+                    store.put(provider, z, px, py, data)
+                    count += 1
+            fill()
+
+    store.flush()
+    print(f"[OK] z={z} 完成，{count} 张瓦片")
+    if skipped["existing"]:
+        print(f"[INFO] z={z}：{skipped['existing']} 张父瓦片库里已有，保留不覆盖（需要重新生成时用 overwrite）")
+    if skipped["incomplete"]:
+        print(f"[WARN] z={z}：{skipped['incomplete']} 张父瓦片缺子瓦片，未生成（补齐 z={child_z} 后重跑）")
+    parents = None if covered is None else {(x // 2, y // 2) for x, y in covered}
+    return (pmin_x, pmax_x, pmin_y, pmax_y), parents
+
+
+def build_pyramid(tile_db, provider, max_zoom, levels, tile_range=None, method="box",
+                  processes=MAX_PROCESSES, overwrite=False):
+    """
+    从 max_zoom 层生成 max_zoom-1 … max_zoom-levels 层
+    tile_range 为空时使用库中 max_zoom 层的全部瓦片范围；AOI 任务只要求 AOI 覆盖的子瓦片齐全
+    overwrite：库里已有的父瓦片也重新生成
+    """
+    import aoi
+
+    if method not in ("box", "lanczos"):
+        raise ValueError("method 只能是 'box' 或 'lanczos'")
+
+    with tilestore.TileStore(tile_db) as store:
+        if tile_range is None:
+            bounds = store.bounds(provider, max_zoom)
+            if bounds is None:
+                raise ValueError(f"瓦片库中没有 {provider} z={max_zoom} 的瓦片")
+        else:
+            bounds = (tile_range["min_x"], tile_range["max_x"], tile_range["min_y"], tile_range["max_y"])
+        covered = aoi.tile_set(tile_range)
+
+        for child_z in range(max_zoom, max(max_zoom - levels, 0), -1):
+            bounds, covered = build_level(store, provider, child_z, bounds, method, processes, covered, overwrite)
+
+
+# ========================
+# 主程序
+# ========================
+if __name__ == "__main__":
+    TILE_DB = "./tiles/tiles.mbtiles"
+    PROVIDER = "osm"
+    MAX_ZOOM = 15      # 已下载的最高层
+    LEVELS = 3         # 生成 z14 / z13 / z12
+
+    build_pyramid(TILE_DB, PROVIDER, MAX_ZOOM, LEVELS, method="box")
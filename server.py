@@ -0,0 +1,359 @@
+# -*- coding: utf-8 -*-
+"""
+本地 XYZ 瓦片服务：overview.html / ampa.html 的底图和下载都走这里，不再在浏览器里直连来源、拼大 canvas
+
+  GET /{source}/{z}/{x}/{y}[.png|.jpg]     从瓦片库取；库里没有时经限速下载器取回、写库再返回
+                                           （source 为 osm / apple；apple 可带 ?accessKey=…）
+  GET /mosaic?source=osm&zoom=15&bbox=min_lon,min_lat,max_lon,max_lat[&aoi=WKT&buffer=50][&format=png|tif]
+                                           服务端下载缺失瓦片 + 拼接；Accept: text/event-stream（EventSource）时
+                                           用 SSE 推送进度（progress / stage / done / error 事件），done 里给出结果地址，
+                                           否则拼完直接返回图片
+  GET /result/<name>                       /mosaic 拼好的图（?download=1 时作为附件下载）
+  GET /metrics                             Prometheus 指标
+  GET /health                              可用来源 + apple 瓦片参数（jim.py 配置区的 style / size / scale / version）
+  GET /overview.html、/ampa.html           页面本身（同源打开，不用担心 CORS）
+
+- 同一张瓦片同时被多次请求（浏览器底图 + 下载任务）时只下载一次
+- 每个请求线程一个 SQLite 连接；WAL 模式下读不阻塞，缺失瓦片写入即提交
+- 只监听本机（HOST），局域网共享时改成 0.0.0.0
+
+  python cli.py serve --port 8765
+"""
+
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from concurrent.futures import Future
+from urllib.parse import parse_qs, urlsplit
+
+import cache as cache_
+import metrics
+import pipeline
+import sources
+import tilestore
+
+HOST = "127.0.0.1"
+PORT = 8765
+TILE_DB = sources.DEFAULT_DB
+OUTPUT_DIR = "output/server"     # /mosaic 的结果
+RESULT_MAX_AGE = 3600            # /mosaic 结果保留的秒数，过期的在下一次拼接前删掉
+RESULT_MAX_COUNT = 20            # 最多保留多少个结果（超出时先删最旧的）
+MAX_MOSAIC_TILES = 40_000        # 单次 /mosaic 最多多少张瓦片（约 51200 × 51200 像素）
+TILE_MAX_AGE = 86400             # 浏览器缓存瓦片的秒数
+KEEPALIVE = 5                    # 拼接期间每隔几秒发一条 SSE 注释，防止代理断开
+PAGES = ("overview.html", "ampa.html")
+CONTENT_TYPES = {"png": "image/png", "jpg": "image/jpeg", "webp": "image/webp", "gif": "image/gif",
+                 "tif": "image/tiff"}
+
+
+# ========================
+# 瓦片缓存
+# ========================
+class TileCache:
+    """服务端共享的瓦片库：每个线程一个连接，缺失的瓦片同一时刻只下载一次"""
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.inflight = {}
+        tilestore.TileStore(path).close()   # 先建好库，后面各线程直接打开
+
+    def store(self):
+        store = getattr(self.local, "store", None)
+        if store is None:
+            store = self.local.store = tilestore.TileStore(self.path, batch_size=1)
+        return store
+
+    def get(self, src, z, x, y, access_key=None):
+        """(状态码, 内容)：库里有直接返回；没有时下载（并发请求同一张瓦片的线程等同一个结果）"""
+        data = self.store().get(src.PROVIDER, z, x, y)
+        if data is not None:
+            metrics.inc("served_tiles", result="hit")
+            return 200, data
+
+        key = (src.PROVIDER, z, x, y)
+        with self.lock:
+            future = self.inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self.inflight[key] = Future()
+        if not owner:
+            return future.result()
+
+        try:
+            status, content, info = pipeline.download_tile(src, z, x, y, access_key=access_key)
+            if status == 200 and content is not None:
+                self.store().put(src.PROVIDER, z, x, y, content, **info)
+                result = 200, content
+            else:
+                result = (status if status in (403, 404) else 502), None
+            metrics.inc("served_tiles", result="miss" if result[1] is not None else "error")
+            future.set_result(result)
+            return result
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                self.inflight.pop(key, None)
+
+
+# ========================
+# 服务端拼接
+# ========================
+def mosaic(cache, source, zoom, bbox=None, aoi=None, buffer=0, fmt="png", access_key=None, emit=print):
+    """下载缺失瓦片 + 拼接；进度通过 emit(事件名, dict) 报告，返回结果文件名"""
+    import aoi as aoi_
+    import engine
+
+    src = sources.load_source(source)
+    job = sources.tile_range(zoom, bbox=bbox, aoi=aoi, buffer=buffer)
+    count = aoi_.tile_count(job)
+    if count > MAX_MOSAIC_TILES:
+        raise ValueError(f"范围太大：{count} 张瓦片（上限 {MAX_MOSAIC_TILES}），请缩小范围或降低 zoom")
+    tiles = list(aoi_.job_tiles(job))
+
+    store = cache.store()
+    with cache_.pinned(store, src.PROVIDER, job):   # 下载 + 拼接期间这些瓦片不会被淘汰
+        cached = store.keys_in_range(src.PROVIDER, zoom, job["min_x"], job["max_x"], job["min_y"], job["max_y"])
+        missing = [(z, x, y) for z, x, y in tiles if (x, y) not in cached]
+        emit("stage", {"stage": "fetch", "tiles": len(tiles), "cached": len(tiles) - len(missing)})
+
+        done = failed = 0
+        last = 0.0
+        tasks = ((cache, src, z, x, y, access_key) for z, x, y in missing)
+        for _, result in engine.run(tasks, lambda c, *a: c.get(*a), src.MAX_WORKERS):
+            done += 1
+            failed += result is None or result[1] is None
+            now = time.monotonic()
+            if now - last >= 0.2 or done == len(missing):
+                emit("progress", {"done": done, "total": len(missing), "failed": failed})
+                last = now
+
+        emit("stage", {"stage": "stitch", "failed": failed})
+        os.makedirs(OUTPUT_DIR, exist_ok=True)
+        expire_results()
+        name = f"{source}_z{zoom}_{uuid.uuid4().hex[:8]}.{fmt}"
+        output = os.path.join(OUTPUT_DIR, name)
+        if src.__name__ == "jim":
+            output = src.stitch_tiles({"provider": src.PROVIDER, **job}, output, tile_db=cache.path)
+        else:
+            output = src.stitch_tiles(cache.path, output, zoom, job, True, 1)
+    cache_.enforce(store)
+    return os.path.basename(output)
+
+
+def expire_results():
+    """删掉 OUTPUT_DIR 里超过 RESULT_MAX_AGE 的结果；剩下的超过 RESULT_MAX_COUNT 个时从最旧的删起（给新结果留一个位置）"""
+    now = time.time()
+    results = []
+    for entry in os.scandir(OUTPUT_DIR):
+        if entry.is_file():
+            results.append((entry.stat().st_mtime, entry.path))
+    results.sort(reverse=True)
+    for i, (mtime, path) in enumerate(results):
+        if now - mtime > RESULT_MAX_AGE or i >= RESULT_MAX_COUNT - 1:
+            try:
+                os.remove(path)
+            except OSError:
+                pass   # 可能正被 /result 读着（Windows），下次再删
+
+
+def health():
+    """/health：可用来源；apple 瓦片按 jim.py 配置区的参数下载，页面据此显示（不能逐请求修改）"""
+    jim = sources.load_source("apple")
+    return {"sources": list(sources.SOURCES),
+            "apple": {"style": jim.APPLE_TILE_STYLE, "size": jim.APPLE_TILE_SIZE_PARAM,
+                      "scale": jim.APPLE_TILE_SCALE, "version": jim.APPLE_TILE_VERSION}}
+
+
+# ========================
+# HTTP
+# ========================
+def make_handler(cache, access_key=None):
+    from http.server import BaseHTTPRequestHandler
+
+    here = os.path.dirname(os.path.abspath(__file__))
+
+    class TileHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def send_body(self, body, ctype, status=200, headers=()):
+            self.send_response(status)
+            self.send_header("Content-Type", ctype)
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("Access-Control-Allow-Origin", "*")
+            for k, v in headers:
+                self.send_header(k, v)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def fail(self, status, message):
+            self.send_body(json.dumps({"error": message}, ensure_ascii=False).encode(),
+                           "application/json; charset=utf-8", status)
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+            parts = [p for p in url.path.split("/") if p]
+            try:
+                if len(parts) == 4 and parts[0] in sources.SOURCES:
+                    self.tile(parts, query)
+                elif parts == ["mosaic"]:
+                    self.mosaic(query)
+                elif len(parts) == 2 and parts[0] == "result":
+                    self.result(parts[1], query)
+                elif parts == ["metrics"]:
+                    self.send_body(metrics.prometheus().encode(), "text/plain; version=0.0.4; charset=utf-8")
+                elif parts == ["health"]:
+                    self.send_body(json.dumps(health()).encode(), "application/json")
+                elif len(parts) == 1 and parts[0] in PAGES or not parts:
+                    with open(os.path.join(here, parts[0] if parts else PAGES[0]), "rb") as f:
+                        self.send_body(f.read(), "text/html; charset=utf-8")
+                else:
+                    self.fail(404, "not found")
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+            except Exception as e:
+                print(f"[ERROR] {self.path} -> {e}")
+                try:
+                    self.fail(500, str(e))
+                except OSError:
+                    pass   # 连接已断，或响应已经发出一部分
+
+        def tile(self, parts, query):
+            source, z, x, y = parts[0], parts[1], parts[2], parts[3].split(".")[0]
+            if source == "google":
+                self.fail(404, "google 静态图不是 XYZ 瓦片")
+                return
+            try:
+                z, x, y = int(z), int(x), int(y)
+            except ValueError:
+                self.fail(400, "z / x / y 必须是整数")
+                return
+            src = sources.load_source(source)
+            try:
+                status, data = cache.get(src, z, x, y, query.get("accessKey") or access_key)
+            except Exception as e:
+                print(f"[ERROR] {source} z={z} x={x} y={y} -> {e}")
+                self.fail(502, f"上游下载失败：{e}")
+                return
+            if data is None:
+                self.fail(status, f"上游返回 {status}")
+                return
+            etag = '"' + tilestore.content_hash(data).hex() + '"'
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_body(data, CONTENT_TYPES.get(tilestore.detect_format(data), "application/octet-stream"),
+                           headers=(("ETag", etag), ("Cache-Control", f"max-age={TILE_MAX_AGE}")))
+
+        def mosaic(self, query):
+            try:
+                args = {"source": query.get("source", "osm"), "zoom": int(query["zoom"]),
+                        "bbox": [float(v) for v in query["bbox"].split(",")] if "bbox" in query else None,
+                        "aoi": query.get("aoi"), "buffer": float(query.get("buffer", 0)),
+                        "fmt": query.get("format", "png"),
+                        "access_key": query.get("accessKey") or access_key}
+            except (KeyError, ValueError) as e:
+                self.fail(400, f"参数错误：{e}")
+                return
+            if args["source"] not in sources.SOURCES or args["source"] == "google" or args["fmt"] not in ("png", "tif"):
+                self.fail(400, "source 只能是 osm / apple，format 只能是 png / tif")
+                return
+            if "text/event-stream" not in self.headers.get("Accept", ""):
+                try:
+                    name = mosaic(cache, **args, emit=lambda *a: None)
+                except (ValueError, SystemExit) as e:
+                    self.fail(400, str(e))
+                    return
+                except Exception as e:
+                    print(f"[ERROR] /mosaic -> {e}")
+                    self.fail(500, f"拼接失败：{e}")
+                    return
+                self.result(name, query)
+                return
+            self.mosaic_sse(args)
+
+        def mosaic_sse(self, args):
+            """SSE：拼接在后台线程里做，这个线程只负责把事件写给浏览器"""
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Cache-Control", "no-cache")
+            self.send_header("Access-Control-Allow-Origin", "*")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            self.close_connection = True
+
+            events = []
+            cond = threading.Condition()
+
+            def emit(event, data):
+                with cond:
+                    events.append((event, data))
+                    cond.notify()
+
+            def job():
+                try:
+                    name = mosaic(cache, **args, emit=emit)
+                    emit("done", {"url": f"/result/{name}", "name": name})
+                except (Exception, SystemExit) as e:
+                    emit("error", {"error": str(e)})
+
+            threading.Thread(target=job, daemon=True).start()
+            while True:
+                with cond:
+                    if not events:
+                        cond.wait(KEEPALIVE)
+                    batch, events[:] = events[:], []
+                if not batch:
+                    self.wfile.write(b": keepalive\n\n")
+                for event, data in batch:
+                    self.wfile.write(f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n".encode())
+                self.wfile.flush()
+                if any(event in ("done", "error") for event, _ in batch):
+                    return
+
+        def result(self, name, query):
+            path = os.path.join(OUTPUT_DIR, os.path.basename(name))
+            if not os.path.exists(path):
+                self.fail(404, "没有这个结果")
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPES.get(name.rsplit(".", 1)[-1], "application/octet-stream"))
+            self.send_header("Content-Length", str(os.path.getsize(path)))
+            self.send_header("Access-Control-Allow-Origin", "*")
+            if query.get("download"):
+                self.send_header("Content-Disposition", f'attachment; filename="{os.path.basename(name)}"')
+            self.end_headers()
+            with open(path, "rb") as f:
+                shutil.copyfileobj(f, self.wfile)
+
+    return TileHandler
+
+
+def serve(tile_db=TILE_DB, host=HOST, port=PORT, access_key=None):
+    """阻塞运行瓦片服务（Ctrl+C 停止）"""
+    from http.server import ThreadingHTTPServer
+
+    cache = TileCache(tile_db)
+    server = ThreadingHTTPServer((host, port), make_handler(cache, access_key))
+    server.daemon_threads = True
+    print(f"[INFO] 瓦片服务 → http://{host}:{server.server_port}/overview.html（瓦片库 {tile_db}）")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return server
@@ -0,0 +1,403 @@
+# -*- coding: utf-8 -*-
+"""
+分片下载：一个大任务按空间填充曲线（Hilbert / Z-order）切成空间上紧凑的分片，
+多台机器（或同一台机器的多个进程）通过共享文件系统上的租约文件领取分片，各自下载
+
+任务目录（放在 NFS / SMB 等共享盘上）：
+  job.json                任务头：来源、tile_range（可以是 AOI 任务）、曲线、每片瓦片数、分片数
+  leases/00012.lease      租约：{"worker", "expires"}；O_EXCL 新建 = 领取，持有期间后台线程定时续约
+  done/00012.json         完成记录：谁下的、写在哪个库、成功 / 失败瓦片数
+  tiles/00012.<worker>.mbtiles   每个分片单独一个瓦片库，只有领到租约的 worker 写（共享盘上的 SQLite 不能多机同时写）
+
+- 分片：瓦片按曲线序号排序后每 SHARD_TILES 张切一片，同一片在地图上是一小块，后面拼接时读库也集中
+- 过期租约（worker 崩溃 / 断网）超过 expires + LEASE_GRACE 后由别的 worker 原子地 rename 掉再重新领取；
+  续约时发现租约不是自己的就放弃这个分片（结果写在自己名下的库里，不会和接手的 worker 冲突）
+- 各节点时钟要大致同步（NTP），误差要小于 LEASE_GRACE
+- 全部分片完成后 merge 到主瓦片库，之后照常拼接
+
+  python cli.py shard osm --bbox=-8.80,52.80,-8.60,52.95 --zoom 17 --dir /mnt/share/jobs/ennis17
+  python cli.py work /mnt/share/jobs/ennis17                 # 每个节点跑一个（或 --local 4 本机起 4 个进程）
+  python cli.py work /mnt/share/jobs/ennis17 --status
+  python cli.py merge /mnt/share/jobs/ennis17 --db tiles/tiles.mbtiles
+"""
+
+import json
+import os
+import socket
+import threading
+import time
+
+import journal
+import sources
+import tilestore
+
+SHARD_TILES = 256      # 每个分片的瓦片数
+CURVE = "hilbert"      # 'hilbert' | 'z'（Morton）；Hilbert 相邻序号一定相邻，分片更紧凑
+LEASE_SECONDS = 60     # 租约有效期，持有期间每 1/3 有效期续约一次
+LEASE_GRACE = 30       # 过期多久之后才允许别人回收（容忍节点间的时钟误差）
+POLL_INTERVAL = 5      # 没有可领的分片但还有别人在做时，隔多久再看一次
+
+
+# ========================
+# 空间填充曲线
+# ========================
+def curve_order(n):
+    """能放下 n × n 网格的最小阶数（2^order >= n）"""
+    return max(1, (max(n, 1) - 1).bit_length())
+
+
+def hilbert_index(x, y, order):
+    """(x, y) 在 2^order × 2^order 网格上的 Hilbert 曲线序号（NumPy 数组，向量化）"""
+    import numpy as np
+
+    n = 1 << order
+    x = np.asarray(x, dtype=np.int64).copy()
+    y = np.asarray(y, dtype=np.int64).copy()
+    d = np.zeros_like(x)
+    s = n >> 1
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        d += s * s * ((3 * rx) ^ ry)
+        # 旋转象限
+        flip = ~ry & rx
+        x = np.where(flip, n - 1 - x, x)
+        y = np.where(flip, n - 1 - y, y)
+        x, y = np.where(ry, x, y), np.where(ry, y, x)
+        s >>= 1
+    return d
+
+
+def morton_index(x, y, order):
+    """Z-order（Morton）序号：x / y 的二进制位交错"""
+    import numpy as np
+
+    x = np.asarray(x, dtype=np.int64)
+    y = np.asarray(y, dtype=np.int64)
+    d = np.zeros_like(x)
+    for bit in range(order):
+        d |= ((x >> bit) & 1) << (2 * bit)
+        d |= ((y >> bit) & 1) << (2 * bit + 1)
+    return d
+
+
+def make_shards(tile_range, shard_tiles=SHARD_TILES, curve=CURVE):
+    """任务的全部瓦片按曲线排序后切片：[[(z, x, y), ...], ...]；同一个任务头在任何节点上结果都一样"""
+    import aoi
+    import numpy as np
+
+    tiles = np.array([(x, y) for _, x, y in aoi.job_tiles(tile_range)], dtype=np.int64).reshape(-1, 2)
+    x = tiles[:, 0] - tile_range["min_x"]
+    y = tiles[:, 1] - tile_range["min_y"]
+    order = curve_order(max(tile_range["max_x"] - tile_range["min_x"], tile_range["max_y"] - tile_range["min_y"]) + 1)
+    index = hilbert_index(x, y, order) if curve == "hilbert" else morton_index(x, y, order)
+    tiles = tiles[np.argsort(index, kind="stable")]
+    z = tile_range["zoom"]
+    return [[(z, int(tx), int(ty)) for tx, ty in tiles[i:i + shard_tiles]]
+            for i in range(0, len(tiles), shard_tiles)]
+
+
+# ========================
+# 任务目录
+# ========================
+def shard_name(i):
+    return f"{i:05d}"
+
+
+def init_job(job_dir, source, tile_range, shard_tiles=SHARD_TILES, curve=CURVE):
+    """在共享目录里建分片任务；目录里已有同一任务时原样返回（可以重复执行）"""
+    if source == "google":
+        raise ValueError("google 静态图不是 XYZ 瓦片，不能建分片任务")
+    src = sources.load_source(source)
+    job = {"source": source, "provider": src.PROVIDER, "tile_range": tile_range,
+           "curve": curve, "shard_tiles": shard_tiles}
+    path = os.path.join(job_dir, "job.json")
+    if os.path.exists(path):
+        existing = load_job(job_dir)
+        if {k: existing[k] for k in job} != json.loads(json.dumps(job)):
+            raise ValueError(f"{job_dir} 里已经有另一个任务")
+        print(f"[INFO] 分片任务已存在：{job_dir}（{existing['shards']} 片）")
+        return existing
+
+    shards = make_shards(tile_range, shard_tiles, curve)
+    job["shards"] = len(shards)
+    job["tiles"] = sum(len(s) for s in shards)
+    for sub in ("leases", "done", "tiles"):
+        os.makedirs(os.path.join(job_dir, sub), exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(job, f, ensure_ascii=False)
+    os.replace(tmp, path)
+    print(f"[OK] 分片任务 → {job_dir}：{job['tiles']} 张瓦片，{len(shards)} 片（{curve}，每片 {shard_tiles} 张）")
+    return job
+
+
+def load_job(job_dir):
+    with open(os.path.join(job_dir, "job.json"), "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def done_record(job_dir, i):
+    try:
+        with open(os.path.join(job_dir, "done", shard_name(i) + ".json"), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def write_json(path, data):
+    """先写临时文件再 rename：读的一方不会看到写了一半的文件"""
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+# ========================
+# 租约
+# ========================
+class Lease:
+    """一个分片的租约文件；持有期间后台线程续约，发现被别人回收就把 lost 置位"""
+
+    def __init__(self, path, worker, seconds=LEASE_SECONDS):
+        self.path = path
+        self.worker = worker
+        self.seconds = seconds
+        self.lost = False
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def body(self):
+        return json.dumps({"worker": self.worker, "expires": time.time() + self.seconds})
+
+    def acquire(self):
+        """O_EXCL 新建租约文件；已存在但过期超过 LEASE_GRACE 时先原子地 rename 掉再抢"""
+        for _ in range(2):
+            try:
+                fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            except FileExistsError:
+                if not self.reclaim():
+                    return False
+                continue
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(self.body())
+            self.thread = threading.Thread(target=self.renew_loop, daemon=True)
+            self.thread.start()
+            return True
+        return False
+
+    def reclaim(self):
+        """
+        过期的租约 rename 成 .stale 后删除；多个 worker 同时回收时 rename 只有一个成功
+        读和 rename 之间租约可能已被续约、或被别人回收后重新领走：rename 后再读一遍，
+        持有者 / 到期时间变了就说明拿到的是别人的有效租约，原样放回
+        """
+        holder = read_lease(self.path)
+        if holder is None or time.time() < holder["expires"] + LEASE_GRACE:
+            return False
+        stale = f"{self.path}.{self.worker}.stale"
+        try:
+            os.rename(self.path, stale)
+        except FileNotFoundError:
+            return False
+        moved = read_lease(stale)
+        if moved != holder:
+            self.restore(stale)
+            return False
+        os.remove(stale)
+        print(f"[WARN] 回收过期租约 {os.path.basename(self.path)}（原持有者 {holder['worker']}）")
+        return True
+
+    def restore(self, stale):
+        """把误 rename 走的有效租约放回；这期间又有人建了新租约时只能作废它（持有者续约时会发现）"""
+        try:
+            os.link(stale, self.path)   # 目标已存在时失败，不会覆盖别人刚建的租约
+        except FileExistsError:
+            pass
+        except OSError:
+            if not os.path.exists(self.path):   # 不支持硬链接的文件系统
+                os.rename(stale, self.path)
+                return
+        os.remove(stale)
+
+    def renew_loop(self):
+        while not self.stopped.wait(self.seconds / 3):
+            holder = read_lease(self.path)
+            if holder is None or holder["worker"] != self.worker:
+                self.lost = True
+                print(f"[WARN] 租约 {os.path.basename(self.path)} 已被回收，放弃这个分片")
+                return
+            write_json(self.path, json.loads(self.body()))
+
+    def release(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        holder = read_lease(self.path)
+        if holder is not None and holder["worker"] == self.worker:
+            os.remove(self.path)
+
+
+def read_lease(path):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None   # 不存在，或者别人正在写（下一轮再看）
+
+
+# ========================
+# Worker
+# ========================
+def worker_id():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def fetch_shard(src, job_dir, i, tiles, lease):
+    """下载一个分片到它自己的瓦片库；返回完成记录（租约丢了时返回 None）"""
+    name = shard_name(i)
+    db = os.path.join(job_dir, "tiles", f"{name}.{lease.worker}.mbtiles")
+    path = os.path.join(job_dir, "tiles", f"{name}.{lease.worker}.journal")
+    def while_held(batch):
+        # 租约被回收后不再派发新的瓦片（已在途的做完即止），免得和新持有者重复请求
+        for tile in batch:
+            if lease.lost:
+                return
+            yield tile
+
+    with tilestore.TileStore(db) as store:
+        job_log = journal.JobJournal(path, {"provider": src.PROVIDER, "shard": i, "tiles": len(tiles)},
+                                     before_sync=store.flush)
+        src.fetch_tiles(store, job_log, while_held(list(job_log.pending(tiles))), len(tiles))
+        failed = job_log.failed()
+        if failed and not lease.lost:
+            print(f"[INFO] 分片 {name} 补洞：重试 {len(failed)} 张失败瓦片")
+            src.fetch_tiles(store, job_log, while_held(failed), len(failed))
+        summary = job_log.finish()
+    if lease.lost:
+        return None
+    return {"worker": lease.worker, "db": os.path.basename(db), "finished": time.time(), **summary}
+
+
+def claim(job_dir, shards, worker, lease_seconds=LEASE_SECONDS):
+    """按曲线顺序领取下一个没完成、没人持有（或租约过期）的分片：(序号, Lease)；都没有时 (None, 还在做的片数)"""
+    busy = 0
+    for i in range(len(shards)):
+        if done_record(job_dir, i) is not None:
+            continue
+        lease = Lease(os.path.join(job_dir, "leases", shard_name(i) + ".lease"), worker, lease_seconds)
+        if lease.acquire():
+            return i, lease
+        busy += 1
+    return None, busy
+
+
+def work(job_dir, worker=None, lease_seconds=LEASE_SECONDS, rate=None, max_workers=None, settings=None):
+    """
+    一直领分片下载，直到所有分片都完成；返回本 worker 完成的片数
+    settings：覆盖来源模块配置区的常量，如 {"OSM_TILE_URL": ...}
+    """
+    job = load_job(job_dir)
+    src = sources.load_source(job["source"])
+    for name, value in (settings or {}).items():
+        setattr(src, name, value)
+    if rate is not None:
+        src.RATE_LIMIT = rate
+    if max_workers is not None:
+        src.MAX_WORKERS = max_workers
+    if src.__name__ == "jim" and os.getenv("APPLE_ACCESS_KEY"):
+        src.ACCESS_KEY = os.getenv("APPLE_ACCESS_KEY")
+    worker = worker or worker_id()
+    shards = make_shards(job["tile_range"], job["shard_tiles"], job["curve"])
+    finished = 0
+
+    while True:
+        i, lease = claim(job_dir, shards, worker, lease_seconds)
+        if i is None:
+            if lease == 0:
+                break
+            time.sleep(POLL_INTERVAL)   # 剩下的分片都有人在做；等它们完成或租约过期
+            continue
+        print(f"[INFO] {worker} 领取分片 {shard_name(i)}（{len(shards[i])} 张瓦片）")
+        try:
+            record = fetch_shard(src, job_dir, i, shards[i], lease)
+            if record is not None:
+                write_json(os.path.join(job_dir, "done", shard_name(i) + ".json"), record)
+                finished += 1
+        finally:
+            lease.release()
+
+    print(f"[OK] {worker}：所有分片已完成，本 worker 完成 {finished} 片")
+    return finished
+
+
+def _work_process(job_dir, n, lease_seconds, rate, max_workers, settings):
+    import metrics
+    work(job_dir, f"{worker_id()}-{n}", lease_seconds, rate=rate, max_workers=max_workers, settings=settings)
+    metrics.report()
+
+
+def work_local(job_dir, processes, rate=None, max_workers=None, settings=None, lease_seconds=LEASE_SECONDS):
+    """
+    本机起 processes 个 worker 进程（测试 / 单机多核）；同一个出口 IP，限速按进程数平分
+    settings：同 work（子进程是 spawn 出来的，主进程里改的模块常量带不过去）
+    """
+    from multiprocessing import get_context
+
+    if rate is None:
+        rate = sources.load_source(load_job(job_dir)["source"]).RATE_LIMIT
+    ctx = get_context("spawn")
+    procs = [ctx.Process(target=_work_process,
+                         args=(job_dir, n, lease_seconds, rate / processes, max_workers, settings))
+             for n in range(processes)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+    return [p.exitcode for p in procs]
+
+
+# ========================
+# 状态 / 合并
+# ========================
+def status(job_dir):
+    """已完成 / 进行中 / 租约过期 / 待领取的分片数，以及已完成分片里失败的瓦片数"""
+    job = load_job(job_dir)
+    counts = {"done": 0, "leased": 0, "stale": 0, "pending": 0, "failed_tiles": 0}
+    now = time.time()
+    for i in range(job["shards"]):
+        record = done_record(job_dir, i)
+        if record is not None:
+            counts["done"] += 1
+            counts["failed_tiles"] += record.get(journal.FAILED, 0)
+            continue
+        holder = read_lease(os.path.join(job_dir, "leases", shard_name(i) + ".lease"))
+        if holder is None:
+            counts["pending"] += 1
+        elif now < holder["expires"] + LEASE_GRACE:
+            counts["leased"] += 1
+        else:
+            counts["stale"] += 1
+    print(f"[INFO] {job_dir}：{job['shards']} 片，完成 {counts['done']}，进行中 {counts['leased']}，"
+          f"租约过期 {counts['stale']}，待领取 {counts['pending']}；失败瓦片 {counts['failed_tiles']}")
+    return counts
+
+
+def merge(job_dir, tile_db):
+    """把所有已完成分片的瓦片库并进主瓦片库；还有没完成的分片时报错"""
+    job = load_job(job_dir)
+    records = [done_record(job_dir, i) for i in range(job["shards"])]
+    missing = [shard_name(i) for i, r in enumerate(records) if r is None]
+    if missing:
+        raise RuntimeError(f"还有 {len(missing)} 个分片没完成（{', '.join(missing[:5])} …）")
+
+    total = 0
+    with tilestore.TileStore(tile_db) as store:
+        for record in records:
+            total += store.merge(os.path.join(job_dir, "tiles", record["db"]))
+    failed = sum(r.get(journal.FAILED, 0) for r in records)
+    print(f"[OK] 合并 {len(records)} 个分片，{total} 张瓦片 → {tile_db}"
+          + (f"（{failed} 张下载失败，拼接时留空）" if failed else ""))
+    return total
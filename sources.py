@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""
+瓦片来源和任务范围：命令行（cli.py）、批量清单（batch.py）、分片任务（shard.py）、瓦片服务（server.py）共用
+
+- SOURCES：来源名 → 模块（osm.py / jim.py / go.py），load_source 按需导入
+- tile_range：bbox / center + half_range / center + size / AOI → 来源模块用的任务范围
+
+只导入标准库；来源模块、mercator、aoi 在真正用到时才导入
+"""
+
+SOURCES = {"osm": "osm", "apple": "jim", "google": "go"}   # 来源 → 模块
+DEFAULT_DB = "tiles/tiles.mbtiles"
+
+
+def load_source(name):
+    """按需导入来源模块"""
+    import importlib
+    return importlib.import_module(SOURCES[name])
+
+
+# ========================
+# 范围
+# ========================
+def bbox_of(bbox=None, center=None, size=None):
+    """(min_lon, min_lat, max_lon, max_lat)：bbox，或 center (lat, lon) + size（宽, 高，米）"""
+    if bbox:
+        return tuple(bbox)
+    if center and size:
+        import mercator
+        lat, lon = center
+        mx, my = mercator.lonlat_to_mercator(lon, lat)
+        w, h = size
+        min_lon, min_lat = mercator.mercator_to_lonlat(mx - w / 2, my - h / 2)
+        max_lon, max_lat = mercator.mercator_to_lonlat(mx + w / 2, my + h / 2)
+        return min_lon, min_lat, max_lon, max_lat
+    return None
+
+
+def tile_range(zoom, bbox=None, center=None, half_range=None, size=None, aoi=None, buffer=0):
+    """瓦片来源的任务范围（tile_range），AOI 任务带 aoi / buffer_m"""
+    if aoi:
+        import aoi as aoi_
+        return aoi_.aoi_job(aoi, zoom, buffer)
+    box = bbox_of(bbox, center, size)
+    if box:
+        import osma
+        min_lon, min_lat, max_lon, max_lat = box
+        return osma.calculate_tile_range_from_area(min_lat, min_lon, max_lat, max_lon, zoom)
+    if center and half_range is not None:
+        import osm
+        return osm.calculate_tile_range(*center, zoom, half_range)
+    raise SystemExit("[ERROR] 需要范围：bbox、center + half_range、center + size 或 aoi")
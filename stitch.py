@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""
+流式拼接：按“瓦片行”逐行处理，整幅大图从不完整放在内存里
+
+- 每次只解码一行瓦片，拼成一条（总宽 × 瓦片高）的条带
+- 条带按扫描线直接压缩写进 PNG（IDAT 分块），写完立即释放
+- 峰值内存 ≈ 一行瓦片，与拼图总尺寸无关；同一时刻只打开一张瓦片文件
+- 从瓦片库拼接时按内容哈希去重解码（TileDecoder）：海面等重复瓦片只解码一次
+- 解码 / 粘贴耗时记进 metrics（decode_seconds / paste_seconds）
+"""
+
+import os
+import struct
+import zlib
+from collections import OrderedDict
+from io import BytesIO
+
+import metrics
+import tracing
+# PIL 在解码 / 粘贴的函数里才导入：encode.py 只用到这里的 PNG 条带写出，plan 等只看 encode 配置时不加载 PIL
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+IDAT_CHUNK_SIZE = 1 << 20   # 压缩数据攒够 1MB 写一个 IDAT 块
+DECODE_CACHE_SIZE = 256     # 最多缓存多少张解码后的重复瓦片（256×256 RGB 约 50MB）
+
+
+# ========================
+# 逐条带写 PNG
+# ========================
+def filter_rows(data, stride):
+    """若干整行原始 RGB 字节 → PNG 扫描线（每行前加滤波类型字节 0，即 None）"""
+    n_rows = len(data) // stride
+    view = memoryview(data)
+    raw = bytearray((stride + 1) * n_rows)
+    for r in range(n_rows):
+        start = r * (stride + 1)
+        raw[start + 1:start + 1 + stride] = view[r * stride:(r + 1) * stride]
+    return raw
+
+
+class PNGStripWriter:
+    """按扫描线顺序写 8 位 RGB PNG，每次写入若干整行"""
+
+    def __init__(self, path, width, height, compress_level=6):
+        self.width = width
+        self.height = height
+        self.stride = width * 3
+        self.rows_written = 0
+        self.pending = []
+        self.pending_size = 0
+        self.compressor = zlib.compressobj(compress_level)
+        self.f = open(path, "wb")
+        self.f.write(PNG_SIGNATURE)
+        # IHDR：宽、高、位深 8、颜色类型 2（RGB）、压缩 0、滤波 0、无隔行
+        self._chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+
+    def _chunk(self, tag, data):
+        self.f.write(struct.pack(">I", len(data)))
+        self.f.write(tag)
+        self.f.write(data)
+        self.f.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(tag)) & 0xFFFFFFFF))
+
+    def _emit(self, data, force=False):
+        if data:
+            self.pending.append(data)
+            self.pending_size += len(data)
+        if self.pending_size >= IDAT_CHUNK_SIZE or (force and self.pending_size):
+            self._chunk(b"IDAT", b"".join(self.pending))
+            self.pending = []
+            self.pending_size = 0
+
+    def write_rows(self, data):
+        """data：若干整行的原始 RGB 字节（行数 = len(data) / (width * 3)）"""
+        n_rows, rest = divmod(len(data), self.stride)
+        if rest:
+            raise ValueError("条带数据不是整行")
+        if self.rows_written + n_rows > self.height:
+            raise ValueError("写入行数超过图像高度")
+
+        self._emit(self.compressor.compress(bytes(filter_rows(data, self.stride))))
+        self.rows_written += n_rows
+
+    def close(self):
+        if self.f is None:
+            return
+        try:
+            if self.rows_written != self.height:
+                raise ValueError(f"只写了 {self.rows_written}/{self.height} 行")
+            self._emit(self.compressor.flush(), force=True)
+            self._chunk(b"IEND", b"")
+        finally:
+            self.f.close()
+            self.f = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.f.close()
+            self.f = None
+
+
+# ========================
+# 按内容去重解码
+# ========================
+class TileDecoder:
+    """同一内容哈希只解码一次；只缓存 shared 里（出现不止一次）的瓦片，LRU 淘汰"""
+
+    def __init__(self, shared=(), limit=DECODE_CACHE_SIZE):
+        self.shared = set(shared)
+        self.limit = limit
+        self.cache = OrderedDict()
+        self.decoded = 0
+        self.reused = 0
+
+    def get(self, key, load):
+        """key：内容哈希；load()：返回瓦片字节（只有缓存未命中时才调用）"""
+        img = self.cache.get(key)
+        if img is not None:
+            self.cache.move_to_end(key)
+            self.reused += 1
+            metrics.inc("decode_reused")
+            return img
+        from PIL import Image
+
+        data = load()
+        with metrics.timer("decode_seconds"):
+            with Image.open(BytesIO(data)) as src:
+                img = src.convert("RGB")
+        self.decoded += 1
+        if key in self.shared:
+            self.cache[key] = img
+            if len(self.cache) > self.limit:
+                self.cache.popitem(last=False)
+        return img
+
+    def report(self):
+        if self.reused:
+            print(f"[INFO] 解码 {self.decoded} 张，重复内容直接复用 {self.reused} 张")
+
+
+def store_rows(store, provider, zoom, bounds, wanted=None, decoder=None):
+    """
+    从瓦片库按行取瓦片并去重解码，返回 get_row(y) → {x: PIL Image}（可直接交给 stitch_streaming）
+    wanted：只取这些 (x, y)（AOI 稀疏瓦片集合）；返回的函数带 .decoder 属性（统计用）
+    """
+    min_x, max_x, min_y, max_y = bounds
+    if decoder is None:
+        decoder = TileDecoder(store.shared_hashes(provider, zoom, min_x, max_x, min_y, max_y))
+
+    def get_row(y):
+        row = {}
+        for x, h in store.row_refs(provider, zoom, y, min_x, max_x).items():
+            if wanted is not None and (x, y) not in wanted:
+                continue
+            try:
+                row[x] = decoder.get(h, lambda h=h: store.blob(h))
+            except Exception as e:
+                print(f"[WARN] 解码失败 z={zoom} x={x} y={y}: {e}")
+        return row
+
+    get_row.decoder = decoder
+    return get_row
+
+
+# ========================
+# 流式拼接
+# ========================
+def stitch_streaming(xs, ys, get_row, output_image, tile_size):
+    """
+    xs / ys：从左到右的列号、从上到下的行号
+    get_row(y)：返回该行 {x: 瓦片来源}（文件路径、文件对象或已解码的 PIL Image），缺失的瓦片不出现即可
+    tile_size：(瓦片宽, 瓦片高)
+    """
+    xs = list(xs)
+    ys = list(ys)
+    col_of = {x: i for i, x in enumerate(xs)}
+    tile_w, tile_h = tile_size
+    width = len(xs) * tile_w
+    height = len(ys) * tile_h
+
+    print(f"[INFO] 流式拼接：{width} x {height}（每次只处理一行瓦片）")
+
+    out_dir = os.path.dirname(output_image)
+    if out_dir:
+        os.makedirs(out_dir, exist_ok=True)
+
+    import encode
+    from PIL import Image
+
+    with encode.png_writer(output_image, width, height) as writer:
+        for y in ys:
+            with tracing.span("stitch.row", "stitch", y=y):
+                strip = Image.new("RGB", (width, tile_h))
+                for x, src in get_row(y).items():
+                    if x not in col_of:
+                        continue
+                    if isinstance(src, Image.Image):
+                        with metrics.timer("paste_seconds"):
+                            strip.paste(src, (col_of[x] * tile_w, 0))
+                        continue
+                    try:
+                        with Image.open(src) as img, metrics.timer("paste_seconds"):
+                            strip.paste(img, (col_of[x] * tile_w, 0))
+                    except Exception as e:
+                        print(f"[WARN] 打开失败 {src}: {e}")
+                writer.write_rows(strip.tobytes())
+                del strip
+
+    return output_image
+
+
+def probe_tile_size(src):
+    """只读文件头拿瓦片尺寸，不解码像素"""
+    from PIL import Image
+
+    with Image.open(src) as img:
+        return img.size
+
+
+def store_tile_size(store, provider, zoom, bounds):
+    """瓦片库中 bounds = (min_x, max_x, min_y, max_y) 范围内第一张瓦片的尺寸；范围内没有瓦片时报错"""
+    min_x, max_x, min_y, max_y = bounds
+    first = next(store.tiles_in_range(provider, zoom, min_x, max_x, min_y, max_y), None)
+    if first is None:
+        raise ValueError(f"瓦片库中没有 {provider} z={zoom} 范围内的瓦片。")
+    return probe_tile_size(BytesIO(first[2]))
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+"""
+瓦片库容量管理（cache.py）：按内容去重后的占用和淘汰
+
+  python -m pytest -q test_cache.py
+"""
+
+import time
+
+import cache
+import tilestore
+
+
+def test_lru_counts_shared_content_once(tmp_path):
+    blank = b"\0" * 1000
+    with tilestore.TileStore(str(tmp_path / "tiles.mbtiles")) as store:
+        for x in range(4):
+            store.put("osm", 5, x, 0, blank)                 # 4 张空白瓦片共用一份内容
+        for x in range(4, 6):
+            store.put("osm", 5, x, 0, bytes([x]) * 1000)    # 各自独立的内容
+        assert store.usage() == {"osm": (6, 3000)}
+
+        # 空白瓦片最久没访问：4 张全删才释放那份内容（删几张占用不变）
+        cache.set_policy(store, "osm", budget=2500)
+        result = cache.enforce(store, now=time.time() + 2 * cache.PROTECT_SECONDS)
+        assert result["osm"] == {"ttl": 0, "lru": 4, "freed": 1000}
+        assert store.usage() == {"osm": (2, 2000)}
+        assert not store.has("osm", 5, 0, 0) and store.has("osm", 5, 5, 0)
+
+
+def test_delete_reports_only_bytes_actually_freed(tmp_path):
+    with tilestore.TileStore(str(tmp_path / "tiles.mbtiles")) as store:
+        store.put("osm", 5, 0, 0, b"a" * 100)
+        store.put("osm", 5, 1, 0, b"a" * 100)
+        assert store.delete("osm", [(5, 0, 0)], "lru") == 0
+        assert store.delete("osm", [(5, 1, 0)], "lru") == 100
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+"""
+任务日志（journal.py）：进程被杀时写了一半的最后一行不能连累后面续写的记录
+
+  python -m pytest -q test_journal.py
+"""
+
+import journal
+
+JOB = {"provider": "osm", "zoom": 1, "min_x": 0, "max_x": 1, "min_y": 0, "max_y": 1}
+
+
+def test_record_after_torn_line_survives_reopen(tmp_path):
+    path = str(tmp_path / "job.journal")
+    with journal.JobJournal(path, JOB) as j:
+        j.record(1, 0, 0, journal.OK)
+    with open(path, "a", encoding="utf-8") as f:
+        f.write('{"z": 1, "x": 0, "y": 1, "sta')   # 写到一半被杀
+
+    with journal.JobJournal(path, JOB) as j:
+        j.record(1, 1, 0, journal.FAILED, "HTTP 503")
+
+    j = journal.JobJournal(path)
+    j.close()
+    assert j.states == {(1, 0, 0): (journal.OK, None, 1), (1, 1, 0): (journal.FAILED, "HTTP 503", 1)}
+
+
+def test_torn_job_header_starts_over(tmp_path):
+    path = str(tmp_path / "job.journal")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write('{"type": "job", "zo')
+
+    with journal.JobJournal(path, JOB) as j:
+        j.record(1, 0, 0, journal.OK)
+    assert journal.job_of(path) == JOB
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+分片任务（shard.py）：多个本机 worker 进程对着假瓦片服务器（bench.FakeTileServer）跑完整个任务，
+以及租约回收时的竞争
+
+  python -m pytest -q test_shard.py
+"""
+
+import json
+import os
+import time
+import types
+
+import pytest
+
+import bench
+import shard
+import tilestore
+
+TILE_RANGE = {"zoom": 12, "min_x": 1970, "max_x": 1975, "min_y": 1350, "max_y": 1355}   # 36 张瓦片
+
+
+def test_work_local_finishes_every_shard(tmp_path):
+    job_dir = str(tmp_path / "job")
+    tile_db = str(tmp_path / "tiles.mbtiles")
+    job = shard.init_job(job_dir, "osm", TILE_RANGE, shard_tiles=8)
+    assert job["shards"] == 5
+
+    with bench.FakeTileServer(latency=0.005, jitter=0.005, payload=2_000) as server:
+        settings = {"OSM_TILE_URL": server.url + "/{z}/{x}/{y}.png"}
+        assert shard.work_local(job_dir, 3, rate=0, max_workers=2, settings=settings) == [0, 0, 0]
+
+    counts = shard.status(job_dir)
+    assert counts["done"] == job["shards"]
+    assert counts["failed_tiles"] == 0
+    assert counts["leased"] == counts["stale"] == counts["pending"] == 0
+
+    assert shard.merge(job_dir, tile_db) == job["tiles"] == 36
+    with tilestore.TileStore(tile_db, readonly=True) as store:
+        assert store.count("osm", TILE_RANGE["zoom"]) == 36
+
+
+def test_reclaim_puts_back_a_lease_taken_over_meanwhile(tmp_path, monkeypatch):
+    path = str(tmp_path / "00000.lease")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"worker": "dead", "expires": time.time() - 10 * shard.LEASE_GRACE}, f)
+    fresh = {"worker": "other", "expires": time.time() + shard.LEASE_SECONDS}
+
+    # 读完过期租约、rename 之前，另一个 worker 已经回收并重新领走了这个分片
+    rename = os.rename
+
+    def racing_rename(src, dst):
+        if src == path:
+            shard.write_json(path, fresh)
+        rename(src, dst)
+
+    monkeypatch.setattr(shard.os, "rename", racing_rename)
+    assert shard.Lease(path, "me").reclaim() is False
+    assert shard.read_lease(path) == fresh
+    assert os.listdir(tmp_path) == ["00000.lease"]
+
+
+def test_fetch_shard_stops_feeding_tiles_once_the_lease_is_lost(tmp_path):
+    os.makedirs(tmp_path / "tiles")
+    lease = shard.Lease(str(tmp_path / "00000.lease"), "me")
+    fed = []
+
+    def fetch_tiles(store, job_log, tiles, total=None):
+        for tile in tiles:
+            fed.append(tile)
+            if len(fed) == 3:
+                lease.lost = True   # 续约线程发现租约已被别人回收
+
+    src = types.SimpleNamespace(PROVIDER="osm", fetch_tiles=fetch_tiles)
+    tiles = [(12, x, 1350) for x in range(1970, 1980)]
+    assert shard.fetch_shard(src, str(tmp_path), 0, tiles, lease) is None
+    assert len(fed) == 3
+
+
+def test_init_job_rejects_google(tmp_path):
+    with pytest.raises(ValueError):
+        shard.init_job(str(tmp_path / "job"), "google", TILE_RANGE)
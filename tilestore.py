@@ -0,0 +1,555 @@
+# -*- coding: utf-8 -*-
+"""
+MBTiles（SQLite）瓦片库：所有瓦片放进一个文件，代替成千上万个 z_x_y 小文件
+
+- 主键 (provider, z, x, y)，y 为 XYZ 行号（和下载 URL 一致）
+- 另建标准 MBTiles 的 tiles 视图（zoom_level / tile_column / tile_row(TMS) / tile_data），
+  单一来源的库可以直接用 QGIS 等工具打开
+- 写入先缓冲，攒够 BATCH_SIZE 条一次事务提交（下载线程的结果由主线程写入）
+- 拼接时按 (provider, z, y, x) 索引做范围查询，不再 os.listdir + 解析文件名
+- 同时保存每张瓦片的 ETag / Last-Modified，用于条件请求
+- 瓦片按服务端返回的原始字节保存（不重新编码），格式靠文件头魔数判断（detect_format）
+- 按内容去重：字节存在 blobs 表（主键为 BLAKE2 哈希），tile_store 里每个 (z, x, y) 只存哈希；
+  海面、无影像占位图等完全相同的瓦片只存一份，拼接时也只解码一次（见 stitch.TileDecoder）
+- 容量管理（见 cache.py）：accessed_at 为最近写入 / 读取 / 被任务使用的时间（按来源建索引，LRU 淘汰用），
+  pins 表记录正在进行的任务范围（不淘汰），cache_stats 表累计命中 / 未命中 / 淘汰次数
+"""
+
+import hashlib
+import os
+import sqlite3
+import struct
+import time
+from pathlib import Path
+
+BATCH_SIZE = 200   # 每个写事务的瓦片数
+SCHEMA_VERSION = 3 # 1：tile_store 直接存 data；2：data 移到 blobs 表按哈希去重；3：accessed_at / pins / cache_stats
+HASH_SIZE = 16     # BLAKE2b 摘要字节数
+
+# 文件头魔数 → 格式（扩展名）
+MAGIC_BYTES = [
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"\xff\xd8\xff", "jpg"),
+    (b"GIF87a", "gif"),
+    (b"GIF89a", "gif"),
+]
+
+
+def content_hash(data):
+    """瓦片内容的 BLAKE2b 哈希（blobs 表主键）"""
+    return hashlib.blake2b(data, digest_size=HASH_SIZE).digest()
+
+
+def detect_format(data):
+    """按文件头判断图片格式：'png' / 'jpg' / 'webp' / 'gif'；不是图片（例如 HTML 错误页）返回 None"""
+    if not data:
+        return None
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "webp"
+    for magic, fmt in MAGIC_BYTES:
+        if data.startswith(magic):
+            return fmt
+    return None
+
+
+def image_size(data):
+    """只看文件头拿 PNG / JPEG 的 (宽, 高)，不导入 PIL；其他格式或读不出时返回 None"""
+    fmt = detect_format(data)
+    if fmt == "png" and len(data) >= 24:
+        return struct.unpack(">II", data[16:24])
+    if fmt == "jpg":
+        i = 2
+        while i + 9 < len(data):
+            if data[i] != 0xFF:
+                return None
+            marker = data[i + 1]
+            if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7:   # 无长度的标记
+                i += 2
+                continue
+            # SOF0..SOF15（除去 DHT / JPG / DAC）：长度 2 + 精度 1 + 高 2 + 宽 2
+            if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                h, w = struct.unpack(">HH", data[i + 5:i + 9])
+                return w, h
+            i += 2 + struct.unpack(">H", data[i + 2:i + 4])[0]
+    return None
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS metadata (
+    name  TEXT PRIMARY KEY,
+    value TEXT
+);
+-- 瓦片内容，按哈希只存一份
+CREATE TABLE IF NOT EXISTS blobs (
+    hash BLOB PRIMARY KEY,
+    data BLOB NOT NULL
+);
+-- 主键列顺序 (provider, z, y, x)：同一行瓦片在索引里相邻，按行拼接时是一次范围扫描
+CREATE TABLE IF NOT EXISTS tile_store (
+    provider      TEXT    NOT NULL,
+    z             INTEGER NOT NULL,
+    x             INTEGER NOT NULL,
+    y             INTEGER NOT NULL,
+    hash          BLOB    NOT NULL,
+    etag          TEXT,
+    last_modified TEXT,
+    fetched_at    REAL,
+    accessed_at   REAL,
+    PRIMARY KEY (provider, z, y, x)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS tile_store_hash ON tile_store (hash);
+CREATE INDEX IF NOT EXISTS tile_store_access ON tile_store (provider, accessed_at);
+-- 正在进行的任务占用的瓦片范围：过期前不淘汰（进程崩溃留下的 pin 过期后自动失效）
+CREATE TABLE IF NOT EXISTS pins (
+    id       TEXT PRIMARY KEY,
+    provider TEXT    NOT NULL,
+    z        INTEGER NOT NULL,
+    min_x    INTEGER NOT NULL,
+    max_x    INTEGER NOT NULL,
+    min_y    INTEGER NOT NULL,
+    max_y    INTEGER NOT NULL,
+    expires  REAL    NOT NULL
+);
+-- 累计计数：hit / miss / evicted_lru / evicted_ttl
+CREATE TABLE IF NOT EXISTS cache_stats (
+    provider TEXT NOT NULL,
+    name     TEXT NOT NULL,
+    value    INTEGER NOT NULL,
+    PRIMARY KEY (provider, name)
+);
+CREATE VIEW IF NOT EXISTS tiles AS
+    SELECT t.z AS zoom_level, t.x AS tile_column, ((1 << t.z) - 1 - t.y) AS tile_row, b.data AS tile_data
+    FROM tile_store t JOIN blobs b ON b.hash = t.hash;
+"""
+
+# 版本 1 的库（tile_store.data）就地迁移到版本 2
+MIGRATE_V1 = """
+DROP VIEW IF EXISTS tiles;
+ALTER TABLE tile_store RENAME TO tile_store_v1;
+"""
+COPY_V1 = """
+INSERT OR IGNORE INTO blobs (hash, data) SELECT content_hash(data), data FROM tile_store_v1;
+INSERT INTO tile_store (provider, z, x, y, hash, etag, last_modified, fetched_at, accessed_at)
+    SELECT provider, z, x, y, content_hash(data), etag, last_modified, fetched_at, fetched_at FROM tile_store_v1;
+DROP TABLE tile_store_v1;
+"""
+# 版本 2 → 3：加 accessed_at 列（初值为下载时间），索引和新表由 SCHEMA 建
+MIGRATE_V2 = """
+ALTER TABLE tile_store ADD COLUMN accessed_at REAL;
+UPDATE tile_store SET accessed_at = fetched_at;
+"""
+
+
+class TileStore:
+    """一个 .mbtiles 文件；同一个对象只在一个线程里使用"""
+
+    def __init__(self, path, batch_size=BATCH_SIZE, readonly=False):
+        """
+        readonly=True：只读打开已有的库（多进程并行读取时用，不建表、不抢写锁）；
+        旧版本的库先读写打开一次完成升级，再只读打开
+        """
+        self.path = path
+        self.batch_size = batch_size
+        self.readonly = readonly
+        self.pending = []
+        self.touched = {}   # (provider, z, y, x) → 访问时间，和写入一起（或 close 时）提交
+        self.revalidated = {}   # (provider, z, y, x) → (etag, last_modified, 时间)：304 确认过仍然有效的瓦片
+        self.stats = {}     # (provider, name) → 本次累计的 hit / miss
+        if readonly:
+            self.conn = self._connect_readonly()
+            if self._outdated():
+                self.conn.close()
+                TileStore(path).close()   # 读写打开即按版本升级
+                self.conn = self._connect_readonly()
+            return
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        columns = [r[1] for r in self.conn.execute("PRAGMA table_info(tile_store)")]
+        if "data" in columns:
+            self._migrate_v1()
+        elif columns and "accessed_at" not in columns:
+            self.conn.executescript("BEGIN;" + MIGRATE_V2 + "COMMIT;")
+        self.conn.executescript(SCHEMA)
+        self.conn.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+
+    def _connect_readonly(self):
+        return sqlite3.connect(Path(self.path).resolve().as_uri() + "?mode=ro", uri=True)
+
+    def _outdated(self):
+        """库里有 tile_store 表但版本低于 SCHEMA_VERSION（版本 1 的库没有记 user_version）"""
+        version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+        if version >= SCHEMA_VERSION:
+            return False
+        return self.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name='tile_store'").fetchone() is not None
+
+    def _migrate_v1(self):
+        print(f"[INFO] 瓦片库 {self.path} 升级为按内容去重的格式 …")
+        self.conn.create_function("content_hash", 1, content_hash, deterministic=True)
+        self.conn.executescript("BEGIN;" + MIGRATE_V1 + SCHEMA + COPY_V1 + "COMMIT;")
+        self.conn.execute("VACUUM")
+
+    # ---------- 写 ----------
+    def put(self, provider, z, x, y, data, etag=None, last_modified=None):
+        """缓冲一张瓦片，攒够一批自动提交"""
+        self.pending.append((provider, z, x, y, content_hash(data), data, etag, last_modified, time.time()))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """把缓冲的瓦片在一个事务里写入；被覆盖且不再被引用的旧内容一并删掉"""
+        if not self.pending:
+            return
+        with self.conn:
+            old = set()
+            for provider, z, x, y, *_ in self.pending:
+                row = self.conn.execute(
+                    "SELECT hash FROM tile_store WHERE provider=? AND z=? AND y=? AND x=?",
+                    (provider, z, y, x),
+                ).fetchone()
+                if row:
+                    old.add(row[0])
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO blobs (hash, data) VALUES (?, ?)",
+                [(h, data) for _, _, _, _, h, data, *_ in self.pending],
+            )
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO tile_store "
+                "(provider, z, x, y, hash, etag, last_modified, fetched_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [(p, z, x, y, h, etag, lm, t, t) for p, z, x, y, h, _, etag, lm, t in self.pending],
+            )
+            old -= {h for _, _, _, _, h, *_ in self.pending}
+            self.conn.executemany(
+                "DELETE FROM blobs WHERE hash=? AND NOT EXISTS (SELECT 1 FROM tile_store WHERE hash=?)",
+                [(h, h) for h in old],
+            )
+            self._write_access()
+        self.pending = []
+
+    def _write_access(self):
+        """把缓冲的访问时间、重新验证时间和命中计数写进库（在调用方的事务里）"""
+        if self.revalidated:
+            # 304：内容没变，但等于刚下载过 —— TTL 从现在重新算，服务端给了新的 validators 就换上
+            self.conn.executemany(
+                "UPDATE tile_store SET fetched_at=?, accessed_at=?, etag=COALESCE(?, etag), "
+                "last_modified=COALESCE(?, last_modified) WHERE provider=? AND z=? AND y=? AND x=?",
+                [(t, t, etag, lm, *key) for key, (etag, lm, t) in self.revalidated.items()],
+            )
+            self.revalidated = {}
+        if self.touched:
+            self.conn.executemany(
+                "UPDATE tile_store SET accessed_at=? WHERE provider=? AND z=? AND y=? AND x=?",
+                [(t, *key) for key, t in self.touched.items()],
+            )
+            self.touched = {}
+        if self.stats:
+            self.count_many(self.stats)
+            self.stats = {}
+
+    def touch(self, provider, z, x, y, validators=None):
+        """
+        记一次访问（LRU 用）；攒够一批或 close 时提交，只读打开的库不记
+        validators：条件请求返回 304 时传入（可以是空 dict），同时刷新下载时间（TTL）和 ETag / Last-Modified
+        """
+        if self.readonly:
+            return
+        key = (provider, z, y, x)
+        self.touched[key] = now = time.time()
+        if validators is not None:
+            self.revalidated[key] = (validators.get("etag"), validators.get("last_modified"), now)
+        if len(self.touched) >= self.batch_size and not self.pending:
+            with self.conn:
+                self._write_access()
+
+    def tally(self, provider, name):
+        """hit / miss 计数，和访问时间一起提交"""
+        if not self.readonly:
+            self.stats[(provider, name)] = self.stats.get((provider, name), 0) + 1
+
+    def count_many(self, counts):
+        """{(provider, name): n} 累加进 cache_stats"""
+        self.conn.executemany(
+            "INSERT INTO cache_stats (provider, name, value) VALUES (?, ?, ?) "
+            "ON CONFLICT (provider, name) DO UPDATE SET value = value + excluded.value",
+            [(p, name, n) for (p, name), n in counts.items()],
+        )
+
+    def merge(self, path):
+        """
+        把另一个瓦片库（分片下载的结果，见 shard.py）整个并进来，返回并入的瓦片数
+        同一位置以并入的为准；被覆盖且不再被引用的旧内容一并删掉
+        """
+        self.flush()
+        self.conn.execute("ATTACH DATABASE ? AS src", (str(path),))
+        try:
+            with self.conn:
+                self.conn.execute("INSERT OR IGNORE INTO blobs (hash, data) SELECT hash, data FROM src.blobs")
+                n = self.conn.execute(
+                    "INSERT OR REPLACE INTO tile_store "
+                    "(provider, z, x, y, hash, etag, last_modified, fetched_at, accessed_at) "
+                    "SELECT provider, z, x, y, hash, etag, last_modified, fetched_at, fetched_at FROM src.tile_store"
+                ).rowcount
+                self.conn.execute(
+                    "DELETE FROM blobs WHERE NOT EXISTS (SELECT 1 FROM tile_store t WHERE t.hash = blobs.hash)"
+                )
+        finally:
+            self.conn.execute("DETACH DATABASE src")
+        return n
+
+    def set_metadata(self, **items):
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO metadata (name, value) VALUES (?, ?)",
+                [(k, str(v)) for k, v in items.items()],
+            )
+
+    def metadata(self):
+        return dict(self.conn.execute("SELECT name, value FROM metadata"))
+
+    # ---------- 读 ----------
+    def get(self, provider, z, x, y):
+        self.flush()
+        row = self.conn.execute(
+            "SELECT b.data FROM tile_store t JOIN blobs b ON b.hash = t.hash "
+            "WHERE t.provider=? AND t.z=? AND t.y=? AND t.x=?",
+            (provider, z, y, x),
+        ).fetchone()
+        self.tally(provider, "hit" if row else "miss")
+        if row:
+            self.touch(provider, z, x, y)
+        return row[0] if row else None
+
+    def has(self, provider, z, x, y):
+        self.flush()
+        return self.conn.execute(
+            "SELECT 1 FROM tile_store WHERE provider=? AND z=? AND y=? AND x=?",
+            (provider, z, y, x),
+        ).fetchone() is not None
+
+    def validators(self, provider, z, x, y):
+        """已缓存瓦片的 {'etag', 'last_modified'}；没有该瓦片时返回 None"""
+        self.flush()
+        row = self.conn.execute(
+            "SELECT etag, last_modified FROM tile_store WHERE provider=? AND z=? AND y=? AND x=?",
+            (provider, z, y, x),
+        ).fetchone()
+        self.tally(provider, "hit" if row else "miss")
+        if row is None:
+            return None
+        self.touch(provider, z, x, y)
+        return {"etag": row[0], "last_modified": row[1]}
+
+    def bounds(self, provider, z):
+        """库中该来源 / zoom 的瓦片范围 (min_x, max_x, min_y, max_y)，没有瓦片时返回 None"""
+        self.flush()
+        row = self.conn.execute(
+            "SELECT MIN(x), MAX(x), MIN(y), MAX(y) FROM tile_store WHERE provider=? AND z=?",
+            (provider, z),
+        ).fetchone()
+        return None if row[0] is None else row
+
+    def row(self, provider, z, y, min_x, max_x):
+        """一行瓦片 {x: data}（索引范围查询）"""
+        self.flush()
+        cur = self.conn.execute(
+            "SELECT t.x, b.data FROM tile_store t JOIN blobs b ON b.hash = t.hash "
+            "WHERE t.provider=? AND t.z=? AND t.y=? AND t.x BETWEEN ? AND ?",
+            (provider, z, y, min_x, max_x),
+        )
+        return dict(cur.fetchall())
+
+    def row_refs(self, provider, z, y, min_x, max_x):
+        """一行瓦片的内容哈希 {x: hash}（不读瓦片数据，配合 blob() 按需取）"""
+        self.flush()
+        cur = self.conn.execute(
+            "SELECT x, hash FROM tile_store WHERE provider=? AND z=? AND y=? AND x BETWEEN ? AND ?",
+            (provider, z, y, min_x, max_x),
+        )
+        return dict(cur.fetchall())
+
+    def blob(self, content_hash):
+        """按哈希取瓦片字节"""
+        self.flush()
+        row = self.conn.execute("SELECT data FROM blobs WHERE hash=?", (content_hash,)).fetchone()
+        return row[0] if row else None
+
+    def shared_hashes(self, provider, z, min_x, max_x, min_y, max_y):
+        """范围内出现不止一次的内容哈希（拼接时值得缓存解码结果的那些）"""
+        self.flush()
+        cur = self.conn.execute(
+            "SELECT hash FROM tile_store "
+            "WHERE provider=? AND z=? AND y BETWEEN ? AND ? AND x BETWEEN ? AND ? "
+            "GROUP BY hash HAVING COUNT(*) > 1",
+            (provider, z, min_y, max_y, min_x, max_x),
+        )
+        return {r[0] for r in cur}
+
+    def tiles_in_range(self, provider, z, min_x, max_x, min_y, max_y):
+        """按行优先顺序逐个返回 (x, y, data)"""
+        self.flush()
+        cur = self.conn.execute(
+            "SELECT t.x, t.y, b.data FROM tile_store t JOIN blobs b ON b.hash = t.hash "
+            "WHERE t.provider=? AND t.z=? AND t.y BETWEEN ? AND ? AND t.x BETWEEN ? AND ? "
+            "ORDER BY t.y, t.x",
+            (provider, z, min_y, max_y, min_x, max_x),
+        )
+        yield from cur
+
+    def keys_in_range(self, provider, z, min_x, max_x, min_y, max_y):
+        """范围内已缓存瓦片的 {(x, y), ...}（只走主键索引，不读瓦片数据）"""
+        self.flush()
+        cur = self.conn.execute(
+            "SELECT x, y FROM tile_store "
+            "WHERE provider=? AND z=? AND y BETWEEN ? AND ? AND x BETWEEN ? AND ?",
+            (provider, z, min_y, max_y, min_x, max_x),
+        )
+        return set(cur.fetchall())
+
+    def tile_stats(self, provider):
+        """该来源已缓存瓦片的 (张数, 平均字节数)，没有瓦片时平均值为 None"""
+        self.flush()
+        return tuple(self.conn.execute(
+            "SELECT COUNT(*), AVG(LENGTH(b.data)) FROM tile_store t JOIN blobs b ON b.hash = t.hash "
+            "WHERE t.provider=?", (provider,)
+        ).fetchone())
+
+    def dedup_stats(self):
+        """(瓦片位置数, 不同内容数, 内容总字节数)"""
+        self.flush()
+        tiles = self.conn.execute("SELECT COUNT(*) FROM tile_store").fetchone()[0]
+        blobs, size = self.conn.execute("SELECT COUNT(*), TOTAL(LENGTH(data)) FROM blobs").fetchone()
+        return tiles, blobs, int(size)
+
+    def count(self, provider, z):
+        self.flush()
+        return self.conn.execute(
+            "SELECT COUNT(*) FROM tile_store WHERE provider=? AND z=?", (provider, z)
+        ).fetchone()[0]
+
+    # ---------- 容量管理（策略见 cache.py） ----------
+    def pin(self, pin_id, provider, z, min_x, max_x, min_y, max_y, seconds):
+        """登记任务正在用的瓦片范围，seconds 秒后自动失效"""
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO pins (id, provider, z, min_x, max_x, min_y, max_y, expires) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (pin_id, provider, z, min_x, max_x, min_y, max_y, time.time() + seconds),
+            )
+
+    def unpin(self, pin_id):
+        """任务结束：范围内的瓦片记一次访问（刚用过，LRU 排到最后），删掉 pin"""
+        self.flush()
+        with self.conn:
+            row = self.conn.execute(
+                "SELECT provider, z, min_x, max_x, min_y, max_y FROM pins WHERE id=?", (pin_id,)
+            ).fetchone()
+            if row is None:
+                return
+            provider, z, min_x, max_x, min_y, max_y = row
+            self.conn.execute(
+                "UPDATE tile_store SET accessed_at=? "
+                "WHERE provider=? AND z=? AND y BETWEEN ? AND ? AND x BETWEEN ? AND ?",
+                (time.time(), provider, z, min_y, max_y, min_x, max_x),
+            )
+            self.conn.execute("DELETE FROM pins WHERE id=?", (pin_id,))
+
+    def usage(self):
+        """各来源的 {provider: (瓦片数, 字节数)}；字节数按该来源引用的不同内容算，共享内容只算一份"""
+        self.flush()
+        tiles = dict(self.conn.execute("SELECT provider, COUNT(*) FROM tile_store GROUP BY provider"))
+        cur = self.conn.execute(
+            "SELECT d.provider, TOTAL(LENGTH(b.data)) FROM (SELECT DISTINCT provider, hash FROM tile_store) d "
+            "JOIN blobs b ON b.hash = d.hash GROUP BY d.provider"
+        )
+        return {p: (tiles[p], int(size)) for p, size in cur}
+
+    def shared_refs(self, provider):
+        """该来源里被多张瓦片引用的内容 {hash: 引用数}（删掉其中一张，usage 里的字节数不变）"""
+        self.flush()
+        return dict(self.conn.execute(
+            "SELECT hash, COUNT(*) FROM tile_store WHERE provider=? GROUP BY hash HAVING COUNT(*) > 1", (provider,)
+        ))
+
+    def evictable(self, provider, accessed_before=None, fetched_before=None):
+        """
+        可淘汰的瓦片 (z, x, y, 内容哈希, 字节数)，最久没访问的在前：
+        不在未过期的 pin 范围内，且 accessed_at < accessed_before / fetched_at < fetched_before
+        """
+        self.flush()
+        now = time.time()
+        sql = ("SELECT t.z, t.x, t.y, t.hash, LENGTH(b.data) FROM tile_store t JOIN blobs b ON b.hash = t.hash "
+               "WHERE t.provider=? AND NOT EXISTS (SELECT 1 FROM pins p WHERE p.provider = t.provider "
+               "AND p.z = t.z AND t.x BETWEEN p.min_x AND p.max_x AND t.y BETWEEN p.min_y AND p.max_y "
+               "AND p.expires > ?)")
+        params = [provider, now]
+        if accessed_before is not None:
+            sql += " AND t.accessed_at < ?"
+            params.append(accessed_before)
+        if fetched_before is not None:
+            sql += " AND t.fetched_at < ?"
+            params.append(fetched_before)
+        yield from self.conn.execute(sql + " ORDER BY t.accessed_at", params)
+
+    def delete(self, provider, keys, reason):
+        """
+        删掉 [(z, x, y), ...] 和不再被引用的内容，计入 cache_stats 的 evicted_<reason>
+        返回实际释放的字节数（只算真正删掉的内容；别的瓦片还在引用的不算）
+        """
+        self.flush()
+        with self.conn:
+            old = set()
+            for z, x, y in keys:
+                row = self.conn.execute(
+                    "SELECT hash FROM tile_store WHERE provider=? AND z=? AND y=? AND x=?", (provider, z, y, x)
+                ).fetchone()
+                if row:
+                    old.add(row[0])
+            self.conn.executemany(
+                "DELETE FROM tile_store WHERE provider=? AND z=? AND y=? AND x=?",
+                [(provider, z, y, x) for z, x, y in keys],
+            )
+            freed = 0
+            for h in old:
+                row = self.conn.execute(
+                    "SELECT LENGTH(data) FROM blobs WHERE hash=? AND NOT EXISTS (SELECT 1 FROM tile_store WHERE hash=?)",
+                    (h, h),
+                ).fetchone()
+                if row:
+                    self.conn.execute("DELETE FROM blobs WHERE hash=?", (h,))
+                    freed += row[0]
+            self.count_many({(provider, f"evicted_{reason}"): len(keys)})
+        return freed
+
+    def cache_stats(self):
+        """累计计数 {provider: {name: n}}（包括本连接还没提交的 hit / miss）"""
+        stats = {}
+        for p, name, n in self.conn.execute("SELECT provider, name, value FROM cache_stats"):
+            stats.setdefault(p, {})[name] = n
+        for (p, name), n in self.stats.items():
+            stats.setdefault(p, {})[name] = stats.get(p, {}).get(name, 0) + n
+        return stats
+
+    def active_pins(self):
+        """未过期的 pin 数"""
+        return self.conn.execute("SELECT COUNT(*) FROM pins WHERE expires > ?", (time.time(),)).fetchone()[0]
+
+    # ---------- 生命周期 ----------
+    def close(self):
+        if self.conn is not None:
+            self.flush()
+            if self.touched or self.stats:
+                with self.conn:
+                    self._write_access()
+            self.conn.close()
+            self.conn = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
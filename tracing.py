@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+可选的时间线追踪：导出 Chrome trace-event JSON，用 Perfetto（https://ui.perfetto.dev）或 chrome://tracing 打开
+
+- 每个请求的各段（等并发窗口、等令牌桶、GET 本身（带状态码 / 字节数 / 首字节时间）、重试退避）、
+  每张瓦片的解码 / 粘贴、每个拼接 / 编码阶段都是一个 span，按线程分行显示：
+  哪张瓦片拖了后腿、哪段时间线程在空等，一眼就能看出来
+- metrics.timer 的每次计时（decode_seconds / paste_seconds ...）同时记成 span，不用重复埋点
+- 首字节时间（ttfb_ms）包括新连接的 DNS / TCP / TLS；keep-alive 复用的连接没有这部分
+- 默认关闭：span() 只多一次布尔判断，返回共享的空上下文管理器
+- 只记录本进程（多进程并行拼接的子进程不记录）；事件先放内存，save() 时一次写出
+
+  python cli.py fetch osm --bbox ... --zoom 16 --trace output/trace.json
+"""
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+ENABLED = False
+
+_events = []     # (名字, 类别, 开始, 时长或 None, 线程号, 参数)；list.append 本身是线程安全的
+_threads = {}    # 线程号 → 线程名
+_origin = 0.0
+_NULL = nullcontext()
+
+
+def start():
+    """开始记录（清空之前的事件）"""
+    global ENABLED, _origin
+    _events.clear()
+    _threads.clear()
+    _origin = time.perf_counter()
+    ENABLED = True
+
+
+def _tid():
+    tid = threading.get_ident()
+    if tid not in _threads:
+        _threads[tid] = threading.current_thread().name
+    return tid
+
+
+def span(name, cat="imagetool", **args):
+    """
+    with tracing.span("GET", "http", url=url) as info: ...
+    记录时 info 是参数 dict，可以在块里补充（状态码等）；关闭时 info 为 None
+    """
+    if not ENABLED:
+        return _NULL
+    return _span(name, cat, args)
+
+
+@contextmanager
+def _span(name, cat, args):
+    t0 = time.perf_counter()
+    try:
+        yield args
+    finally:
+        _events.append((name, cat, t0, time.perf_counter() - t0, _tid(), args))
+
+
+def complete(name, started, seconds, cat="imagetool", **args):
+    """已经计好时的一段（metrics.timer 用）：started 为 time.perf_counter() 读数"""
+    if ENABLED:
+        _events.append((name, cat, started, seconds, _tid(), args))
+
+
+def instant(name, cat="imagetool", **args):
+    """时间点事件（例如 429 / Retry-After）"""
+    if ENABLED:
+        _events.append((name, cat, time.perf_counter(), None, _tid(), args))
+
+
+def save(path):
+    """停止记录，写出 trace-event JSON，返回事件数"""
+    global ENABLED
+    ENABLED = False
+    pid = os.getpid()
+    events = [{"name": "process_name", "ph": "M", "pid": pid, "tid": 0, "args": {"name": "imagetool"}}]
+    events += [{"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}}
+               for tid, name in _threads.items()]
+    for name, cat, t0, seconds, tid, args in _events:
+        event = {"name": name, "cat": cat, "ts": round((t0 - _origin) * 1e6, 3), "pid": pid, "tid": tid}
+        if seconds is None:
+            event.update(ph="i", s="t")
+        else:
+            event.update(ph="X", dur=round(seconds * 1e6, 3))
+        if args:
+            event["args"] = args
+        events.append(event)
+
+    folder = os.path.dirname(path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f, default=str)
+    print(f"[OK] 时间线 → {path}（{len(_events)} 个事件，用 https://ui.perfetto.dev 或 chrome://tracing 打开）")
+    return len(_events)